@@ -0,0 +1,162 @@
+import json
+import time
+import asyncio
+import argparse
+import statistics
+
+import off
+import shard
+import fanout
+import discover
+import emulator
+
+DEFAULT_SIZES = (14, 100, 1000, 10000)
+APPLY_PARAMS = {"r": 255, "g": 70, "b": 10, "dimming": 60}
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def measure(emu, repeat, fn):
+    """
+    Run `fn(emu)` `repeat` times against the emulator.
+    `fn` returns how many bulbs acknowledged.
+    Returns a dict of timing (ms), packets per run (sent by the client, and
+    delivered to bulbs, where one broadcast reaches all of them) and
+    acknowledgement counts.
+    """
+    timings = []
+    packets = []
+    delivered = []
+    acked = []
+    for _ in range(repeat):
+        emu.reset_counters()
+        start = time.perf_counter()
+        acked.append(fn(emu))
+        timings.append((time.perf_counter() - start) * 1000)
+        counters = emu.counters()
+        packets.append(counters["packets_received"])
+        delivered.append(counters["packets_delivered"])
+    return {
+        "median_ms": statistics.median(timings),
+        "p95_ms": percentile(timings, 0.95),
+        "packets": statistics.median(packets),
+        "delivered": statistics.median(delivered),
+        "acked": min(acked),
+        "bulbs": emu.count,
+    }
+
+
+def bench_apply(emu):
+    # Whole-fleet setPilot through the fan-out engine.
+    targets = [(mac, ip, APPLY_PARAMS) for mac, ip in emu.macs_to_ips().items()]
+    results = fanout.run_send_all(targets)
+    return sum(fanout.is_success(reply) for reply, _ in results.values())
+
+
+def bench_group(emu):
+    # Whole-fleet setPilot as one broadcast plus unicast retries.
+    results = fanout.run_send_group(emu.macs_to_ips(), APPLY_PARAMS, broadcast_addr=emu.broadcast_addr)
+    return sum(fanout.is_success(reply) for reply, _ in results.values())
+
+
+def bench_wrap(emu):
+    # experimental.py's apply path for the named house (the first bulbs).
+    import experimental
+
+    data_list = [
+        (experimental.get_alias(mac), mac, ip)
+        for mac, ip in emu.macs_to_ips().items()
+        if mac in experimental.ALIAS_BY_MAC
+    ]
+    results = experimental.send_to_devices(data_list)
+    return sum(1 for _, success, _, _ in results.values() if success)
+
+
+def bench_discover(emu):
+    expected = emu.macs_to_ips()
+    return sum(1 for _ in discover.iter_devices(window=5.0, expected=expected, addr=emu.broadcast_addr))
+
+
+def bench_off(emu):
+    # off.py's bulk power-off from a cached bulb list.
+    results = asyncio.run(off.bulk_power(emu.macs_to_ips(), "off"))
+    return sum(1 for success, _ in results.values() if success)
+
+
+def bench_sharded(emu):
+    # Whole-fleet setPilot split across one worker process per core.
+    targets = [(mac, ip, APPLY_PARAMS) for mac, ip in emu.macs_to_ips().items()]
+    results = SHARD_POOL.send_all(targets)
+    return sum(fanout.is_success(reply) for reply, _, _ in results.values())
+
+
+# Started in run() only when the sharded benchmark is selected.
+SHARD_POOL = None
+
+BENCHMARKS = {
+    "apply": bench_apply,
+    "group": bench_group,
+    "wrap": bench_wrap,
+    "discover": bench_discover,
+    "off": bench_off,
+    "sharded": bench_sharded,
+}
+
+
+def format_row(size, name, result):
+    return (
+        f"{size:<7} {name:<9} "
+        f"MEDIAN={result['median_ms']:>9.1f}ms  "
+        f"P95={result['p95_ms']:>9.1f}ms  "
+        f"PACKETS={result['packets']:<7.0f} "
+        f"DELIVERED={result['delivered']:<7.0f} "
+        f"ACKED={result['acked']}/{result['bulbs']}"
+    )
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the send/discover paths against emulated bulbs.")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="comma-separated fleet sizes")
+    parser.add_argument("--bench", default=",".join(BENCHMARKS), help="comma-separated benchmarks")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.01, help="seconds")
+    parser.add_argument("--jitter", type=float, default=0.005, help="seconds")
+    parser.add_argument("--loss", type=float, default=0.0, help="drop probability per packet")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print one JSON object per result")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes for the sharded benchmark")
+    args = parser.parse_args(argv)
+
+    names = [name for name in args.bench.split(",") if name]
+    global SHARD_POOL
+    if "sharded" in names:
+        SHARD_POOL = shard.ShardPool(args.workers).start()
+    try:
+        run_sizes(args, names)
+    finally:
+        if SHARD_POOL is not None:
+            SHARD_POOL.close()
+
+
+def run_sizes(args, names):
+    # The emulator gets its own process: on a thread it would share the GIL
+    # with the code under test, and large fleets would measure the harness.
+    for size in (int(size) for size in args.sizes.split(",")):
+        with emulator.EmulatorProcess(count=size, latency=args.latency, jitter=args.jitter,
+                                     loss=args.loss, seed=args.seed) as emu:
+            for name in names:
+                # The named-house path only knows the first len(DEVICES) bulbs.
+                if name == "wrap" and size > len(discover.DEVICES):
+                    continue
+                result = measure(emu, args.repeat, BENCHMARKS[name])
+                if args.json:
+                    print(json.dumps({"size": size, "bench": name, **result}), flush=True)
+                else:
+                    print(format_row(size, name, result), flush=True)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,245 @@
+import os
+import json
+import ipaddress
+
+CONFIG_PATH = os.environ.get(
+    "WIZ_CONFIG",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "devices.json"),
+)
+# Seconds between mtime checks while watching the config file.
+WATCH_INTERVAL = 1.0
+# Flattened device table for quick commands, rebuilt when the config changes.
+COMPILED_CACHE = os.environ.get(
+    "WIZ_COMPILED_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "wizchatgpt", "compiled.json"),
+)
+
+
+class ConfigError(ValueError):
+    pass
+
+
+def group_override_key(group):
+    """
+    Name of the OVERRIDES entry for a group, e.g. "accent" -> "GROUP_ACCENT".
+    """
+    return f"GROUP_{group.upper()}"
+
+
+def resolve_params(defaults, group_override, device_override):
+    """
+    Resolve defaults -> group override -> device override for one device.
+    Overrides are {"enabled", "params"} entries; disabled ones don't apply.
+    """
+    params = dict(defaults)
+    for override in (group_override, device_override):
+        if override["enabled"]:
+            params.update(override["params"])
+    return params
+
+
+class Config:
+    """
+    Devices, groups, defaults, overrides, the skip list and the networks to
+    search from one config file, indexed by MAC, by name and by group.
+    """
+
+    def __init__(self, data, path=None, mtime=None):
+        self.path = path
+        self.mtime = mtime
+        self.defaults = dict(data.get("defaults", {}))
+        self.skip = list(data.get("skip", []))
+        # Interface names ("eth0") or subnets ("10.0.20.0/24"); empty means
+        # every local broadcast-capable interface.
+        self.networks = [str(spec) for spec in data.get("networks", [])]
+        for spec in self.networks:
+            if "/" in spec:
+                try:
+                    ipaddress.IPv4Network(spec, strict=False)
+                except ValueError as e:
+                    raise ConfigError(f"networks: {e}") from None
+        self.groups = {}
+        for group, spec in data.get("groups", {}).items():
+            self.groups[group] = {
+                "broadcast": spec.get("broadcast"),
+                "override": _override(spec.get("override"), f"group {group}"),
+                "members": [],
+            }
+
+        self.devices = {}
+        self.by_mac = {}
+        for name, spec in data.get("devices", {}).items():
+            mac = str(spec.get("mac", "")).lower().replace(":", "")
+            if len(mac) != 12:
+                raise ConfigError(f"device {name}: invalid mac {spec.get('mac')!r}")
+            if mac in self.by_mac:
+                raise ConfigError(f"device {name}: mac {mac} already used by {self.by_mac[mac]}")
+            group = spec.get("group")
+            if group not in self.groups:
+                raise ConfigError(f"device {name}: unknown group {group!r}")
+            self.devices[name] = {
+                "mac": mac,
+                "group": group,
+                "override": _override(spec.get("override"), f"device {name}"),
+            }
+            self.by_mac[mac] = name
+            self.groups[group]["members"].append(name)
+
+        for name in self.skip:
+            if name not in self.devices:
+                raise ConfigError(f"skip: unknown device {name!r}")
+
+    def devices_by_mac(self):
+        """
+        Return {mac: {"name", "group"}}, the shape discover.py and set.py use.
+        """
+        return {
+            device["mac"]: {"name": name, "group": device["group"]}
+            for name, device in self.devices.items()
+        }
+
+    def group_macs(self, group):
+        """
+        Return {name: mac} for the members of `group`, in config order.
+        """
+        return {name: self.devices[name]["mac"] for name in self.groups[group]["members"]}
+
+    def overrides(self):
+        """
+        Return the OVERRIDES table: group entries first, then every device.
+        """
+        table = {group_override_key(group): spec["override"] for group, spec in self.groups.items()}
+        table.update({name: device["override"] for name, device in self.devices.items()})
+        return table
+
+    def effective_params(self):
+        """
+        Resolve defaults -> group override -> device override for every device.
+        Returns {mac: params}.
+        """
+        return {
+            device["mac"]: resolve_params(
+                self.defaults, self.groups[device["group"]]["override"], device["override"]
+            )
+            for device in self.devices.values()
+        }
+
+
+def _override(spec, where):
+    if spec is None:
+        return {"enabled": False, "params": {}}
+    if not isinstance(spec, dict) or not isinstance(spec.get("params", {}), dict):
+        raise ConfigError(f"{where}: override must be {{\"enabled\": bool, \"params\": {{...}}}}")
+    return {"enabled": bool(spec.get("enabled", False)), "params": dict(spec.get("params", {}))}
+
+
+def load(path=None):
+    """
+    Read and validate the config file. Raises ConfigError on bad content.
+    """
+    path = path or CONFIG_PATH
+    with open(path) as f:
+        mtime = os.fstat(f.fileno()).st_mtime_ns
+        try:
+            data = json.load(f)
+        except ValueError as e:
+            raise ConfigError(f"{path}: {e}") from None
+    return Config(data, path, mtime)
+
+
+def compile_devices(cfg):
+    """
+    Flatten a Config into the table quick commands need, with each device's
+    final params already resolved.
+    Returns {"devices": {name: {"mac", "group", "params", "skip"}}, "groups": {group: [names]}}.
+    """
+    params = cfg.effective_params()
+    return {
+        "devices": {
+            name: {
+                "mac": device["mac"],
+                "group": device["group"],
+                "params": params[device["mac"]],
+                "skip": name in cfg.skip,
+            }
+            for name, device in cfg.devices.items()
+        },
+        "groups": {group: list(spec["members"]) for group, spec in cfg.groups.items()},
+    }
+
+
+def load_compiled(path=None, cache_path=COMPILED_CACHE):
+    """
+    Return compile_devices(load(path)), served from `cache_path` while the
+    config file's mtime and size are unchanged, so a warm start skips
+    parsing and validation. Returns (table, cached).
+    """
+    path = os.path.abspath(path or CONFIG_PATH)
+    stat = os.stat(path)
+    key = [path, stat.st_mtime_ns, stat.st_size]
+    try:
+        with open(cache_path) as f:
+            data = json.load(f)
+        if data.get("key") == key:
+            return data["table"], True
+    except (OSError, ValueError, AttributeError):
+        pass
+
+    table = compile_devices(load(path))
+    try:
+        directory = os.path.dirname(cache_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{cache_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"key": key, "table": table}, f)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # A read-only cache directory only costs the next start a rebuild.
+        pass
+    return table, False
+
+
+class Watcher:
+    """
+    Poll a config file's mtime and hand back a fresh Config when it changes.
+    """
+
+    def __init__(self, path=None, interval=WATCH_INTERVAL):
+        self.path = path or CONFIG_PATH
+        self.interval = interval
+        self.mtime = self._mtime()
+
+    def _mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def poll(self):
+        """
+        Return a new Config if the file changed since the last poll, else None.
+        A file that fails to parse is reported once and otherwise ignored.
+        """
+        mtime = self._mtime()
+        if mtime is None or mtime == self.mtime:
+            return None
+        self.mtime = mtime
+        try:
+            return load(self.path)
+        except (OSError, ConfigError) as e:
+            print(f"Error reloading config: {e}")
+            return None
+
+    async def watch(self, on_change):
+        """
+        Call `on_change(config)` (a coroutine function) for every change until cancelled.
+        """
+        # Imported here: asyncio is the slowest import by far, and only the daemon watches.
+        import asyncio
+
+        while True:
+            await asyncio.sleep(self.interval)
+            new = self.poll()
+            if new is not None:
+                await on_change(new)
@@ -0,0 +1,452 @@
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import asyncio
+import argparse
+
+import config
+import fade
+import fanout
+import metrics
+import registry
+import state
+import poller
+import push
+import scheduler
+
+SOCKET_PATH = os.environ.get(
+    "WIZ_DAEMON_SOCKET",
+    os.path.join(os.environ.get("XDG_RUNTIME_DIR") or "/tmp", f"wizchatgpt-{os.getuid()}.sock"),
+)
+# How often the registry and state caches are flushed to disk.
+SAVE_INTERVAL = 60
+MAX_REQUEST = 64 * 1024
+
+# If set, HTTP commands must carry "Authorization: Bearer <token>".
+HTTP_TOKEN = os.environ.get("WIZ_HTTP_TOKEN")
+# Without a token, HTTP requests must name one of these hosts (or the address
+# the server listens on), so a DNS-rebound web page can't reach the daemon.
+LOCAL_HOSTS = ("127.0.0.1", "localhost", "[::1]")
+
+HTTP_STATUS = {
+    200: "OK", 400: "Bad Request", 401: "Unauthorized", 403: "Forbidden", 404: "Not Found",
+    405: "Method Not Allowed", 415: "Unsupported Media Type",
+}
+
+# setPilot params a "set" or "override" command may carry.
+SET_PARAMS = set(state.PILOT_KEYS) | set(state.PARAM_ALIASES)
+
+
+def check_params(params):
+    """
+    Return `params` if it is a dict of known setPilot fields with sensible
+    values, otherwise raise ValueError.
+    """
+    if not isinstance(params, dict):
+        raise ValueError("params must be a JSON object")
+    unknown = sorted(set(params) - SET_PARAMS)
+    if unknown:
+        raise ValueError(f"unknown params: {', '.join(unknown)}")
+    for name, value in params.items():
+        if name == "state":
+            if not isinstance(value, bool):
+                raise ValueError("state must be true or false")
+            continue
+        if value is None and name in ("sceneId", "sceneID"):
+            continue  # clears a scene
+        if isinstance(value, bool) or not isinstance(value, int):
+            raise ValueError(f"{name} must be an integer")
+        low, high = fade.PARAM_RANGES.get(name, (0, None))
+        if value < low or (high is not None and value > high):
+            raise ValueError(f"{name} out of range: {value}")
+    return params
+
+
+class Controller:
+    """
+    Keeps the device registry, an open fan-out socket and last-known state
+    warm, and executes scene, group and device commands against them.
+    """
+
+    def __init__(self):
+        self.engine = None
+        self.scheduler = None
+        self.registry = registry.get_registry()
+        self.state = state.get_state_cache()
+        self.started = time.time()
+        self.poller = None
+        self.push = None
+
+    async def start(self):
+        # experimental loads the config on import; keeping it out of module
+        # scope lets the thin `call` client start fast and survive a broken config.
+        import experimental
+
+        self.engine = await fanout.FanoutEngine(broadcast=True).open()
+        self.scheduler = scheduler.SendScheduler(self.engine)
+        self.registry.resolve(experimental.ALL_MACS.values())
+
+    def start_poller(self, interval):
+        """
+        Keep a getPilot history for every known device, sweeping every `interval` seconds.
+        Returns the background task.
+        """
+        self.poller = poller.Poller(
+            lambda: {mac: ip for _, mac, ip in self.known_devices()}, interval, engine=self.engine,
+        )
+        return asyncio.ensure_future(self.poller.run())
+
+    def start_push(self, port=push.LISTEN_PORT):
+        """
+        Register with every known device and track the state it pushes.
+        Returns the background task.
+        """
+        self.push = push.PushListener(
+            lambda: {mac: ip for _, mac, ip in self.known_devices()}, port, engine=self.engine,
+        )
+        return asyncio.ensure_future(self.push.run())
+
+    def close(self):
+        if self.scheduler is not None:
+            self.scheduler.close()
+        if self.engine is not None:
+            self.engine.close()
+        self.save()
+
+    def save(self):
+        self.registry.save()
+        self.state.save()
+        metrics.METRICS.write_textfile()
+
+    def known_devices(self, target="all"):
+        """
+        Return (alias, mac, ip) for the reachable devices named by `target`:
+        an alias, a config group or "all".
+        """
+        import experimental
+
+        if target == "all":
+            aliases = experimental.ALL_MACS
+        elif target in experimental.GROUP_MACS:
+            aliases = experimental.GROUP_MACS[target]
+        elif target in experimental.ALL_MACS:
+            aliases = [target]
+        else:
+            raise ValueError(f"unknown target: {target}")
+        macs = [experimental.ALL_MACS[alias] for alias in aliases]
+        ips = self.registry.resolve(macs)
+        return [(experimental.get_alias(mac), mac, ips[mac]) for mac in macs if mac in ips]
+
+    async def send(self, devices, method, params):
+        """
+        Send one explicit command to every device and record the outcome.
+        Commands go through the rate-limited scheduler, so a burst of "set"
+        requests (a dimmer slider, say) collapses to the newest per bulb.
+        """
+        results = {}
+        futures = {alias: self.scheduler.submit(alias, ip, method, params) for alias, _, ip in devices}
+        for alias, mac, _ in devices:
+            reply, latency, sent = await futures[alias]
+            success = fanout.is_success(reply)
+            if success:
+                self.state.record_sent(mac, sent, method)
+            else:
+                self.state.forget(mac)
+            results[alias] = {
+                "success": success,
+                "latency": latency,
+                "attempts": self.engine.stats.get(alias, {}).get("attempts", 1),
+            }
+        return results
+
+    async def reload(self, cfg=None):
+        """
+        Load a new config and push it to only the devices whose output changed.
+        """
+        import experimental
+
+        changed = experimental.reload_config(cfg)
+        results = await experimental.apply_changed(changed, self.engine)
+        return {"ok": True, "changed": [alias for alias, _ in changed], "results": {
+            alias: {"success": success, "latency": latency, "attempts": attempts}
+            for alias, (_, success, latency, attempts) in results.items()
+        }}
+
+    async def handle(self, request):
+        """
+        Execute one command dict and return a JSON-serialisable reply.
+        """
+        import experimental
+
+        cmd = request.get("cmd")
+        if cmd == "apply":
+            # The configured scene, skipping bulbs that already show it.
+            results = await experimental.apply_devices(
+                self.known_devices(), whole_house=True,
+                skip_unchanged=request.get("skip_unchanged", True), engine=self.engine,
+            )
+            return {"ok": True, "results": {
+                alias: {"success": success, "latency": latency, "attempts": attempts}
+                for alias, (_, success, latency, attempts) in results.items()
+            }}
+        if cmd == "set":
+            devices = self.known_devices(request.get("target", "all"))
+            return {"ok": True, "results": await self.send(devices, "setPilot", check_params(request.get("params", {})))}
+        if cmd == "power":
+            devices = self.known_devices(request.get("target", "all"))
+            if not isinstance(request.get("state"), bool):
+                raise ValueError("state must be true or false")
+            params = {"state": request["state"]}
+            return {"ok": True, "results": await self.send(devices, "setState", params)}
+        if cmd == "override":
+            key = request["key"]
+            if key not in experimental.OVERRIDES:
+                raise ValueError(f"unknown override: {key}")
+            if "params" in request:
+                experimental.OVERRIDES[key]["params"].update(check_params(request["params"]))
+            if "enabled" in request:
+                experimental.OVERRIDES[key]["enabled"] = bool(request["enabled"])
+            return await self.handle({"cmd": "apply"})
+        if cmd == "status":
+            devices = {}
+            for alias, mac, ip in self.known_devices():
+                devices[alias] = {"mac": mac, "ip": ip, "state": self.state.get(mac)}
+            reply = {"ok": True, "uptime": time.time() - self.started, "devices": devices,
+                     "queued": self.scheduler.depths()}
+            if self.push is not None:
+                reply["registered"] = len(self.push.registered)
+            return reply
+        if cmd == "history":
+            if self.poller is None:
+                raise ValueError("poller not running (start the daemon with --poll)")
+            devices = self.known_devices(request.get("target", "all"))
+            if request.get("since") is None and request.get("until") is None:
+                latest = self.poller.latest()
+                return {"ok": True, "devices": {alias: latest.get(mac) for alias, mac, _ in devices}}
+            return {"ok": True, "devices": {
+                alias: self.poller.range(mac, request.get("since"), request.get("until"))
+                for alias, mac, _ in devices
+            }}
+        if cmd == "drift":
+            if self.poller is None:
+                raise ValueError("poller not running (start the daemon with --poll)")
+            devices = self.known_devices(request.get("target", "all"))
+            expected = {mac: experimental.get_command_params(mac) for alias, mac, _ in devices
+                        if alias not in experimental.SKIP_LIST}
+            drifted = self.poller.drifted(expected)
+            unreachable = set(self.poller.unreachable())
+            return {"ok": True, "drifted": {
+                experimental.get_alias(mac): diff for mac, diff in drifted.items()
+            }, "unreachable": [alias for alias, mac, _ in devices if mac in unreachable]}
+        if cmd == "reload":
+            return await self.reload()
+        if cmd == "refresh":
+            self.registry.scan()
+            return {"ok": True, "devices": len(self.registry)}
+        if cmd == "metrics":
+            if request.get("format") == "prometheus":
+                return {"ok": True, "text": metrics.prometheus()}
+            return {"ok": True, "metrics": metrics.snapshot()}
+        raise ValueError(f"unknown command: {cmd}")
+
+    async def dispatch(self, raw):
+        try:
+            request = json.loads(raw)
+            if not isinstance(request, dict):
+                raise ValueError("request must be a JSON object")
+            return await self.handle(request)
+        except (ValueError, KeyError) as e:
+            return {"ok": False, "error": str(e)}
+        except Exception as e:
+            # Whatever went wrong, the client gets a reply rather than a hung connection.
+            return {"ok": False, "error": f"{type(e).__name__}: {e}"}
+
+
+async def serve_unix(controller, path):
+    """
+    Newline-delimited JSON over a Unix domain socket: one request per line,
+    one reply per line.
+    """
+    async def on_client(reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                reply = await controller.dispatch(line)
+                writer.write(json.dumps(reply).encode() + b"\n")
+                await writer.drain()
+        finally:
+            writer.close()
+
+    if os.path.exists(path):
+        os.unlink(path)
+    # Created owner-only from the start: a chmod after bind would leave a
+    # window in which another user could connect.
+    umask = os.umask(0o177)
+    try:
+        server = await asyncio.start_unix_server(on_client, path, limit=MAX_REQUEST)
+    finally:
+        os.umask(umask)
+    return server
+
+
+async def serve_http(controller, host, port, token=HTTP_TOKEN):
+    """
+    Minimal local HTTP front end: POST /command with a JSON body,
+    GET /status, and GET /metrics in the Prometheus text format.
+
+    Commands must be sent as application/json, which a web page can't do
+    cross-site without a CORS preflight this server never answers; with
+    `token` they must also carry "Authorization: Bearer <token>". Without
+    one, every request's Host must be local (LOCAL_HOSTS or `host`), since
+    a page whose name was rebound to this machine is same-origin.
+    """
+    allowed_hosts = set(LOCAL_HOSTS) | {host, f"[{host}]"}
+
+    def local_host(value):
+        # Strip the port: "localhost:8765" or "[::1]:8765".
+        name = value.rsplit(":", 1)[0] if value.rsplit(":", 1)[-1].isdigit() else value
+        return name.lower() in allowed_hosts
+
+    async def respond(writer, status, body, content_type="application/json"):
+        writer.write(
+            f"HTTP/1.1 {status} {HTTP_STATUS[status]}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+
+    async def on_client(reader, writer):
+        try:
+            request_line = (await reader.readline()).decode().split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode().strip()
+                if not line:
+                    break
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            if len(request_line) < 2:
+                await respond(writer, 400, b'{"ok": false}')
+                return
+            method, target = request_line[0], request_line[1]
+            if not token and not local_host(headers.get("host", "")):
+                await respond(writer, 403, b'{"ok": false}')
+                return
+            if method == "GET" and target == "/metrics":
+                await respond(writer, 200, metrics.prometheus().encode(), "text/plain; version=0.0.4")
+            elif method == "GET" and target == "/status":
+                await respond(writer, 200, json.dumps(await controller.handle({"cmd": "status"})).encode())
+            elif target == "/command":
+                if method != "POST":
+                    await respond(writer, 405, b'{"ok": false}')
+                    return
+                if headers.get("content-type", "").split(";")[0].strip().lower() != "application/json":
+                    await respond(writer, 415, b'{"ok": false}')
+                    return
+                if token and headers.get("authorization") != f"Bearer {token}":
+                    await respond(writer, 401, b'{"ok": false}')
+                    return
+                length = min(int(headers.get("content-length", 0)), MAX_REQUEST)
+                body = await reader.readexactly(length)
+                reply = await controller.dispatch(body)
+                await respond(writer, 200 if reply["ok"] else 400, json.dumps(reply).encode())
+            else:
+                await respond(writer, 404, b'{"ok": false}')
+        except (ValueError, asyncio.IncompleteReadError):
+            await respond(writer, 400, b'{"ok": false}')
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(on_client, host, port)
+
+
+async def run_daemon(path=SOCKET_PATH, http=None, poll=None, listen=False):
+    import experimental
+
+    controller = Controller()
+    await controller.start()
+    tasks = []
+    if poll:
+        tasks.append(controller.start_poller(poll))
+    if listen:
+        tasks.append(controller.start_push())
+    servers = [await serve_unix(controller, path)]
+    print(f"Listening on {path}")
+    if http:
+        host, _, port = http.rpartition(":")
+        servers.append(await serve_http(controller, host or "127.0.0.1", int(port)))
+        print(f"Listening on http://{host or '127.0.0.1'}:{port}")
+    watcher = config.Watcher(experimental.CONFIG.path)
+    watch_task = asyncio.ensure_future(watcher.watch(controller.reload))
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+    try:
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), SAVE_INTERVAL)
+            except asyncio.TimeoutError:
+                controller.save()
+    finally:
+        watch_task.cancel()
+        for task in tasks:
+            task.cancel()
+        for server in servers:
+            server.close()
+        controller.close()
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def call(request, path=SOCKET_PATH, timeout=10):
+    """
+    Thin client: send one command dict to the daemon and return its reply.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        data = b""
+        while not data.endswith(b"\n"):
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        sock.close()
+    return json.loads(data)
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description="Resident WiZ controller.")
+    parser.add_argument("--socket", default=SOCKET_PATH)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    serve = subparsers.add_parser("serve", help="run the daemon")
+    serve.add_argument("--http", help="also listen for HTTP on HOST:PORT (e.g. 127.0.0.1:8765)")
+    serve.add_argument("--poll", type=float, metavar="SECONDS",
+                       help="poll every bulb's state on this interval and keep a history")
+    serve.add_argument("--push", action="store_true",
+                       help="register with the bulbs and track the state they push")
+    send = subparsers.add_parser("call", help="send one JSON command to a running daemon")
+    send.add_argument("request", help='e.g. \'{"cmd": "power", "target": "accent", "state": false}\'')
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        asyncio.run(run_daemon(args.socket, args.http, args.poll, args.push))
+        return
+    reply = call(json.loads(args.request), args.socket)
+    print(json.dumps(reply, indent=2))
+    if not reply.get("ok"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    run()
@@ -1,26 +1,19 @@
-import re
+import sys
 import time
 import socket
 import json
-import subprocess
-
-DEVICES = {
-    "d8a01165a452": {"name": "DRESSER", "group": "accent"},
-    "cc40853d9142": {"name": "FACES", "group": "accent"},
-    "cc4085840e8a": {"name": "HORSE", "group": "accent"},
-    "cc40853e5276": {"name": "PIG", "group": "accent"},
-    "444f8e1f2fc8": {"name": "SKULLS", "group": "accent"},
-
-    "cc40855a796e": {"name": "ALIEN", "group": "overhead"},
-    "cc4085558f40": {"name": "BATHROOM", "group": "overhead"},
-    "d8a011671f1a": {"name": "ENTRANCE", "group": "overhead"},
-    "cc4085558842": {"name": "K_0", "group": "overhead"},
-    "cc40855a7c1e": {"name": "K_1", "group": "overhead"},
-    "cc4085558c88": {"name": "S_0", "group": "overhead"},
-    "d8a01161d568": {"name": "S_1", "group": "overhead"},
-    "cc40855a7e7c": {"name": "TV_0", "group": "overhead"},
-    "d8a01162e8da": {"name": "TV_1", "group": "overhead"},
-}
+import argparse
+
+import state
+import config
+import metrics
+import networks
+import registry
+import tracing
+
+# Devices, groups and networks come from the shared config file (devices.json).
+CONFIG = config.load()
+DEVICES = CONFIG.devices_by_mac()
 
 DEFAULT_PARAMS = {
     "r": 255,
@@ -30,6 +23,15 @@ DEFAULT_PARAMS = {
     "sceneID": None,
 }
 
+WIZ_PORT = 38899
+BROADCAST_ADDR = "255.255.255.255"
+DISCOVERY_WINDOW = 2.0
+# Every bulb answers the broadcast at once; make room for the burst.
+RECV_BUFFER = 4 * 1024 * 1024
+
+for mac, device in DEVICES.items():
+    metrics.register_device(mac, device["name"], device["group"])
+
 OVERRIDES = {
     # GROUPS
     "ACCENT": False,
@@ -54,13 +56,42 @@ OVERRIDES = {
     "TV_1": False,
 }
 
-def send_command(command):
-    terminal_command = ["echo", "{}".format(command)]  # Replace with the actual command split into a list
-    socat = ["socat", "-", "UDP-DATAGRAM:255.255.255.255:38899,broadcast"]
-    process1 = subprocess.Popen(terminal_command, stdout=subprocess.PIPE, text=True)
-    process2 = subprocess.run(socat, stdin=process1.stdout, capture_output=True, text=True, check=True)
-    results = process2.stdout
-    return results
+def iter_replies(command, window=DISCOVERY_WINDOW, addr=BROADCAST_ADDR):
+    """
+    Broadcast `command` once to `addr` (one address or a list, e.g. one
+    directed broadcast per subnet) and yield (reply dict, sender ip) for every
+    datagram that arrives within one shared `window` of seconds. Each
+    datagram is parsed on its own; malformed ones are skipped.
+    """
+    addrs = [addr] if isinstance(addr, str) else list(addr)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER)
+        for broadcast in addrs:
+            try:
+                sock.sendto(command.encode(), (broadcast, WIZ_PORT))
+            except OSError as e:
+                # An unreachable VLAN shouldn't stop the others.
+                print(f"Error broadcasting to {broadcast}: {e}", file=sys.stderr)
+                continue
+            metrics.record_send(broadcast, json.loads(command)["method"])
+        deadline = time.monotonic() + window
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            sock.settimeout(remaining)
+            try:
+                data, (ip, _) = sock.recvfrom(4096)
+            except socket.timeout:
+                return
+            try:
+                yield json.loads(data.decode()), ip
+            except ValueError:
+                print(f"Error processing device: {data!r}. Error: malformed reply", file=sys.stderr)
+    finally:
+        sock.close()
 
 def build_command(method, params={}):
     command = json.dumps({
@@ -84,41 +115,108 @@ def format_output(device_details):
     )
     return formatted
 
-def discover_devices():
-    command = build_command("getPilot")
-    results = send_command(command)
-    devices = results.split('}{')
-    devices = [device + '}' if not device.endswith('}}') else device for device in devices]
-    devices = ['{' + device if not device.startswith('{') else device for device in devices]
+def format_ndjson(device_details):
+    return json.dumps(device_details, separators=(",", ":"))
 
-    grouped_devices = {"accent": [], "overhead": []}
+def broadcast_targets(specs=None):
+    """
+    Return the resolved networks for `specs` (default: the config's), and
+    their broadcast addresses, falling back to the limited broadcast.
+    """
+    nets = networks.resolve(CONFIG.networks if specs is None else specs)
+    return nets, [net["broadcast"] for net in nets] or [BROADCAST_ADDR]
 
-    for device in devices:
-        try:
-            device_details = json.loads(device)["result"]
-            device_mac = device_details["mac"]
+def iter_devices(window=DISCOVERY_WINDOW, expected=DEVICES, addr=None, specs=None):
+    """
+    Yield device details from a getPilot broadcast as soon as each bulb answers.
+    Without `addr` every network in `specs` (default: the config's) is searched
+    in the same window, and each bulb's IP and network land in the registry.
+    Stops when the collection window closes or every MAC in `expected` has answered.
+    """
+    command = build_command("getPilot")
+    nets, default_addrs = broadcast_targets(specs)
+    reg = registry.get_registry()
+    waiting = set(expected)
+    seen = set()
+    start = time.monotonic()
+    traced = tracing.now()
+    try:
+        for reply, ip in iter_replies(command, window, addr or default_addrs):
+            try:
+                device_details = reply["result"]
+                device_mac = device_details["mac"]
+            except (KeyError, TypeError) as e:
+                print(f"Error processing device: {reply}. Error: {e}", file=sys.stderr)
+                continue
+            if device_mac in seen:
+                continue
+            metrics.record_reply(device_mac, "getPilot", time.monotonic() - start)
+            if tracing.ENABLED:
+                tracing.complete("getPilot", traced, tracing.now(), "bulb", device_mac, ip=ip)
+            seen.add(device_mac)
+            state.get_state_cache().seed(device_mac, device_details)
+            net = networks.network_for(ip, nets)
+            reg.put(device_mac, ip, networks.label(net) if net else None)
             # Ensure all parameters exist; use `` if not present
             for param in DEFAULT_PARAMS.keys():
                 if param not in device_details:
                     device_details[param] = ""
+            device_details["ip"] = ip
+            device_details["network"] = networks.label(net) if net else None
             if device_mac in DEVICES:
                 device_details["name"] = DEVICES[device_mac]["name"]
-                group = DEVICES[device_mac]["group"]
-                grouped_devices[group].append(device_details)
+                device_details["group"] = DEVICES[device_mac]["group"]
             else:
                 device_details["name"] = "UNKNOWN"
-        except Exception as e:
-            print(f"Error processing device: {device}. Error: {e}")
+                device_details["group"] = None
+            yield device_details
+            waiting.discard(device_mac)
+            if expected and not waiting:
+                return
+    finally:
+        # The whole collection window; it ends early once every expected bulb answered.
+        tracing.complete("collect_replies", traced, tracing.now(), devices=len(seen))
+
+def discover_devices(window=DISCOVERY_WINDOW, specs=None):
+    grouped_devices = {device["group"]: [] for device in DEVICES.values()}
+
+    for device_details in iter_devices(window, specs=specs):
+        if device_details["group"] in grouped_devices:
+            grouped_devices[device_details["group"]].append(device_details)
 
     # Sort and display devices by group
-    for group_name, devices in grouped_devices.items():
-        print(group_name.upper())
-        for device in sorted(devices, key=lambda x: x["name"]):
-            print(format_output(device))
-        print()  # Add a blank line between groups
-
-def run():
-    discover_devices()
+    with tracing.span("print"):
+        for group_name, devices in grouped_devices.items():
+            print(group_name.upper())
+            for device in sorted(devices, key=lambda x: x["name"]):
+                print(format_output(device))
+            print()  # Add a blank line between groups
+
+def discover_ndjson(window=DISCOVERY_WINDOW, specs=None):
+    # Print each device as one JSON line the moment it answers.
+    for device_details in iter_devices(window, specs=specs):
+        print(format_ndjson(device_details), flush=True)
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description="Discover WiZ bulbs with a getPilot broadcast.")
+    parser.add_argument("--ndjson", action="store_true", help="stream one JSON object per device")
+    parser.add_argument("--window", type=float, default=DISCOVERY_WINDOW, help="collection window in seconds")
+    parser.add_argument("--network", action="append", dest="networks",
+                        help="interface or subnet to search (repeatable; default: the config's networks)")
+    parser.add_argument("--trace", metavar="PATH",
+                        help="write a Chrome trace of the run to PATH and print a phase summary")
+    args = parser.parse_args(argv)
+    if args.trace:
+        tracing.enable(args.trace)
+    if args.ndjson:
+        discover_ndjson(args.window, args.networks)
+    else:
+        discover_devices(args.window, args.networks)
+    with tracing.span("save_caches"):
+        registry.get_registry().save()
+        # Remember what every bulb is showing so applies can skip unchanged ones.
+        state.get_state_cache().save()
+        metrics.METRICS.write_textfile()
 
 if __name__ == "__main__":
     run()
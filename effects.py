@@ -0,0 +1,259 @@
+import time
+import asyncio
+import argparse
+
+import numpy as np
+
+import fade
+import config
+import fanout
+import metrics
+import registry
+import scheduler
+import templates
+
+DEFAULT_FPS = 20
+
+# One row per bulb, one column per channel.
+COLUMNS = ("r", "g", "b", "dimming")
+LOW = np.array([fade.PARAM_RANGES[column][0] for column in COLUMNS], dtype=np.float64)
+HIGH = np.array([fade.PARAM_RANGES[column][1] for column in COLUMNS], dtype=np.float64)
+
+
+def fleet_array(keys, params):
+    """
+    Build the (bulbs x COLUMNS) float array for `keys`, in order, from
+    {key: params}. Missing channels default to 0 (dimming to 100).
+    """
+    base = np.zeros((len(keys), len(COLUMNS)))
+    base[:, COLUMNS.index("dimming")] = 100
+    for row, key in enumerate(keys):
+        for column, name in enumerate(COLUMNS):
+            value = params.get(key, {}).get(name)
+            if isinstance(value, (int, float)):
+                base[row, column] = value
+    return base
+
+
+def quantize(frame):
+    """
+    Round and clamp a float frame to the integer range each channel accepts.
+    Returns an int16 array of the same shape.
+    """
+    frame = np.rint(frame)
+    np.maximum(frame, LOW, out=frame)
+    np.minimum(frame, HIGH, out=frame)
+    return frame.astype(np.int16)
+
+
+def _color(color, base):
+    # A full (r, g, b, dimming) row, or (r, g, b) keeping each bulb's dimming.
+    color = np.asarray(color, dtype=np.float64)
+    if color.shape[-1] == len(COLUMNS):
+        return np.broadcast_to(color, base.shape)
+    return np.column_stack([np.broadcast_to(color, (len(base), 3)), base[:, 3]])
+
+
+def gradient(base, start=(255, 0, 0), end=(0, 0, 255), speed=0.0):
+    """
+    Blend from `start` to `end` along the bulbs' order; `speed` (cycles per
+    second) scrolls it, wrapping smoothly back from `end` to `start`.
+    """
+    start = _color(start, base)
+    span = _color(end, base) - start
+    position = np.linspace(0.0, 1.0, len(base), endpoint=False) if speed else np.linspace(0.0, 1.0, len(base))
+
+    def render(t):
+        # Triangle wave so a scrolling gradient has no seam.
+        mix = np.abs(((position + t * speed) % 1.0) * 2 - 1) if speed else position
+        return start + span * mix[:, None]
+
+    return render
+
+
+def chase(base, color=(255, 255, 255, 100), width=3.0, speed=5.0, background=None):
+    """
+    A lit band `width` bulbs long running along the order at `speed` bulbs
+    per second, fading out behind its head, over `background` (default: base).
+    """
+    background = base if background is None else _color(background, base)
+    span = _color(color, base) - background
+    index = np.arange(len(base), dtype=np.float64)
+
+    def render(t):
+        distance = (t * speed - index) % len(base)
+        intensity = np.clip(1.0 - distance / width, 0.0, 1.0)
+        return background + span * intensity[:, None]
+
+    return render
+
+
+def flicker(base, amount=0.3, seed=None):
+    """
+    Candle flicker: every frame each bulb's dimming drops by a random
+    fraction of up to `amount`.
+    """
+    rng = np.random.default_rng(seed)
+    dimming = COLUMNS.index("dimming")
+
+    def render(t):
+        frame = base.copy()
+        frame[:, dimming] *= 1.0 - amount * rng.random(len(base))
+        return frame
+
+    return render
+
+
+def breathing(base, period=4.0, low=0.2, spread=0.0):
+    """
+    Dimming rises and falls between `low` and full on a `period`; `spread`
+    (0..1 of a period) offsets the phase along the order so it ripples.
+    """
+    phase = np.linspace(0.0, spread, len(base), endpoint=False)
+    dimming = COLUMNS.index("dimming")
+
+    def render(t):
+        level = low + (1.0 - low) * (0.5 - 0.5 * np.cos(2 * np.pi * (t / period - phase)))
+        frame = base.copy()
+        frame[:, dimming] *= level
+        return frame
+
+    return render
+
+
+EFFECTS = {
+    "gradient": gradient,
+    "chase": chase,
+    "flicker": flicker,
+    "breathing": breathing,
+}
+
+
+def changed_rows(previous, frame):
+    """
+    Return the indices of bulbs whose quantized values differ from the last frame sent.
+    """
+    if previous is None:
+        return np.arange(len(frame))
+    return np.flatnonzero(np.any(previous != frame, axis=1))
+
+
+async def run_effect(targets, render, duration, fps=DEFAULT_FPS, engine=None):
+    """
+    Play `render` (from one of EFFECTS) on `targets`, an ordered {key: ip},
+    for `duration` seconds at `fps`. Frames are computed for the whole fleet
+    at once, and only bulbs whose quantized values differ from what they were
+    last sent get a packet, patched into a shared packet template.
+    A bulb (or the fleet) out of send tokens just skips the frame and is
+    brought up to date by a later one, so slow bulbs always get the newest
+    values. Returns a dict of stats: frames, dropped, packets and render_us
+    (mean microseconds per frame).
+    """
+    keys = list(targets)
+    template = templates.template_for(COLUMNS)
+    buckets = [scheduler.TokenBucket(scheduler.BULB_RATE, scheduler.BULB_BURST) for _ in keys]
+    fleet = scheduler.TokenBucket(scheduler.GLOBAL_RATE, scheduler.GLOBAL_BURST)
+    counts = np.zeros(len(keys), dtype=np.int64)
+    sent = np.full((len(keys), len(COLUMNS)), -1, dtype=np.int16)
+    frames = dropped = 0
+    render_time = 0.0
+
+    owns_engine = engine is None
+    if owns_engine:
+        engine = await fanout.FanoutEngine().open()
+    addrs = [(targets[key], engine.port) for key in keys]
+    try:
+        interval = 1.0 / fps
+        began = time.monotonic()
+        frame_number = 0
+        while True:
+            due = began + frame_number * interval
+            if due - began >= duration:
+                break
+            delay = due - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            elif frame_number:
+                skipped = int(-delay / interval)
+                dropped += skipped
+                frame_number += skipped
+            rendered = time.perf_counter()
+            now = time.monotonic()
+            frame = quantize(render(now - began))
+            rows = changed_rows(sent, frame)
+            render_time += time.perf_counter() - rendered
+            if len(rows):
+                # Rotate the starting bulb so a fleet-wide limit doesn't starve the tail.
+                rows = np.roll(rows, -(frame_number % len(rows)))
+                # Only spend a bulb's token once the fleet has granted one too.
+                allowed = []
+                for row in rows.tolist():
+                    if not buckets[row].ready(now):
+                        continue
+                    if not fleet.try_take(now):
+                        break
+                    buckets[row].try_take(now)
+                    allowed.append(row)
+                template.send_batch(engine.transport, frame[allowed].tolist(), [addrs[row] for row in allowed])
+                sent[allowed] = frame[allowed]
+                counts[allowed] += 1
+            frames += 1
+            frame_number += 1
+    finally:
+        if owns_engine:
+            engine.close()
+
+    for row in np.flatnonzero(counts).tolist():
+        metrics.record_send(keys[row], "setPilot", count=int(counts[row]))
+    return {
+        "frames": frames,
+        "dropped": dropped,
+        "packets": int(counts.sum()),
+        "render_us": render_time / max(frames, 1) * 1e6,
+    }
+
+
+def time_render(count, effect="chase", frames=1000):
+    """
+    Mean microseconds to render, quantize and diff one frame for `count` bulbs.
+    """
+    base = np.tile([255.0, 80.0, 5.0, 60.0], (count, 1))
+    render = EFFECTS[effect](base)
+    previous = None
+    start = time.perf_counter()
+    for frame_number in range(frames):
+        frame = quantize(render(frame_number / DEFAULT_FPS))
+        changed_rows(previous, frame)
+        previous = frame
+    return (time.perf_counter() - start) / frames * 1e6
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description="Play a whole-group light effect.")
+    parser.add_argument("effect", choices=sorted(EFFECTS))
+    parser.add_argument("--group", default="accent", help="config group, in config (physical) order, or 'all'")
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--fps", type=float, default=DEFAULT_FPS)
+    parser.add_argument("--time-render", type=int, metavar="BULBS",
+                        help="only time frame rendering for this many bulbs")
+    args = parser.parse_args(argv)
+
+    if args.time_render:
+        print(f"{args.effect}: {time_render(args.time_render, args.effect):.1f}us per frame "
+              f"for {args.time_render} bulbs")
+        return
+
+    cfg = config.load()
+    names = cfg.devices if args.group == "all" else cfg.groups[args.group]["members"]
+    macs = [cfg.devices[name]["mac"] for name in names]
+    ips = registry.get_registry().resolve(macs)
+    targets = {mac: ips[mac] for mac in macs if mac in ips}
+    effective = cfg.effective_params()
+    render = EFFECTS[args.effect](fleet_array(list(targets), effective))
+    stats = asyncio.run(run_effect(targets, render, args.seconds, args.fps))
+    print(f"{args.effect}: {stats['frames']} frames, {stats['dropped']} dropped, "
+          f"{stats['packets']} packets, {stats['render_us']:.1f}us per frame")
+
+
+if __name__ == "__main__":
+    run()
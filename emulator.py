@@ -0,0 +1,379 @@
+import json
+import time
+import random
+import asyncio
+import argparse
+import threading
+import multiprocessing
+
+from discover import DEVICES
+
+WIZ_PORT = 38899
+# Bulbs push syncPilot to registered listeners on this port for REGISTRATION_TTL seconds.
+PUSH_PORT = 38900
+REGISTRATION_TTL = 30
+# Virtual bulbs live on 127.1.0.1 upwards; the "broadcast" listener fans out to all of them.
+BASE_OCTETS = (127, 1)
+BROADCAST_ADDR = "127.255.255.254"
+
+
+def bulb_ip(index):
+    return f"{BASE_OCTETS[0]}.{BASE_OCTETS[1] + index // 62500}.{index % 62500 // 250}.{index % 250 + 1}"
+
+
+def bulb_mac(index):
+    # The real house comes first so the scripts recognise the emulated bulbs.
+    known = list(DEVICES)
+    if index < len(known):
+        return known[index]
+    return f"aa{index:010x}"
+
+
+class VirtualBulb(asyncio.DatagramProtocol):
+    """
+    One emulated WiZ bulb answering getPilot, setPilot, setState and
+    registration, and pushing syncPilot to registered listeners on changes.
+    """
+
+    def __init__(self, emulator, mac, ip):
+        self.emulator = emulator
+        self.mac = mac
+        self.ip = ip
+        self.transport = None
+        # phone ip -> registration expiry (monotonic)
+        self.subscribers = {}
+        self.pilot = {"state": False, "sceneId": 0, "r": 0, "g": 0, "b": 0, "c": 0, "w": 0,
+                      "dimming": 100, "temp": 2700, "rssi": -55}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.emulator.packets_received += 1
+        self.handle(data, addr)
+
+    def handle(self, data, addr):
+        emulator = self.emulator
+        emulator.packets_delivered += 1
+        if emulator.rng.random() < emulator.loss:
+            emulator.packets_dropped += 1
+            return
+        try:
+            message = json.loads(data.decode())
+        except ValueError:
+            return
+        reply = self.reply_for(message)
+        if reply is None:
+            return
+        delay = max(0.0, emulator.latency + emulator.rng.uniform(-emulator.jitter, emulator.jitter))
+        payload = json.dumps(reply).encode()
+        if delay:
+            emulator.loop.call_later(delay, self._send, payload, addr)
+        else:
+            self._send(payload, addr)
+
+    def _send(self, payload, addr):
+        # Delayed replies can come due after the emulator has been closed.
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.sendto(payload, addr)
+            self.emulator.packets_sent += 1
+
+    def push(self):
+        now = time.monotonic()
+        payload = json.dumps({
+            "method": "syncPilot",
+            "env": "pro",
+            "params": {"mac": self.mac, "src": "", **self.pilot},
+        }).encode()
+        for phone_ip, expires in list(self.subscribers.items()):
+            if expires < now:
+                del self.subscribers[phone_ip]
+            else:
+                self._send(payload, (phone_ip, self.emulator.push_port))
+
+    def reply_for(self, message):
+        method = message.get("method")
+        params = message.get("params", {})
+        reply = {"method": method, "env": "pro"}
+        if "id" in message:
+            reply["id"] = message["id"]
+        if method == "getPilot":
+            reply["result"] = {"mac": self.mac, **self.pilot}
+        elif method == "setPilot":
+            self.pilot["state"] = True
+            if "sceneId" in params or "sceneID" in params:
+                self.pilot["sceneId"] = params.get("sceneId", params.get("sceneID"))
+            elif {"r", "g", "b", "c", "w", "temp"} & set(params):
+                self.pilot["sceneId"] = 0
+            for param in ("r", "g", "b", "c", "w", "dimming", "temp", "speed"):
+                if param in params:
+                    self.pilot[param] = int(params[param])
+            reply["result"] = {"success": True}
+            self.push()
+        elif method == "setState":
+            self.pilot["state"] = bool(params.get("state"))
+            reply["result"] = {"success": True}
+            self.push()
+        elif method == "registration":
+            if params.get("register") and params.get("phoneIp"):
+                self.subscribers[params["phoneIp"]] = time.monotonic() + REGISTRATION_TTL
+            reply["result"] = {"mac": self.mac, "success": True}
+        else:
+            reply["error"] = {"code": -32601, "message": "Method not found"}
+        return reply
+
+
+class BroadcastListener(asyncio.DatagramProtocol):
+    """
+    Stands in for the LAN broadcast address: every datagram is delivered to
+    every virtual bulb, which answers from its own address.
+    """
+
+    def __init__(self, emulator):
+        self.emulator = emulator
+
+    def datagram_received(self, data, addr):
+        # One datagram from the client, however many bulbs hear it.
+        self.emulator.packets_received += 1
+        for bulb in self.emulator.bulbs:
+            bulb.handle(data, addr)
+
+
+class Emulator:
+    """
+    N virtual WiZ bulbs on loopback with configurable latency, jitter and loss.
+
+    Usage:
+        async with Emulator(count=100, latency=0.01, loss=0.02) as emulator:
+            emulator.macs_to_ips()  # {mac: ip}
+    """
+
+    def __init__(self, count=len(DEVICES), latency=0.01, jitter=0.005, loss=0.0,
+                 port=WIZ_PORT, seed=None, push_port=PUSH_PORT):
+        self.count = count
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.port = port
+        self.push_port = push_port
+        self.rng = random.Random(seed)
+        self.loop = None
+        self.bulbs = []
+        self.broadcast_addr = BROADCAST_ADDR
+        self._transports = []
+        # Datagrams clients sent, counting a broadcast once.
+        self.packets_received = 0
+        # Datagrams that reached a bulb: a broadcast counts once per bulb.
+        self.packets_delivered = 0
+        self.packets_sent = 0
+        self.packets_dropped = 0
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        for index in range(self.count):
+            ip = bulb_ip(index)
+            transport, bulb = await self.loop.create_datagram_endpoint(
+                lambda index=index, ip=ip: VirtualBulb(self, bulb_mac(index), ip),
+                local_addr=(ip, self.port),
+            )
+            self._transports.append(transport)
+            self.bulbs.append(bulb)
+        transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: BroadcastListener(self),
+            local_addr=(self.broadcast_addr, self.port),
+        )
+        self._transports.append(transport)
+        return self
+
+    def close(self):
+        for transport in self._transports:
+            transport.close()
+        self._transports = []
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def macs_to_ips(self):
+        return {bulb.mac: bulb.ip for bulb in self.bulbs}
+
+    def counters(self):
+        return {
+            "packets_received": self.packets_received,
+            "packets_delivered": self.packets_delivered,
+            "packets_sent": self.packets_sent,
+            "packets_dropped": self.packets_dropped,
+        }
+
+    def reset_counters(self):
+        self.packets_received = 0
+        self.packets_delivered = 0
+        self.packets_sent = 0
+        self.packets_dropped = 0
+
+
+class EmulatorThread(threading.Thread):
+    """
+    Run an Emulator on its own event loop so blocking scripts can talk to it.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(daemon=True)
+        self.emulator = Emulator(**kwargs)
+        self.ready = threading.Event()
+        self.error = None
+        self.loop = None
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self.emulator.start())
+        except Exception as e:
+            self.error = e
+            self.ready.set()
+            return
+        self.ready.set()
+        self.loop.run_forever()
+        self.emulator.close()
+        # Let the transports finish closing so their addresses can be reused.
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+
+    def __enter__(self):
+        self.start()
+        self.ready.wait()
+        if self.error:
+            raise self.error
+        return self.emulator
+
+    def __exit__(self, *exc):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.join()
+
+
+def _process_main(conn, kwargs):
+    loop = asyncio.new_event_loop()
+    emulator = Emulator(**kwargs)
+    try:
+        loop.run_until_complete(emulator.start())
+    except Exception as e:
+        conn.send(("error", f"{type(e).__name__}: {e}"))
+        loop.close()
+        return
+    conn.send(("ready", None))
+
+    def on_command():
+        try:
+            op = conn.recv()
+        except EOFError:
+            op = "close"
+        if op == "close":
+            loop.stop()
+            return
+        if op == "reset":
+            emulator.reset_counters()
+        conn.send(("ok", emulator.counters()))
+
+    loop.add_reader(conn.fileno(), on_command)
+    loop.run_forever()
+    loop.remove_reader(conn.fileno())
+    emulator.close()
+    loop.run_until_complete(asyncio.sleep(0))
+    loop.close()
+
+
+class EmulatorProcess:
+    """
+    Run an Emulator in a child process, so it doesn't share the GIL (or an
+    event loop) with the code being measured. The context manager yields
+    this object, which answers the same questions as an Emulator: count,
+    port, broadcast_addr, macs_to_ips(), counters(), reset_counters() and
+    the packet counters, fetched from the child on each read.
+    """
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.count = kwargs.get("count", len(DEVICES))
+        self.port = kwargs.get("port", WIZ_PORT)
+        self.broadcast_addr = BROADCAST_ADDR
+        self.process = None
+        self.conn = None
+
+    def _call(self, op):
+        self.conn.send(op)
+        return self.conn.recv()[1]
+
+    @property
+    def packets_received(self):
+        return self._call("counters")["packets_received"]
+
+    @property
+    def packets_delivered(self):
+        return self._call("counters")["packets_delivered"]
+
+    @property
+    def packets_sent(self):
+        return self._call("counters")["packets_sent"]
+
+    @property
+    def packets_dropped(self):
+        return self._call("counters")["packets_dropped"]
+
+    def counters(self):
+        return self._call("counters")
+
+    def macs_to_ips(self):
+        return {bulb_mac(index): bulb_ip(index) for index in range(self.count)}
+
+    def reset_counters(self):
+        self._call("reset")
+
+    def __enter__(self):
+        # spawn, not fork: the caller may already be running threads.
+        context = multiprocessing.get_context("spawn")
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=_process_main, args=(child, self.kwargs), daemon=True)
+        self.process.start()
+        child.close()
+        status, error = self.conn.recv()
+        if status == "error":
+            self.__exit__()
+            raise OSError(error)
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            self.conn.send("close")
+        except OSError:
+            pass
+        self.conn.close()
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description="Emulate WiZ bulbs on loopback.")
+    parser.add_argument("--count", type=int, default=len(DEVICES))
+    parser.add_argument("--latency", type=float, default=0.01, help="seconds")
+    parser.add_argument("--jitter", type=float, default=0.005, help="seconds")
+    parser.add_argument("--loss", type=float, default=0.0, help="drop probability per packet")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    async def serve():
+        async with Emulator(args.count, args.latency, args.jitter, args.loss, seed=args.seed) as emulator:
+            print(f"{args.count} bulbs on {bulb_ip(0)}..{bulb_ip(args.count - 1)}, "
+                  f"broadcast {emulator.broadcast_addr}:{emulator.port}")
+            await asyncio.Event().wait()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    run()
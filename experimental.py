@@ -1,77 +1,240 @@
-import re
+import sys
 import time
-import socket
-import json
-import subprocess
-
-# Accent MACs (alphabetically ordered)
-ACCENT_MACS = {
-    "DRESSER": "d8a01165a452",
-    "FACES":   "cc40853d9142",
-    "HORSE":   "cc4085840e8a",
-    "PIG":     "cc40853e5276",
-    "SKULLS":  "444f8e1f2fc8",
-}
-
-# Overhead MACs (alphabetically ordered)
-OVERHEAD_MACS = {
-    "ALIEN":    "cc40855a796e",
-    "BATHROOM": "cc4085558f40",
-    "ENTRANCE": "d8a011671f1a",
-    "K_0":      "cc4085558842",
-    "K_1":      "cc40855a7c1e",
-    "S_0":      "cc4085558c88",
-    "S_1":      "d8a01161d568",
-    "TV_0":     "cc40855a7e7c",
-    "TV_1":     "d8a01162e8da",
-}
+import asyncio
+
+import fade
+import config
+import fanout
+import metrics
+import networks
+import registry
+import state
+import tracing
+
+# Devices, groups, defaults, overrides and the skip list live in devices.json
+# (or $WIZ_CONFIG); the tables below are filled from it and kept up to date
+# in place by reload_config().
+with tracing.span("load_config"):
+    CONFIG = config.load()
+
+# MACs per group, in config order
+GROUP_MACS = {}
+ACCENT_MACS = {}
+OVERHEAD_MACS = {}
 
 # Combine all MACs for overall lookups
-ALL_MACS = {**ACCENT_MACS, **OVERHEAD_MACS}
+ALL_MACS = {}
 
 # Default command parameters
-DIVISOR = 8
-DEFAULT_PARAMS = {
-    "r": 255/DIVISOR,
-    "g": 60/DIVISOR,
-    "b": 1,
-    "dimming": 10,
-    "sceneID": None,
-}
-
-DIVISOR = 6
-SKIP_LIST = list(OVERHEAD_MACS)
+DEFAULT_PARAMS = {}
+
+SKIP_LIST = []
 BR = 20
+FADE_SECONDS = 5
+# Skip devices whose last-known state already matches their params.
+SKIP_UNCHANGED = True
+# Read every bulb back after it acknowledges and resend to the ones that
+# don't show their params, for at most VERIFY_DEADLINE seconds.
+VERIFY = False
+VERIFY_DEADLINE = 5.0
 
 # Overrides:
-#  1. GROUP_ACCENT and GROUP_OVERHEAD can apply to all accent/overhead devices if enabled.
+#  1. GROUP_<NAME> (e.g. GROUP_ACCENT, GROUP_OVERHEAD) can apply to all devices of a group if enabled.
 #  2. Then each device can have its own override.
-OVERRIDES = {
-    "GROUP_ACCENT": {
-        "enabled": False,
-        "params": {"r": 255, "g": 30, "b": 0, "dimming": 40, "sceneID": None},
-    },
-    "GROUP_OVERHEAD": {
-        "enabled": False,
-        "params": {"r": 255, "g": 80, "b": 5, "dimming": 60, "sceneID": None},
-    },
-
-    "DRESSER": {"enabled": False, "params": {"r": 0, "g": 0, "b": 0, "dimming": 0, "sceneID": None}},
-    "FACES": {"enabled": True, "params": {"r": 255, "g": 25, "b": 0, "dimming": 10, "sceneID": None}},
-    "HORSE": {"enabled": True, "params": {"r": 255, "g": 25, "b": 0, "dimming": 10, "sceneID": None}},
-    "PIG": {"enabled": True, "params": {"r": 255, "g": 25, "b": 0, "dimming": 10, "sceneID": None}},
-    "SKULLS": {"enabled": True, "params": {"r": 255, "g": 25, "b": 0, "dimming": 20, "sceneID": None}},
-
-    "ALIEN": {"enabled": False, "params": {"r": 0, "g": 0, "b": 0, "dimming": 0, "sceneID": None}},
-    "BATHROOM": {"enabled": False, "params": {"r": 0, "g": 0, "b": 0, "dimming": 0, "sceneID": None}},
-    "ENTRANCE": {"enabled": False, "params": {"r": 0, "g": 0, "b": 0, "dimming": 0, "sceneID": None}},
-    "K_0": {"enabled": False, "params": {"r": 0, "g": 0, "b": 0, "dimming": 0, "sceneID": None}},
-    "K_1": {"enabled": False, "params": {"r": 0, "g": 0, "b": 0, "dimming": 0, "sceneID": None}},
-    "S_0": {"enabled": False, "params": {"r": 0, "g": 0, "b": 0, "dimming": 0, "sceneID": None}},
-    "S_1": {"enabled": False, "params": {"r": 0, "g": 0, "b": 0, "dimming": 0, "sceneID": None}},
-    "TV_1": {"enabled": False, "params": {"r": 0, "g": 0, "b": 0, "dimming": 0, "sceneID": None}},
-    "TV_0": {"enabled": False, "params": {"r": 255/DIVISOR, "g": 60/DIVISOR, "b": 2, "dimming": 10, "sceneID": None}}
-}
+OVERRIDES = {}
+
+# Broadcast group commands:
+#  When every bulb that would hear a broadcast gets the same params, a single
+#  broadcast setPilot replaces the per-device packets; only devices that do
+#  not acknowledge are retried by unicast. Give a group a subnet-directed
+#  address (e.g. "192.168.20.255") only if that subnet holds nothing but the
+#  group's bulbs, since every bulb on it applies the command.
+GROUP_BROADCAST = {}
+
+# Reverse lookups so per-device work is a dict access instead of a scan.
+ALIAS_BY_MAC = {}
+GROUP_BY_MAC = {}
+
+
+def load_tables(cfg):
+    """
+    Fill the module tables from a Config, updating them in place so modules
+    that imported them see the change.
+    """
+    GROUP_MACS.clear()
+    GROUP_MACS.update({group: cfg.group_macs(group) for group in cfg.groups})
+    ACCENT_MACS.clear()
+    ACCENT_MACS.update(GROUP_MACS.get("accent", {}))
+    OVERHEAD_MACS.clear()
+    OVERHEAD_MACS.update(GROUP_MACS.get("overhead", {}))
+    ALL_MACS.clear()
+    for macs in GROUP_MACS.values():
+        ALL_MACS.update(macs)
+    SKIP_LIST[:] = cfg.skip
+    GROUP_BROADCAST.clear()
+    GROUP_BROADCAST.update({
+        config.group_override_key(group): spec["broadcast"] for group, spec in cfg.groups.items()
+    })
+    ALIAS_BY_MAC.clear()
+    ALIAS_BY_MAC.update({mac: alias for alias, mac in ALL_MACS.items()})
+    GROUP_BY_MAC.clear()
+    for group, macs in GROUP_MACS.items():
+        for alias, mac in macs.items():
+            GROUP_BY_MAC[mac] = config.group_override_key(group)
+            # Sends are keyed by alias here; label them with their group for metrics.
+            metrics.register_device(alias, alias, group)
+            metrics.register_device(mac, alias, group)
+    DEFAULT_PARAMS.clear()
+    DEFAULT_PARAMS.update(cfg.defaults)
+    OVERRIDES.clear()
+    OVERRIDES.update(cfg.overrides())
+
+
+class _WatchedDict(dict):
+    """
+    dict that drops the compiled parameter table whenever it (or any dict
+    nested inside it) is modified, so OVERRIDES["FACES"]["params"]["dimming"] -= 1
+    is picked up by the next apply.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for key, value in self.items():
+            if isinstance(value, dict) and not isinstance(value, _WatchedDict):
+                super().__setitem__(key, _WatchedDict(value))
+
+    def __setitem__(self, key, value):
+        if isinstance(value, dict) and not isinstance(value, _WatchedDict):
+            value = _WatchedDict(value)
+        super().__setitem__(key, value)
+        invalidate_params()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        invalidate_params()
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, *args):
+        value = super().pop(*args)
+        invalidate_params()
+        return value
+
+    def popitem(self):
+        item = super().popitem()
+        invalidate_params()
+        return item
+
+    def clear(self):
+        super().clear()
+        invalidate_params()
+
+
+_compiled_params = None
+
+
+def invalidate_params():
+    """
+    Forget the compiled parameter table; the next lookup rebuilds it.
+    """
+    global _compiled_params
+    _compiled_params = None
+
+
+def compile_params():
+    """
+    Resolve DEFAULT_PARAMS -> group override -> device override once for every
+    known MAC. Each entry holds the alias, the final params, which overrides
+    applied, and the pre-encoded setPilot body (fanout.encode_body) that each
+    send stamps with a fresh request id.
+    Returns the MAC-indexed table.
+    """
+    global _compiled_params
+    if _compiled_params is not None:
+        return _compiled_params
+
+    with tracing.span("compile_params", devices=len(ALIAS_BY_MAC)):
+        _compiled_params = _compile_params()
+    return _compiled_params
+
+
+def _compile_params():
+    table = {}
+    for mac, alias in ALIAS_BY_MAC.items():
+        group_key = GROUP_BY_MAC[mac]
+        params = config.resolve_params(DEFAULT_PARAMS, OVERRIDES[group_key], OVERRIDES[alias])
+        group_override = group_key if OVERRIDES[group_key]["enabled"] else None
+        device_override = alias if OVERRIDES[alias]["enabled"] else None
+
+        table[mac] = {
+            "alias": alias,
+            "params": params,
+            "group_override": group_override,
+            "device_override": device_override,
+            "body": fanout.encode_body("setPilot", params),
+        }
+    return table
+
+
+DEFAULT_PARAMS = _WatchedDict(DEFAULT_PARAMS)
+OVERRIDES = _WatchedDict(OVERRIDES)
+load_tables(CONFIG)
+
+
+def reload_config(cfg=None):
+    """
+    Load a new config (default: re-read the file) into the module tables.
+    Returns the (alias, mac) pairs whose output changed: their effective
+    params differ from what was in force, or they left the skip list.
+    """
+    global CONFIG
+    cfg = cfg or config.load(CONFIG.path)
+    old_params = {mac: entry["params"] for mac, entry in compile_params().items()}
+    old_skip = {ALL_MACS[alias] for alias in SKIP_LIST if alias in ALL_MACS}
+    CONFIG = cfg
+    load_tables(cfg)
+    changed = []
+    for mac, entry in compile_params().items():
+        if entry["alias"] in SKIP_LIST:
+            continue
+        if entry["params"] != old_params.get(mac) or mac in old_skip:
+            changed.append((entry["alias"], mac))
+    return changed
+
+
+async def apply_changed(changed, engine=None):
+    """
+    Send only the devices returned by reload_config().
+    Returns the apply_devices results for those that are reachable.
+    """
+    ips = registry.get_registry().resolve([mac for _, mac in changed])
+    data_list = [(alias, mac, ips[mac]) for alias, mac in changed if mac in ips]
+    if not data_list:
+        return {}
+    return await apply_devices(data_list, skip_unchanged=True, engine=engine)
+
+
+async def watch_config(engine=None):
+    """
+    Watch the config file and push each change to only the devices it affects.
+    """
+    async def on_change(cfg):
+        changed = reload_config(cfg)
+        print(f"Config reloaded: {len(changed)} device(s) changed")
+        results = await apply_changed(changed, engine)
+        for alias, (params, success, latency, attempts) in sorted(results.items()):
+            success_str = "SAME" if success is None else "TRUE" if success else "FALSE"
+            print(f"{alias:<10}  SUCCESS={success_str:<5}  ATTEMPTS={attempts}  LATENCY={latency * 1000:.0f}ms")
+        state.get_state_cache().save()
+
+    await config.Watcher(CONFIG.path).watch(on_change)
 
 
 def sort_devices_by_alias(dev_list):
@@ -81,18 +244,11 @@ def sort_devices_by_alias(dev_list):
     dev_list.sort(key=lambda x: x[0])
 
 
-def parse_devices(data):
+def get_alias(mac):
     """
-    Parse the ARP table output and extract IP and MAC addresses.
-    Returns a list of tuples: (IP, MAC).
+    Return the alias for a MAC, or "UNKNOWN".
     """
-    pattern = r"\S+\s+\((\d+\.\d+\.\d+\.\d+)\)\s+at\s+([0-9A-Fa-f:]+)"
-    devices = []
-    for match in re.findall(pattern, data):
-        ip = match[0]
-        mac = ''.join(segment.zfill(2) for segment in match[1].split(":")).lower()
-        devices.append((ip, mac))
-    return devices
+    return ALIAS_BY_MAC.get(mac, "UNKNOWN")
 
 
 def get_override_name(mac):
@@ -100,10 +256,8 @@ def get_override_name(mac):
     Check if there's a device-specific override for this mac.
     Return the override key if found and enabled, otherwise None.
     """
-    for device_key, device_mac in ALL_MACS.items():
-        if mac == device_mac and OVERRIDES[device_key]["enabled"]:
-            return device_key
-    return None
+    entry = compile_params().get(mac)
+    return entry["device_override"] if entry else None
 
 
 def get_group_override_name(mac):
@@ -113,13 +267,8 @@ def get_group_override_name(mac):
       - GROUP_OVERHEAD if the device is in OVERHEAD_MACS and GROUP_OVERHEAD is enabled
     Return the group key if found, else None.
     """
-    # Check accent group
-    if mac in ACCENT_MACS.values() and OVERRIDES["GROUP_ACCENT"]["enabled"]:
-        return "GROUP_ACCENT"
-    # Check overhead group
-    if mac in OVERHEAD_MACS.values() and OVERRIDES["GROUP_OVERHEAD"]["enabled"]:
-        return "GROUP_OVERHEAD"
-    return None
+    entry = compile_params().get(mac)
+    return entry["group_override"] if entry else None
 
 
 def get_command_params(mac):
@@ -130,51 +279,287 @@ def get_command_params(mac):
     3. If there's a device-specific override that's enabled, apply that last.
     Returns a dict of r, g, b, dimming, etc.
     """
-    params = DEFAULT_PARAMS.copy()
+    entry = compile_params().get(mac)
+    return dict(entry["params"]) if entry else dict(DEFAULT_PARAMS)
 
-    # 1) Check group override
-    group_override_key = get_group_override_name(mac)
-    if group_override_key:
-        params.update(OVERRIDES[group_override_key]["params"])
 
-    # 2) Check device-specific override
-    device_override_key = get_override_name(mac)
-    if device_override_key:
-        params.update(OVERRIDES[device_override_key]["params"])
+def can_broadcast(macs, net=None):
+    """
+    True if every bulb that could hear a broadcast on `net` (a
+    networks.resolve entry; None for the limited broadcast, which reaches
+    every network) is in `macs`. Configured bulbs, including skipped ones,
+    and unconfigured bulbs that have answered us all count; one whose
+    address is unknown could be anywhere.
+    """
+    reg = registry.get_registry()
+    bulbs = set(ALL_MACS.values()) | set(state.get_state_cache().entries)
+    for mac in bulbs - set(macs):
+        ip = reg.get(mac)
+        if ip is None or net is None or networks.network_for(ip, [net]) is not None:
+            return False
+    return True
+
 
-    return params
+def plan_broadcasts(targets, whole_house=False, bystanders=()):
+    """
+    Split (alias, mac, ip, params) targets into broadcast groups and unicasts.
+    A broadcast is only planned when no bulb outside the targets can hear
+    it, apart from the MACs in `bystanders`, which already show the params.
+    Returns (broadcasts, unicasts) where broadcasts is a list of
+    (broadcast_addr, {alias: ip}, params).
+    """
+    broadcasts = []
+    unicasts = list(targets)
+    bystanders = set(bystanders)
+
+    # A whole-house apply where everybody shares params is one broadcast per
+    # network, all sent together; bulbs outside every known network, or on a
+    # network with a bulb that must not change, get unicasts.
+    if whole_house and len(unicasts) > 1:
+        first = unicasts[0][3]
+        if all(params == first for _, _, _, params in unicasts):
+            macs = bystanders | {mac for _, mac, _, _ in unicasts}
+            nets = networks.resolve(CONFIG.networks)
+            if not nets:
+                if not can_broadcast(macs):
+                    return [], unicasts
+                members = {alias: ip for alias, _, ip, _ in unicasts}
+                return [(fanout.BROADCAST_ADDR, members, first)], []
+            by_network = {}
+            rest = []
+            for target in unicasts:
+                net = networks.network_for(target[2], nets)
+                if net is None or not can_broadcast(macs, net):
+                    rest.append(target)
+                else:
+                    by_network.setdefault(net["broadcast"], {})[target[0]] = target[2]
+            return [(addr, members, first) for addr, members in by_network.items()], rest
+
+    # Groups living on their own subnet can be broadcast to individually.
+    nets = networks.resolve(CONFIG.networks) if any(GROUP_BROADCAST.values()) else []
+    for group_key, addr in GROUP_BROADCAST.items():
+        if not addr:
+            continue
+        in_group = [t for t in unicasts if GROUP_BY_MAC[t[1]] == group_key]
+        if len(in_group) < 2 or any(t[3] != in_group[0][3] for t in in_group):
+            continue
+        # An address outside every known network can't be bounded, so it
+        # counts as reaching everybody.
+        net = next((net for net in nets if net["broadcast"] == addr), None)
+        if not can_broadcast(bystanders | {mac for _, mac, _, _ in in_group}, net):
+            continue
+        broadcasts.append((addr, {alias: ip for alias, _, ip, _ in in_group}, in_group[0][3]))
+        unicasts = [t for t in unicasts if GROUP_BY_MAC[t[1]] != group_key]
+
+    return broadcasts, unicasts
+
+
+async def _send_targets(targets, whole_house, engine=None, bystanders=(), diffs=None):
+    # `diffs` maps alias -> the params a device still lacks; unicasts send
+    # just those, while a broadcast carries the full shared params.
+    broadcasts, unicasts = plan_broadcasts(targets, whole_house, bystanders)
+    if engine is None:
+        async with fanout.FanoutEngine(broadcast=bool(broadcasts)) as engine:
+            return await _send_targets(targets, whole_house, engine, bystanders, diffs)
+
+    results = {}
+
+    async def collect(replies):
+        async for alias, reply, latency in replies:
+            results[alias] = (reply, latency, engine.stats.get(alias, {}).get("attempts", 1))
+
+    streams = [engine.send_group(members, params, broadcast_addr=addr)
+               for addr, members, params in broadcasts]
+    # Unicasts go out as the pre-encoded bodies from the compiled table,
+    # unless only part of the params needs sending.
+    table = compile_params()
+    diffs = diffs or {}
+    streams.append(engine.send_all_bytes([
+        (alias, ip, *engine.stamp(
+            fanout.encode_body("setPilot", diffs[alias]) if alias in diffs else table[mac]["body"]
+        ))
+        for alias, mac, ip, _ in unicasts
+    ]))
+    await asyncio.gather(*(collect(stream) for stream in streams))
+    return results
+
+
+def send_to_devices(data_list, whole_house=False, skip_unchanged=False):
+    """
+    Blocking entry point for apply_devices.
+    """
+    return asyncio.run(apply_devices(data_list, whole_house, skip_unchanged))
 
 
-def build_command_json(params):
+async def apply_devices(data_list, whole_house=False, skip_unchanged=False, engine=None):
     """
-    Build a JSON command for Wiz lights from the given params.
-    Returns the JSON string.
+    Send each device its command concurrently over one socket.
+    `data_list` holds (alias, mac, ip) tuples; devices in SKIP_LIST are left out.
+    `whole_house=True` allows one broadcast per network when the devices all
+    share the same params and no other bulb can hear it (see can_broadcast).
+    With `skip_unchanged`, devices whose last-known state already shows their
+    params are not sent anything, and devices sent a unicast get only the
+    params they lack (state.pilot_diff: a bulb that is off or in a scene,
+    or one whose color changes, still gets the whole color).
+    `engine` lets a long-running caller reuse its open FanoutEngine, which
+    must allow broadcast if `whole_house` is set.
+    Returns a dict of alias -> (params, success, latency, attempts); success
+    is None for devices that were skipped as unchanged.
     """
-    return json.dumps({
-        "id": 1,
-        "method": "setPilot",
-        "params": {k: v for k, v in params.items() if v is not None},
-    })
+    table = compile_params()
+    targets = []
+    for alias, mac, ip in data_list:
+        if alias in SKIP_LIST:
+            continue
+        targets.append((alias, mac, ip, table[mac]["params"]))
+    # Skipped devices would still hear a broadcast, and so would unchanged ones,
+    # so the broadcast decision is made before unchanged devices are dropped;
+    # those may hear it since they already show the same params.
+    whole_house = (
+        whole_house and len(targets) == len(data_list)
+        and all(params == targets[0][3] for _, _, _, params in targets)
+    )
+    bystanders = set()
+
+    params_by_alias = {alias: params for alias, _, _, params in targets}
+    cache = state.get_state_cache()
+    results = {}
+    diffs = {}
+    if skip_unchanged:
+        changed = []
+        for target in targets:
+            alias, mac, _, params = target
+            diff = cache.diff(mac, params)
+            if not diff:
+                results[alias] = (params, None, 0.0, 0)
+                bystanders.add(mac)
+                continue
+            if len(diff) < sum(1 for value in params.values() if value is not None):
+                diffs[alias] = diff
+            changed.append(target)
+        targets = changed
+    if not targets:
+        return results
+
+    with tracing.span("send", devices=len(targets), whole_house=whole_house):
+        replies = await _send_targets(targets, whole_house, engine, bystanders, diffs)
+
+    # A timeout may mean the bulb moved to a new IP; re-resolve only those
+    # entries and resend to the ones whose address actually changed.
+    moved = []
+    reg = registry.get_registry()
+    for alias, mac, ip, params in targets:
+        if fanout.is_success(replies.get(alias, (None,))[0]):
+            continue
+        new_ip = reg.refresh_entry(mac)
+        if new_ip and new_ip != ip:
+            moved.append((alias, mac, new_ip, params))
+    if moved:
+        with tracing.span("resend_moved", devices=len(moved)):
+            replies.update(await _send_targets(moved, False, engine, diffs=diffs))
+
+    for alias, mac, _, params in targets:
+        reply, latency, attempts = replies.get(alias, (None, 0.0, 0))
+        success = fanout.is_success(reply)
+        if success:
+            cache.record_sent(mac, params)
+        else:
+            cache.forget(mac)
+        results[alias] = (params_by_alias[alias], success, latency, attempts)
+    return results
 
 
-def send_command(ip, command):
+def apply_sharded(data_list, pool):
     """
-    Send a command to the specified device via UDP and parse success from the response.
-    Returns True if the device responded with success; otherwise False.
+    Like send_to_devices, but the devices are split across the worker
+    processes of a started shard.ShardPool, each sending its slice from its
+    own socket. Returns the same alias -> (params, success, latency, attempts).
     """
-    try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.settimeout(1)
-        sock.sendto(command.encode(), (ip, 38899))
-        response, _ = sock.recvfrom(1024)
-        decoded = response.decode()
-        data = json.loads(decoded)
-        return True if data.get("success") == True else False
-    except Exception:
-        return False
-    finally:
-        time.sleep(1)
-        sock.close()
+    table = compile_params()
+    targets = [(alias, mac, ip) for alias, mac, ip in data_list if alias not in SKIP_LIST]
+    pool.load([(alias, ip, "setPilot", table[mac]["params"]) for alias, mac, ip in targets])
+    replies = pool.apply()
+    cache = state.get_state_cache()
+    results = {}
+    for alias, mac, _ in targets:
+        params = table[mac]["params"]
+        reply, latency, attempts = replies.get(alias, (None, 0.0, 0))
+        success = fanout.is_success(reply)
+        if success:
+            cache.record_sent(mac, params)
+        else:
+            cache.forget(mac)
+        results[alias] = (params, success, latency, attempts)
+    return results
+
+
+async def send_verified(targets, deadline=VERIFY_DEADLINE, engine=None):
+    """
+    Send each (key, mac, ip, method, params) target its command and read it
+    back with getPilot as soon as that bulb acknowledges, while the rest of
+    the sends are still in flight. A bulb whose read-back doesn't show
+    `params` gets the command again, until it does or `deadline` seconds
+    have passed. Read-backs seed the state cache.
+    Returns {key: (verified, latency, attempts)}, latency being the time to
+    the matching read-back.
+    """
+    if engine is None:
+        async with fanout.FanoutEngine() as engine:
+            return await send_verified(targets, deadline, engine)
+
+    cache = state.get_state_cache()
+    start = time.monotonic()
+    end = start + deadline
+
+    async def one(key, mac, ip, method, params):
+        attempts = 0
+        while True:
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return key, (False, time.monotonic() - start, attempts)
+            attempts += 1
+            reply, _ = await engine.request(ip, method, params, min(engine.timeout, remaining), key)
+            if reply is None:
+                continue
+            if not fanout.is_success(reply):
+                # An error reply won't change on a resend.
+                return key, (False, time.monotonic() - start, attempts)
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                continue
+            readback, _ = await engine.request(ip, "getPilot", {}, min(engine.timeout, remaining), key)
+            pilot = (readback or {}).get("result")
+            if not isinstance(pilot, dict):
+                continue
+            cache.seed(mac, pilot)
+            if not state.pilot_diff(pilot, params, method):
+                return key, (True, time.monotonic() - start, attempts)
+
+    return dict(await asyncio.gather(*(one(*target) for target in targets)))
+
+
+def verify_devices(data_list, deadline=VERIFY_DEADLINE):
+    """
+    Like send_to_devices, but every device is read back and resent its
+    params until it shows them or `deadline` passes; success means the
+    read-back matched, not just that the bulb acknowledged.
+    Returns the same alias -> (params, success, latency, attempts).
+    """
+    table = compile_params()
+    targets = [
+        (alias, mac, ip, "setPilot", table[mac]["params"])
+        for alias, mac, ip in data_list if alias not in SKIP_LIST
+    ]
+    with tracing.span("verify", devices=len(targets)):
+        replies = asyncio.run(send_verified(targets, deadline))
+    cache = state.get_state_cache()
+    results = {}
+    for alias, mac, _, _, params in targets:
+        success, latency, attempts = replies[alias]
+        if not success:
+            cache.forget(mac)
+        results[alias] = (params, success, latency, attempts)
+    return results
 
 
 def print_section(header, data_list, max_alias_length):
@@ -190,21 +575,22 @@ def print_section(header, data_list, max_alias_length):
     print()  # Blank line after each section
 
 
-def print_and_send_section(header, data_list, max_alias_length):
+def print_and_send_section(header, data_list, max_alias_length, results=None):
     """
-    Print a header and, for each device, build and send commands,
-    then print a single-line output with success/override info.
+    Print a header and, for each device, a single-line output with
+    success/override info. Commands are sent for the whole section at once
+    unless `results` from `send_to_devices` are passed in.
     """
     if not data_list:
         return
+    if results is None:
+        results = send_to_devices(data_list)
     print(header)
     for alias, mac, ip in data_list:
-        if alias in SKIP_LIST:
+        if alias not in results:
             continue
-        params = get_command_params(mac)
-        command_json = build_command_json(params)
-        success = send_command(ip, command_json)
-        success_str = "TRUE" if success else "FALSE"
+        params, success, latency, attempts = results[alias]
+        success_str = "SAME" if success is None else "TRUE" if success else "FALSE"
         
         # Check group override
         group_override_key = get_group_override_name(mac)
@@ -227,7 +613,9 @@ def print_and_send_section(header, data_list, max_alias_length):
             f"RED={int(params.get('r', 0)):<3}  "
             f"GREEN={int(params.get('g', 0)):<3}  "
             f"BLUE={int(params.get('b', 0)):<3}  "
-            f"DIMMING={int(params.get('dimming', 0))}"
+            f"DIMMING={int(params.get('dimming', 0)):<3}  "
+            f"ATTEMPTS={attempts}  "
+            f"LATENCY={latency * 1000:.0f}ms"
             f"{combined_override_str}"
         )
     print()
@@ -235,22 +623,26 @@ def print_and_send_section(header, data_list, max_alias_length):
 
 def discover_devices():
     """
-    Discover devices on the network using ARP, then print them
-    in aligned sections by device type (Accent, Overhead, Unknown).
+    Discover devices from the shared MAC -> IP registry (scanning the neighbor
+    table only when a known MAC is missing), then print them in aligned
+    sections by device type (Accent, Overhead, Unknown).
+    Returns a list of tuples: (IP, MAC).
     """
     print("Discovering devices on the network...")
     try:
-        result = subprocess.run(["arp", "-a"], capture_output=True, text=True)
-        devices = parse_devices(result.stdout)
+        with tracing.span("resolve_registry"):
+            reg = registry.get_registry()
+            reg.resolve(ALL_MACS.values())
+            devices = [(ip, mac) for mac, ip in reg.items()]
         
         if not devices:
             print("No devices found.")
-            return result.stdout
+            return devices
         
         # Build a list of (alias, MAC, IP)
         discovered_info = []
         for (ip, mac) in devices:
-            alias = next((name for name, stored_mac in ALL_MACS.items() if stored_mac == mac), "UNKNOWN")
+            alias = get_alias(mac)
             discovered_info.append((alias, mac, ip))
         
         # Separate into three groups: accent, overhead, unknown
@@ -279,60 +671,116 @@ def discover_devices():
         print_section("Overhead Devices:", overhead_list, max_alias_length)
         print_section("Unknown Devices:", unknown_list, max_alias_length)
 
-        return result.stdout
+        return devices
     except Exception as e:
         print(f"Error discovering devices: {e}")
-        return ""
-
-def main():
-    wrap()
-    while(OVERRIDES["FACES"]["params"]["dimming"] > 10):
-        OVERRIDES["FACES"]["params"]["dimming"] -= 1
-        wrap()
-
-def wrap():
-    # 1. Discover devices (prints them).
-    raw_data = discover_devices()
-    # 2. Parse discovered data into a structured list.
-    devices = parse_devices(raw_data)
+        return []
+
+def fade_device(alias, end_params, duration=FADE_SECONDS, easing="ease_in_out"):
+    """
+    Fade one device from its current effective params to `end_params` in
+    wall-clock time. Once the bulb has acknowledged the end state, record it
+    in its override, enabling the override if it was off so the next apply
+    keeps the faded state; a failed or interrupted fade leaves it untouched.
+    """
+    mac = ALL_MACS[alias]
+    ip = registry.get_registry().resolve([mac]).get(mac)
+    if not ip:
+        print(f"{alias} not found on the network.")
+        return None
+    start = get_command_params(mac)
+    end = {**start, **end_params}
+    try:
+        stats = fade.fade({alias: ip}, start, end, duration, easing)
+    except BaseException:
+        state.get_state_cache().forget(mac)
+        raise
+    success = fanout.is_success(stats["replies"][alias][0])
+    if success:
+        state.get_state_cache().record_sent(mac, end)
+        override = OVERRIDES[alias]
+        if override["enabled"]:
+            override["params"].update(end_params)
+        else:
+            # A disabled override's params may be stale; the full end state
+            # reproduces exactly what the bulb shows.
+            override["params"] = dict(end)
+            override["enabled"] = True
+    else:
+        state.get_state_cache().forget(mac)
+    success_str = "TRUE" if success else "FALSE"
+    print(
+        f"FADE {alias}  SUCCESS={success_str}  FRAMES={stats['frames']}  "
+        f"PACKETS={stats['packets']}  DROPPED={stats['dropped']}"
+    )
+    return stats
+
+
+def main(verify=VERIFY):
+    wrap(verify)
+    fade_device("FACES", {"dimming": 10})
+
+def wrap(verify=VERIFY):
+    # Set WIZ_TRACE=trace.json to time each step below (see tracing.py).
+    # 1. Discover devices (prints them) as (IP, MAC) pairs.
+    with tracing.span("discover"):
+        devices = discover_devices()
     if not devices:
         return
 
-    # 3. Separate known from unknown so we do NOT send commands to unknown.
-    known_devices = []
-    for (ip, mac) in devices:
-        alias = next((name for name, stored_mac in ALL_MACS.items() if stored_mac == mac), "UNKNOWN")
-        if alias != "UNKNOWN":
-            known_devices.append((alias, mac, ip))
-
-    # 4. Separate accent vs overhead
-    accent_list = []
-    overhead_list = []
-    for alias, mac, ip in known_devices:
-        if alias in ACCENT_MACS:
-            accent_list.append((alias, mac, ip))
-        else:
-            overhead_list.append((alias, mac, ip))
-    
-    # 5. Sort each list by alias
-    sort_devices_by_alias(accent_list)
-    sort_devices_by_alias(overhead_list)
+    with tracing.span("resolve_aliases", devices=len(devices)):
+        # 2. Separate known from unknown so we do NOT send commands to unknown.
+        known_devices = []
+        for (ip, mac) in devices:
+            alias = get_alias(mac)
+            if alias != "UNKNOWN":
+                known_devices.append((alias, mac, ip))
 
-    # 6. If there are no known devices at all
+        # 3. Separate accent vs overhead
+        accent_list = []
+        overhead_list = []
+        for alias, mac, ip in known_devices:
+            if alias in ACCENT_MACS:
+                accent_list.append((alias, mac, ip))
+            else:
+                overhead_list.append((alias, mac, ip))
+
+        # 4. Sort each list by alias
+        sort_devices_by_alias(accent_list)
+        sort_devices_by_alias(overhead_list)
+
+    # 5. If there are no known devices at all
     if not (accent_list or overhead_list):
         print("No known devices to send commands to.")
         return
 
     print("Sending commands to known devices...\n")
 
-    # 7. Determine maximum alias length for alignment within these groups
+    # 6. Determine maximum alias length for alignment within these groups
     all_known = accent_list + overhead_list
     max_alias_length = max(len(item[0]) for item in all_known)
 
-    # 8. Print accent devices first, then overhead
-    print_and_send_section("Accent Devices:", accent_list, max_alias_length)
-    print_and_send_section("Overhead Devices:", overhead_list, max_alias_length)
+    # 7. Send to every known device at once, then print accent devices first, then overhead
+    #    With `verify`, each device is read back and resent until it shows its params.
+    with tracing.span("apply", devices=len(all_known)):
+        if verify:
+            results = verify_devices(all_known)
+        else:
+            results = send_to_devices(all_known, whole_house=True, skip_unchanged=SKIP_UNCHANGED)
+    with tracing.span("print"):
+        print_and_send_section("Accent Devices:", accent_list, max_alias_length, results)
+        print_and_send_section("Overhead Devices:", overhead_list, max_alias_length, results)
 
+    # 8. Keep the MAC -> IP and state caches warm for the next run.
+    with tracing.span("save_caches"):
+        registry.get_registry().save()
+        state.get_state_cache().save()
+        metrics.METRICS.write_textfile()
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:] == ["watch"]:
+        asyncio.run(watch_config())
+    elif sys.argv[1:] == ["verify"]:
+        main(verify=True)
+    else:
+        main()
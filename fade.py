@@ -0,0 +1,134 @@
+import math
+import time
+import asyncio
+
+import fanout
+import scheduler
+
+DEFAULT_FPS = 20
+
+# Valid integer range for each setPilot parameter a fade can drive.
+PARAM_RANGES = {
+    "r": (0, 255),
+    "g": (0, 255),
+    "b": (0, 255),
+    "c": (0, 255),
+    "w": (0, 255),
+    "dimming": (10, 100),
+    "temp": (2200, 6500),
+}
+
+EASINGS = {
+    "linear": lambda t: t,
+    "ease_in": lambda t: t * t,
+    "ease_out": lambda t: 1 - (1 - t) * (1 - t),
+    "ease_in_out": lambda t: 0.5 - 0.5 * math.cos(math.pi * t),
+}
+
+
+def quantize(param, value):
+    """
+    Round a value to the integer range the bulb accepts for `param`.
+    """
+    low, high = PARAM_RANGES[param]
+    return max(low, min(high, int(round(value))))
+
+
+def interpolate(start, end, t):
+    """
+    Blend two param dicts at eased progress `t` (0..1).
+    Only numeric params present in both are faded; the rest of `end` is copied.
+    Returns a dict of quantized params.
+    """
+    frame = {}
+    for param, target in end.items():
+        if target is None:
+            continue
+        origin = start.get(param)
+        if param in PARAM_RANGES and isinstance(origin, (int, float)) and isinstance(target, (int, float)):
+            frame[param] = quantize(param, origin + (target - origin) * t)
+        else:
+            frame[param] = target
+    return frame
+
+
+def _per_target(state, targets):
+    # A single params dict applies to every target; otherwise it is keyed by target.
+    if all(key in state for key in targets):
+        return state
+    return {key: state for key in targets}
+
+
+async def run_transition(targets, start, end, duration, easing="linear", fps=DEFAULT_FPS, engine=None):
+    """
+    Fade `targets` ({key: ip}) from `start` to `end` params over `duration` seconds.
+    `start` and `end` are either one params dict for every target or {key: params}.
+    Frames are rendered on the monotonic clock at `fps`; late frames are dropped
+    rather than queued, and a bulb is only sent a frame when its quantized
+    params changed. Intermediate frames go through a per-bulb rate limiter that
+    keeps only the newest pending frame; the final frame is sent with
+    acknowledgement.
+    Returns a dict of stats: frames, dropped, packets, and the final replies.
+    """
+    ease = EASINGS[easing] if isinstance(easing, str) else easing
+    start = _per_target(start, targets)
+    end = _per_target(end, targets)
+    last_sent = {}
+    frames = dropped = packets = 0
+
+    owns_engine = engine is None
+    if owns_engine:
+        engine = await fanout.FanoutEngine().open()
+    # Intermediate frames are fire-and-forget; the next frame supersedes them.
+    frames_out = scheduler.SendScheduler(engine, acked=False)
+    try:
+        interval = 1.0 / fps
+        began = time.monotonic()
+        frame_number = 1
+        while True:
+            due = began + frame_number * interval
+            if due - began >= duration:
+                break
+            delay = due - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                # Skip straight to the frame that is due now.
+                skipped = int(-delay / interval)
+                dropped += skipped
+                frame_number += skipped
+            t = ease(min(1.0, (time.monotonic() - began) / duration))
+            for key, ip in targets.items():
+                params = interpolate(start[key], end[key], t)
+                if params == last_sent.get(key):
+                    continue
+                frames_out.submit(key, ip, "setPilot", params)
+                last_sent[key] = params
+                packets += 1
+            frames += 1
+            frame_number += 1
+
+        # A stale frame must not land after the final one.
+        packets -= frames_out.discard() + frames_out.coalesced
+        final = []
+        for key, ip in targets.items():
+            params = interpolate(start[key], end[key], 1.0)
+            final.append((key, ip, params))
+        replies = {}
+        async for key, reply, latency in engine.send_all(final):
+            replies[key] = (reply, latency)
+        packets += len(final)
+        frames += 1
+    finally:
+        frames_out.close()
+        if owns_engine:
+            engine.close()
+
+    return {"frames": frames, "dropped": dropped, "packets": packets, "replies": replies}
+
+
+def fade(targets, start, end, duration, easing="linear", fps=DEFAULT_FPS):
+    """
+    Blocking entry point for run_transition.
+    """
+    return asyncio.run(run_transition(targets, start, end, duration, easing, fps))
@@ -0,0 +1,454 @@
+import asyncio
+import itertools
+import json
+import time
+import socket
+
+import state
+import metrics
+import tracing
+
+WIZ_PORT = 38899
+DEFAULT_TIMEOUT = 1.0
+BROADCAST_ADDR = "255.255.255.255"
+# Replies to a whole-fleet send arrive in one burst; the default socket buffer
+# only holds a few hundred of them. The kernel caps this at net.core.rmem_max.
+RECV_BUFFER = 4 * 1024 * 1024
+# next_id() wraps back to 1 here.
+ID_LIMIT = 1 << 24
+# Requests send_all keeps in flight at once. Starting thousands together only
+# queues them behind each other, where they time out and are retransmitted
+# before the bulbs have even seen the first copy.
+CONCURRENCY = 64
+
+
+# Retransmission timeout bounds, in the style of TCP's RTO (RFC 6298) but
+# scaled for a LAN where healthy bulbs answer in tens of milliseconds.
+INITIAL_RTO = 0.25
+MIN_RTO = 0.03
+MAX_RTO = 1.0
+RTT_ALPHA = 1 / 8
+RTT_BETA = 1 / 4
+RTT_K = 4
+
+
+class RttEstimator:
+    """
+    Smoothed RTT and RTT variance per bulb, giving each its own
+    retransmission timeout.
+    """
+
+    def __init__(self, initial_rto=INITIAL_RTO, min_rto=MIN_RTO, max_rto=MAX_RTO):
+        self.initial_rto = initial_rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.estimates = {}
+
+    def sample(self, key, rtt):
+        """
+        Fold one unambiguous round-trip measurement into the estimate for `key`.
+        """
+        estimate = self.estimates.get(key)
+        if estimate is None or estimate["srtt"] is None:
+            estimate = {"srtt": rtt, "rttvar": rtt / 2}
+        else:
+            estimate["rttvar"] = (1 - RTT_BETA) * estimate["rttvar"] + RTT_BETA * abs(estimate["srtt"] - rtt)
+            estimate["srtt"] = (1 - RTT_ALPHA) * estimate["srtt"] + RTT_ALPHA * rtt
+        estimate["rto"] = min(self.max_rto, max(self.min_rto, estimate["srtt"] + RTT_K * estimate["rttvar"]))
+        self.estimates[key] = estimate
+
+    def rto(self, key):
+        estimate = self.estimates.get(key)
+        return estimate["rto"] if estimate else self.initial_rto
+
+    def backoff(self, key):
+        """
+        Double the timeout for `key` after a loss, up to max_rto.
+        """
+        estimate = self.estimates.setdefault(key, {"srtt": None, "rttvar": None, "rto": self.initial_rto})
+        estimate["rto"] = min(self.max_rto, estimate["rto"] * 2)
+
+
+# Shared by every engine in the process so estimates survive between applies.
+RTT_ESTIMATES = RttEstimator()
+
+
+class FanoutProtocol(asyncio.DatagramProtocol):
+    """
+    Datagram protocol for the single long-lived socket shared by every bulb.
+    Replies are matched back to their request by the JSON `id`.
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.sock = None
+        self.pending = {}
+        # Broadcast requests expect many replies with the same id.
+        self.collectors = {}
+        # Cleared while the transport holds datagrams the kernel hasn't taken yet.
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            reply = json.loads(data.decode())
+        except ValueError:
+            return
+        if not isinstance(reply, dict):
+            return
+        collector = self.collectors.get(reply.get("id"))
+        if collector is not None:
+            collector(reply, addr)
+            return
+        future = self.pending.pop(reply.get("id"), None)
+        if future is not None and not future.done():
+            future.set_result((reply, addr))
+
+    def poll(self):
+        """
+        Handle every reply already waiting in the socket buffer. The transport
+        reads one datagram per event-loop pass, so behind a big fan-out a reply
+        can sit there past its request's retransmission timeout.
+        """
+        while self.sock is not None:
+            try:
+                data, addr = self.sock.recvfrom(65536)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                self.error_received(e)
+                return
+            self.datagram_received(data, addr)
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+    def error_received(self, exc):
+        # ICMP errors (e.g. port unreachable) surface here; the request
+        # simply times out like a dropped packet would.
+        pass
+
+    def connection_lost(self, exc):
+        self.sock = None
+        self.writable.set()
+        for future in self.pending.values():
+            if not future.done():
+                future.cancel()
+        self.pending.clear()
+        self.collectors.clear()
+
+
+class FanoutEngine:
+    """
+    Send WiZ commands to many bulbs at once over one UDP socket.
+
+    Usage:
+        async with FanoutEngine() as engine:
+            async for key, reply, latency in engine.send_all(targets):
+                ...
+
+    `timeout` is the overall deadline per request. Within it, lost packets
+    are retransmitted on each bulb's own RTO with exponential backoff, and
+    `stats` records attempts and latency per key.
+    """
+
+    def __init__(self, port=WIZ_PORT, timeout=DEFAULT_TIMEOUT, broadcast=False, rtt=None):
+        self.port = port
+        self.timeout = timeout
+        self.broadcast = broadcast
+        self.rtt = rtt or RTT_ESTIMATES
+        self.stats = {}
+        self.transport = None
+        self.protocol = None
+        self._ids = itertools.count(1)
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        # Created here rather than by the loop so the protocol can read it
+        # directly (see FanoutProtocol.poll).
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        if self.broadcast:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER)
+        sock.bind(("0.0.0.0", 0))
+        self.transport, self.protocol = await loop.create_datagram_endpoint(FanoutProtocol, sock=sock)
+        self.protocol.sock = sock
+        # Pause as soon as anything is queued in the transport, so request_bytes
+        # can wait for the socket and start its clocks when a packet really leaves.
+        self.transport.set_write_buffer_limits(high=0)
+        return self
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def next_id(self):
+        """
+        Return a request id that is unique for the lifetime of the engine.
+        """
+        request_id = next(self._ids)
+        if request_id >= ID_LIMIT:
+            self._ids = itertools.count(2)
+            request_id = 1
+        return request_id
+
+    def build(self, method, params, request_id):
+        """
+        Build the wire bytes for a command carrying the given request id.
+        """
+        return b'{"id": %d' % request_id + encode_body(method, params)
+
+    def stamp(self, body):
+        """
+        Give a command pre-encoded by encode_body() a fresh request id.
+        Returns (payload, request_id).
+        """
+        request_id = self.next_id()
+        return b'{"id": %d' % request_id + body, request_id
+
+    async def request_bytes(self, ip, payload, request_id, timeout=None, key=None, method="setPilot"):
+        """
+        Send pre-encoded `payload` (which must carry `request_id`) to `ip`,
+        retransmitting until a reply arrives or `timeout` seconds have passed.
+        `key` (default: the ip) names the bulb for RTT tracking, stats and
+        metrics; `method` is only used to label metrics.
+        Returns (reply dict or None on timeout, latency in seconds).
+        """
+        key = key or ip
+        if request_id in self.protocol.pending:
+            # Its reply would resolve the other request; stamp() avoids this.
+            raise ValueError(f"request id {request_id} is already in flight")
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.protocol.pending[request_id] = future
+        start = deadline = None
+        rto = self.rtt.rto(key)
+        attempts = 0
+        try:
+            while True:
+                # The deadline and RTO run from when the datagram reaches the
+                # socket, not from when it was queued behind other sends.
+                await self.protocol.writable.wait()
+                if future.done():
+                    break  # answered while a retransmission waited
+                attempts += 1
+                sent = time.monotonic()
+                if start is None:
+                    start = sent
+                    deadline = start + (timeout or self.timeout)
+                self.transport.sendto(payload, (ip, self.port))
+                metrics.record_send(key, method, retry=attempts > 1)
+                wait = min(rto, deadline - sent)
+                await asyncio.wait({future}, timeout=wait)
+                if not future.done():
+                    self.protocol.poll()
+                if future.done():
+                    break
+                if time.monotonic() >= deadline:
+                    break
+                self.rtt.backoff(key)
+                rto = min(self.rtt.max_rto, rto * 2)
+        finally:
+            if not future.done():
+                future.cancel()
+            self.protocol.pending.pop(request_id, None)
+
+        latency = time.monotonic() - start if start is not None else 0.0
+        reply = future.result()[0] if future.done() and not future.cancelled() else None
+        if reply is not None:
+            metrics.record_reply(key, method, latency)
+        else:
+            metrics.record_timeout(key, method)
+        if reply is not None and attempts == 1:
+            # Karn's rule: a reply to a retransmitted id can't be timed reliably.
+            self.rtt.sample(key, latency)
+        self.stats[key] = {"attempts": attempts, "latency": latency, "replied": reply is not None}
+        if tracing.ENABLED:
+            end = tracing.now()
+            tracing.complete(method, end - latency, end, "bulb", key, attempts=attempts, replied=reply is not None)
+        return reply, latency
+
+    async def request(self, ip, method, params, timeout=None, key=None):
+        """
+        Send a single command to `ip` and wait for its reply.
+        Returns (reply dict or None on timeout, latency in seconds).
+        """
+        request_id = self.next_id()
+        payload = self.build(method, params, request_id)
+        return await self.request_bytes(ip, payload, request_id, timeout, key, method)
+
+    async def send_all(self, targets, method="setPilot", timeout=None, limit=CONCURRENCY):
+        """
+        Send `method` to every (key, ip, params) target at once and yield
+        (key, reply, latency) tuples in the order the replies arrive.
+        `reply` is None for bulbs that did not answer within the timeout.
+        `limit` bounds how many requests are in flight at a time (None: all).
+        """
+        async def one(key, ip, params):
+            reply, latency = await self.request(ip, method, params, timeout, key)
+            return key, reply, latency
+
+        async for result in self._gather([one(*target) for target in targets], limit):
+            yield result
+
+    async def send_all_bytes(self, targets, timeout=None, method="setPilot", limit=CONCURRENCY):
+        """
+        Like send_all, but for pre-encoded (key, ip, payload, request_id) targets.
+        """
+        async def one(key, ip, payload, request_id):
+            reply, latency = await self.request_bytes(ip, payload, request_id, timeout, key, method)
+            return key, reply, latency
+
+        async for result in self._gather([one(*target) for target in targets], limit):
+            yield result
+
+    async def _gather(self, coroutines, limit=None):
+        # Yield results in completion order, cancelling leftovers if abandoned.
+        if limit:
+            semaphore = asyncio.Semaphore(limit)
+
+            async def bounded(coroutine):
+                async with semaphore:
+                    return await coroutine
+
+            coroutines = [bounded(coroutine) for coroutine in coroutines]
+        tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def send_group(self, members, params, method="setPilot",
+                         broadcast_addr=BROADCAST_ADDR, window=None, retry=True):
+        """
+        Send one broadcast `method` to a group whose members all share `params`.
+        `members` maps key -> ip; replies are matched to members by source IP.
+        Members that do not acknowledge within `window` get a unicast retry.
+        Yields (key, reply, latency) tuples as replies arrive, like send_all.
+
+        Every bulb that hears the broadcast applies it, so the caller must make
+        sure no bulb outside `members` sits behind `broadcast_addr`.
+        """
+        window = window or self.timeout
+        keys_by_ip = {ip: key for key, ip in members.items()}
+        arrived = asyncio.Queue()
+        request_id = self.next_id()
+
+        def collect(reply, addr):
+            key = keys_by_ip.get(addr[0])
+            if key is not None:
+                arrived.put_nowait((key, reply))
+
+        self.protocol.collectors[request_id] = collect
+        start = time.monotonic()
+        acked = set()
+        try:
+            self.transport.sendto(self.build(method, params, request_id), (broadcast_addr, self.port))
+            metrics.record_send(broadcast_addr, method)
+            deadline = start + window
+            while len(acked) < len(members):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    key, reply = await asyncio.wait_for(arrived.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if key in acked or not is_success(reply):
+                    continue
+                acked.add(key)
+                latency = time.monotonic() - start
+                metrics.record_reply(key, method, latency)
+                self.rtt.sample(key, latency)
+                self.stats[key] = {"attempts": 1, "latency": latency, "replied": True}
+                if tracing.ENABLED:
+                    end = tracing.now()
+                    tracing.complete(method, end - latency, end, "bulb", key, broadcast=broadcast_addr)
+                yield key, reply, latency
+        finally:
+            self.protocol.collectors.pop(request_id, None)
+
+        missing = [(key, ip, params) for key, ip in members.items() if key not in acked]
+        if not missing:
+            return
+        if not retry:
+            for key, _, _ in missing:
+                yield key, None, time.monotonic() - start
+            return
+        async for key, reply, latency in self.send_all(missing, method):
+            # The broadcast counts as the first attempt.
+            self.stats[key]["attempts"] += 1
+            self.stats[key]["latency"] = time.monotonic() - start
+            yield key, reply, self.stats[key]["latency"]
+
+
+def encode_body(method, params):
+    """
+    Encode everything of a command but its id, once, for FanoutEngine.stamp()
+    to complete per send: a fixed id shared by concurrent sends would let one
+    send's reply resolve another's request.
+    """
+    return b", " + json.dumps({
+        "method": method,
+        "params": {k: v for k, v in params.items() if v is not None},
+    }).encode()[1:]
+
+
+# Defined in state.py so wiz.py's quick commands can share it without importing asyncio.
+is_success = state.is_success
+
+
+async def send_all(targets, method="setPilot", timeout=DEFAULT_TIMEOUT):
+    """
+    Convenience wrapper: open an engine, fan `method` out to every
+    (key, ip, params) target and return {key: (reply, latency)}.
+    """
+    results = {}
+    async with FanoutEngine(timeout=timeout) as engine:
+        async for key, reply, latency in engine.send_all(targets, method, timeout):
+            results[key] = (reply, latency)
+    return results
+
+
+def run_send_all(targets, method="setPilot", timeout=DEFAULT_TIMEOUT):
+    """
+    Blocking entry point for scripts that are not already running an event loop.
+    """
+    return asyncio.run(send_all(targets, method, timeout))
+
+
+async def send_group(members, params, method="setPilot", broadcast_addr=BROADCAST_ADDR,
+                     window=DEFAULT_TIMEOUT):
+    """
+    Convenience wrapper around FanoutEngine.send_group.
+    Returns {key: (reply, latency)} for every member.
+    """
+    results = {}
+    async with FanoutEngine(timeout=window, broadcast=True) as engine:
+        async for key, reply, latency in engine.send_group(members, params, method, broadcast_addr, window):
+            results[key] = (reply, latency)
+    return results
+
+
+def run_send_group(members, params, method="setPilot", broadcast_addr=BROADCAST_ADDR,
+                   window=DEFAULT_TIMEOUT):
+    """
+    Blocking entry point for send_group.
+    """
+    return asyncio.run(send_group(members, params, method, broadcast_addr, window))
@@ -0,0 +1,403 @@
+import sys
+import time
+import mmap
+import json
+import socket
+import struct
+import asyncio
+import argparse
+
+import fade
+import config
+import fanout
+import metrics
+import registry
+import templates
+
+MAGIC = b"WIZJ"
+VERSION = 1
+# File header: magic, version, device count; then one 12-character MAC per
+# device, so records can refer to bulbs by index.
+HEADER = struct.Struct("<4sHH")
+MAC_WIDTH = 12
+# One bulb's state at a moment: milliseconds since the start of the show,
+# device index, on/off, r, g, b, dimming and color temperature (0 = RGB).
+RECORD = struct.Struct("<IHBBBBBH")
+
+# Replay sleeps until this long before a frame is due, then spins, since
+# sleep() alone can overshoot by a scheduler tick.
+SPIN = 0.002
+# A frame running later than this is folded into the next one (each bulb
+# keeps its newest state) and counted as dropped.
+MAX_LATE = 0.05
+
+COLOR_FIELDS = ("r", "g", "b", "dimming")
+WHITE_FIELDS = ("temp", "dimming")
+
+
+def encode_state(params, previous=None):
+    """
+    Return the (state, r, g, b, dimming, temp) record fields for setPilot
+    params or a pilot dict, or None if they can't be represented. Any of r,
+    g or b means an RGB color, otherwise a temp means white; fields left out
+    (a dimming-only change, or just "state") keep their values from
+    `previous`, the bulb's last record. A scene, or a bulb switched on with
+    no earlier color to show, can't be recorded.
+    """
+    def channel(name, default=0):
+        value = params.get(name)
+        if not isinstance(value, (int, float)):
+            return default
+        low, high = fade.PARAM_RANGES[name]
+        return max(low, min(high, int(round(value))))
+
+    state = 1 if params.get("state", True) else 0
+    _, last_r, last_g, last_b, last_dimming, last_temp = previous or (0, 0, 0, 0, 100, 0)
+    dimming = channel("dimming", last_dimming)
+    if any(isinstance(params.get(name), (int, float)) for name in ("r", "g", "b")):
+        return state, channel("r", last_r), channel("g", last_g), channel("b", last_b), dimming, 0
+    if isinstance(params.get("temp"), (int, float)):
+        return state, last_r, last_g, last_b, dimming, channel("temp")
+    if not state:
+        return state, last_r, last_g, last_b, dimming, last_temp
+    if previous is None or params.get("sceneId") or params.get("sceneID"):
+        return None
+    return state, last_r, last_g, last_b, dimming, last_temp
+
+
+class JournalWriter:
+    """
+    Append timed per-bulb states to a journal file.
+
+    Usage:
+        with JournalWriter(path, macs) as journal:
+            journal.record(0.0, mac, {"r": 255, "g": 0, "b": 0, "dimming": 80})
+            journal.record(0.05, mac, {"state": False})
+    """
+
+    def __init__(self, path, macs):
+        self.path = path
+        self.macs = list(macs)
+        self.index = {mac: index for index, mac in enumerate(self.macs)}
+        self.file = None
+        self.last = 0
+        self.count = 0
+        # Device index -> its last recorded fields, carried into the next record.
+        self.shown = {}
+        # Records dropped because encode_state couldn't represent them.
+        self.skipped = 0
+
+    def open(self):
+        self.file = open(self.path, "wb")
+        self.file.write(HEADER.pack(MAGIC, VERSION, len(self.macs)))
+        for mac in self.macs:
+            self.file.write(mac.encode().ljust(MAC_WIDTH)[:MAC_WIDTH])
+        return self
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def record(self, seconds, mac, params):
+        """
+        Record that `mac` shows `params` `seconds` after the start of the show.
+        Times must not go backwards. Returns False, counting it in `skipped`,
+        if the state can't be represented (see encode_state).
+        """
+        milliseconds = int(round(seconds * 1000))
+        if milliseconds < self.last:
+            raise ValueError(f"journal time went backwards: {milliseconds}ms after {self.last}ms")
+        self.last = milliseconds
+        index = self.index[mac]
+        fields = encode_state(params, self.shown.get(index))
+        if fields is None:
+            self.skipped += 1
+            return False
+        self.shown[index] = fields
+        self.file.write(RECORD.pack(milliseconds, index, *fields))
+        self.count += 1
+        return True
+
+
+class JournalReader:
+    """
+    A journal mapped into memory; records are decoded on demand, so a long
+    show never has to be read in whole.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.map = None
+        self.macs = []
+        self.start = 0
+
+    def open(self):
+        self.file = open(self.path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, devices = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f"{self.path}: not a version {VERSION} journal")
+        self.start = HEADER.size + devices * MAC_WIDTH
+        self.macs = [
+            self.map[HEADER.size + index * MAC_WIDTH:HEADER.size + (index + 1) * MAC_WIDTH].decode().strip()
+            for index in range(devices)
+        ]
+        return self
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return (len(self.map) - self.start) // RECORD.size
+
+    def duration(self):
+        """
+        Seconds from the start of the show to its last record.
+        """
+        if not len(self):
+            return 0.0
+        return RECORD.unpack_from(self.map, self.start + (len(self) - 1) * RECORD.size)[0] / 1000
+
+    def frames(self):
+        """
+        Yield (milliseconds, offsets) for each run of records sharing a timestamp.
+        """
+        offsets = []
+        current = None
+        end = self.start + len(self) * RECORD.size
+        for offset in range(self.start, end, RECORD.size):
+            milliseconds = RECORD.unpack_from(self.map, offset)[0]
+            if milliseconds != current and offsets:
+                yield current, offsets
+                offsets = []
+            current = milliseconds
+            offsets.append(offset)
+        if offsets:
+            yield current, offsets
+
+
+def _with_last(items):
+    # Yield (item, is_last) pairs, looking one item ahead.
+    items = iter(items)
+    try:
+        previous = next(items)
+    except StopIteration:
+        return
+    for item in items:
+        yield previous, False
+        previous = item
+    yield previous, True
+
+
+def _percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def play(path, ips=None, speed=1.0, max_late=MAX_LATE, port=fanout.WIZ_PORT):
+    """
+    Replay a journal against the bulbs in `ips` ({mac: ip}, default: the
+    registry's), keeping frames on the monotonic clock. Packets are patched
+    into pre-encoded templates; no JSON is built during the show.
+    Returns a dict of stats: frames, dropped, packets, missing (MACs with no
+    IP) and jitter_ms, the mean, p50, p99 and max lateness of sent frames.
+    """
+    color = templates.template_for(COLOR_FIELDS)
+    white = templates.template_for(WHITE_FIELDS)
+    off = json.dumps({"id": 0, "method": "setState", "params": {"state": False}}).encode()
+
+    with JournalReader(path) as journal:
+        if ips is None:
+            ips = registry.get_registry().resolve(journal.macs)
+        addrs = [(ips[mac], port) if mac in ips else None for mac in journal.macs]
+        counts = [0] * len(journal.macs)
+        # Device index -> offset of the newest record not sent yet.
+        pending = {}
+        lateness = []
+        frames = dropped = 0
+
+        def flush():
+            for index, offset in pending.items():
+                addr = addrs[index]
+                if addr is None:
+                    continue
+                _, _, state, r, g, b, dimming, temp = RECORD.unpack_from(journal.map, offset)
+                if not state:
+                    sock.sendto(off, addr)
+                elif temp:
+                    sock.sendto(white.patch((temp, dimming)), addr)
+                else:
+                    sock.sendto(color.patch((r, g, b, dimming)), addr)
+                counts[index] += 1
+            pending.clear()
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            began = time.monotonic()
+            for (milliseconds, offsets), last in _with_last(journal.frames()):
+                for offset in offsets:
+                    pending[RECORD.unpack_from(journal.map, offset)[1]] = offset
+                frames += 1
+                due = began + milliseconds / 1000 / speed
+                delay = due - time.monotonic()
+                if delay > SPIN:
+                    time.sleep(delay - SPIN)
+                while time.monotonic() < due:
+                    pass
+                late = time.monotonic() - due
+                # A late frame is skipped and folded into the next one; the
+                # show's end state always goes out, however late.
+                if late > max_late and not last:
+                    dropped += 1
+                    continue
+                flush()
+                lateness.append(late)
+        finally:
+            sock.close()
+
+        for index, count in enumerate(counts):
+            if count:
+                metrics.record_send(journal.macs[index], "setPilot", count=count)
+        missing = [mac for mac, addr in zip(journal.macs, addrs) if addr is None]
+
+    ordered = sorted(late * 1000 for late in lateness)
+    return {
+        "frames": frames,
+        "dropped": dropped,
+        "packets": sum(counts),
+        "missing": missing,
+        "jitter_ms": {
+            "mean": sum(ordered) / len(ordered) if ordered else 0.0,
+            "p50": _percentile(ordered, 0.5),
+            "p99": _percentile(ordered, 0.99),
+            "max": ordered[-1] if ordered else 0.0,
+        },
+    }
+
+
+def record_effect(path, macs, render, duration, fps):
+    """
+    Render an effects.py effect for `macs`, in the order its rows follow,
+    into a journal instead of sending it; only bulbs whose values change get
+    a record. Returns the number of records written.
+    """
+    # numpy is only needed to render effects, not to record or play.
+    import effects
+
+    previous = None
+    with JournalWriter(path, macs) as journal:
+        for frame_number in range(int(duration * fps)):
+            seconds = frame_number / fps
+            frame = effects.quantize(render(seconds))
+            for row in effects.changed_rows(previous, frame).tolist():
+                journal.record(seconds, macs[row], dict(zip(effects.COLUMNS, frame[row].tolist())))
+            previous = frame
+        return journal.count
+
+
+async def record_live(path, macs, seconds):
+    """
+    Record what the bulbs report for `seconds`: every syncPilot push after a
+    change, whether it came from these scripts, the phone app or a switch.
+    Returns (records written, pushes skipped as unrepresentable).
+    """
+    import push
+
+    with JournalWriter(path, macs) as journal:
+        began = time.monotonic()
+
+        def on_change(mac, pilot, changed):
+            if mac in journal.index:
+                journal.record(time.monotonic() - began, mac, pilot)
+
+        listener = push.PushListener(lambda: registry.get_registry().resolve(macs), on_change=on_change)
+        try:
+            await asyncio.wait_for(listener.run(), seconds)
+        except asyncio.TimeoutError:
+            pass
+        return journal.count, journal.skipped
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description="Record and replay timed light shows.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    play_parser = subparsers.add_parser("play", help="replay a journal")
+    play_parser.add_argument("path")
+    play_parser.add_argument("--speed", type=float, default=1.0)
+    play_parser.add_argument("--max-late", type=float, default=MAX_LATE,
+                             help="seconds a frame may run late before it is folded into the next")
+    record_parser = subparsers.add_parser("record", help="record the bulbs' pushed state changes")
+    record_parser.add_argument("path")
+    record_parser.add_argument("--seconds", type=float, default=60.0)
+    effect_parser = subparsers.add_parser("effect", help="render an effects.py effect into a journal")
+    effect_parser.add_argument("path")
+    effect_parser.add_argument("effect")
+    effect_parser.add_argument("--group", default="accent", help="config group, in config (physical) order, or 'all'")
+    effect_parser.add_argument("--seconds", type=float, default=10.0)
+    effect_parser.add_argument("--fps", type=float, default=20.0)
+    info_parser = subparsers.add_parser("info", help="summarize a journal")
+    info_parser.add_argument("path")
+    args = parser.parse_args(argv)
+
+    if args.command == "play":
+        stats = play(args.path, speed=args.speed, max_late=args.max_late)
+        jitter = stats["jitter_ms"]
+        print(f"{stats['frames']} frames, {stats['dropped']} dropped, {stats['packets']} packets; "
+              f"late by {jitter['mean']:.2f}ms mean, {jitter['p50']:.2f}ms p50, "
+              f"{jitter['p99']:.2f}ms p99, {jitter['max']:.2f}ms max")
+        if stats["missing"]:
+            print("NOT FOUND: " + ", ".join(stats["missing"]))
+        registry.get_registry().save()
+        metrics.METRICS.write_textfile()
+        return
+
+    if args.command == "info":
+        with JournalReader(args.path) as journal:
+            frames = sum(1 for _ in journal.frames())
+            print(f"{len(journal.macs)} devices, {len(journal)} records, {frames} frames, "
+                  f"{journal.duration():.2f}s")
+        return
+
+    cfg = config.load()
+    if args.command == "record":
+        count, skipped = asyncio.run(record_live(args.path, list(cfg.devices_by_mac()), args.seconds))
+        registry.get_registry().save()
+        if skipped:
+            print(f"{skipped} pushes skipped (scenes, or no color known yet)")
+    else:
+        import effects
+
+        if args.effect not in effects.EFFECTS:
+            parser.error(f"unknown effect: {args.effect}")
+        names = cfg.devices if args.group == "all" else cfg.groups[args.group]["members"]
+        macs = [cfg.devices[name]["mac"] for name in names]
+        render = effects.EFFECTS[args.effect](effects.fleet_array(macs, cfg.effective_params()))
+        count = record_effect(args.path, macs, render, args.seconds, args.fps)
+    print(f"{count} records written to {args.path}")
+    if not count:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    run()
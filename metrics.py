@@ -0,0 +1,242 @@
+import os
+import json
+import threading
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# Optional path of a node_exporter textfile the scripts write after a run.
+TEXTFILE_PATH = os.environ.get("WIZ_METRICS_TEXTFILE")
+
+HELP = {
+    "wiz_packets_sent_total": "UDP packets sent to bulbs, including retransmissions.",
+    "wiz_replies_total": "Replies received from bulbs.",
+    "wiz_timeouts_total": "Requests that got no reply before their deadline.",
+    "wiz_retries_total": "Retransmissions after a lost packet.",
+    "wiz_request_latency_seconds": "Time from first send to reply.",
+    "wiz_queue_depth": "Commands waiting in a bulb's send queue.",
+    "wiz_coalesced_total": "Queued setPilot commands replaced by a newer one before sending.",
+    "wiz_push_updates_total": "syncPilot state pushes received from bulbs.",
+}
+
+# key (alias or MAC) -> {"alias", "group"}, filled in by the scripts that know
+# their devices so every send is labeled the same way.
+DEVICE_LABELS = {}
+
+
+def register_device(key, alias, group):
+    DEVICE_LABELS[key] = {"alias": alias, "group": group or ""}
+
+
+def device_labels(key):
+    """
+    Return the alias/group label dict for `key`.
+    """
+    return dict(DEVICE_LABELS.get(key, {"alias": str(key), "group": ""}))
+
+
+def labels_for(key, method):
+    """
+    Return the label dict for a send to `key` with `method`.
+    """
+    return {"method": method, **device_labels(key)}
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(label_key, extra=()):
+    pairs = list(label_key) + list(extra)
+    if not pairs:
+        return ""
+    body = ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in pairs
+    )
+    return "{" + body + "}"
+
+
+class Metrics:
+    """
+    In-process counters, gauges and latency histograms keyed by metric name and labels.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name, labels, value=1):
+        key = (name, _label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, labels, value):
+        key = (name, _label_key(labels))
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, labels, value):
+        key = (name, _label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram["counts"][index] += 1
+                    break
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+    def snapshot(self):
+        """
+        Return every counter, gauge and histogram as plain JSON-serialisable data.
+        Histogram buckets are cumulative, as in the Prometheus format.
+        """
+        with self.lock:
+            counters = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self.counters.items())
+            ]
+            gauges = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self.gauges.items())
+            ]
+            histograms = []
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                buckets = {}
+                for bound, count in zip(self.buckets, histogram["counts"]):
+                    cumulative += count
+                    buckets[str(bound)] = cumulative
+                buckets["+Inf"] = histogram["count"]
+                histograms.append({
+                    "name": name,
+                    "labels": dict(labels),
+                    "buckets": buckets,
+                    "sum": histogram["sum"],
+                    "count": histogram["count"],
+                })
+        return {"counters": counters, "gauges": gauges, "histograms": histograms}
+
+    def merge(self, snapshot):
+        """
+        Add a snapshot() taken elsewhere (e.g. in a worker process) into this one.
+        """
+        for counter in snapshot["counters"]:
+            self.inc(counter["name"], counter["labels"], counter["value"])
+        for gauge in snapshot["gauges"]:
+            self.set(gauge["name"], gauge["labels"], gauge["value"])
+        with self.lock:
+            for histogram in snapshot["histograms"]:
+                key = (histogram["name"], _label_key(histogram["labels"]))
+                mine = self.histograms.get(key)
+                if mine is None:
+                    mine = self.histograms[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+                previous = 0
+                for index, bound in enumerate(self.buckets):
+                    cumulative = histogram["buckets"][str(bound)]
+                    mine["counts"][index] += cumulative - previous
+                    previous = cumulative
+                mine["sum"] += histogram["sum"]
+                mine["count"] += histogram["count"]
+
+    def to_json(self):
+        return json.dumps(self.snapshot())
+
+    def prometheus(self):
+        """
+        Render all metrics in the Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        lines = []
+        described = set()
+
+        def describe(name, kind):
+            if name in described:
+                return
+            described.add(name)
+            if name in HELP:
+                lines.append(f"# HELP {name} {HELP[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for counter in snapshot["counters"]:
+            describe(counter["name"], "counter")
+            label_key = _label_key(counter["labels"])
+            lines.append(f"{counter['name']}{_format_labels(label_key)} {counter['value']}")
+        for gauge in snapshot["gauges"]:
+            describe(gauge["name"], "gauge")
+            label_key = _label_key(gauge["labels"])
+            lines.append(f"{gauge['name']}{_format_labels(label_key)} {gauge['value']}")
+        for histogram in snapshot["histograms"]:
+            name = histogram["name"]
+            describe(name, "histogram")
+            label_key = _label_key(histogram["labels"])
+            for bound, count in histogram["buckets"].items():
+                lines.append(f"{name}_bucket{_format_labels(label_key, [('le', bound)])} {count}")
+            lines.append(f"{name}_sum{_format_labels(label_key)} {histogram['sum']}")
+            lines.append(f"{name}_count{_format_labels(label_key)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path=None):
+        """
+        Write the Prometheus text to `path` atomically (for node_exporter's
+        textfile collector). Does nothing if no path is configured.
+        """
+        path = path or TEXTFILE_PATH
+        if not path:
+            return
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.prometheus())
+        os.replace(tmp_path, path)
+
+
+METRICS = Metrics()
+
+
+def record_send(key, method, retry=False, count=1):
+    labels = labels_for(key, method)
+    METRICS.inc("wiz_packets_sent_total", labels, count)
+    if retry:
+        METRICS.inc("wiz_retries_total", labels)
+
+
+def record_reply(key, method, latency):
+    labels = labels_for(key, method)
+    METRICS.inc("wiz_replies_total", labels)
+    METRICS.observe("wiz_request_latency_seconds", labels, latency)
+
+
+def record_timeout(key, method):
+    METRICS.inc("wiz_timeouts_total", labels_for(key, method))
+
+
+def record_queue_depth(key, depth):
+    METRICS.set("wiz_queue_depth", device_labels(key), depth)
+
+
+def record_coalesced(key):
+    METRICS.inc("wiz_coalesced_total", device_labels(key))
+
+
+def record_push(key):
+    METRICS.inc("wiz_push_updates_total", device_labels(key))
+
+
+def snapshot():
+    return METRICS.snapshot()
+
+
+def prometheus():
+    return METRICS.prometheus()
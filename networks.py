@@ -0,0 +1,144 @@
+import re
+import socket
+import struct
+import ipaddress
+import subprocess
+
+try:
+    import fcntl
+except ImportError:  # not on Windows
+    fcntl = None
+
+# Linux interface ioctls and flags (see <linux/sockios.h> and <net/if.h>).
+SIOCGIFFLAGS = 0x8913
+SIOCGIFADDR = 0x8915
+SIOCGIFNETMASK = 0x891B
+IFF_UP = 0x1
+IFF_BROADCAST = 0x2
+IFF_LOOPBACK = 0x8
+
+_cache = {}
+
+
+def _network(interface, address, netmask):
+    network = ipaddress.IPv4Network(f"{address}/{netmask}", strict=False)
+    return {
+        "interface": interface,
+        "address": address,
+        "network": network,
+        "broadcast": str(network.broadcast_address),
+    }
+
+
+def _ioctl(sock, request, name):
+    return fcntl.ioctl(sock.fileno(), request, struct.pack("256s", name.encode()[:15]))
+
+
+def _read_ioctl():
+    # One IPv4 address per interface, straight from the kernel; no subprocess.
+    found = []
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for _, name in socket.if_nameindex():
+            try:
+                flags = struct.unpack("H", _ioctl(sock, SIOCGIFFLAGS, name)[16:18])[0]
+                if not flags & IFF_UP or not flags & IFF_BROADCAST or flags & IFF_LOOPBACK:
+                    continue
+                address = socket.inet_ntoa(_ioctl(sock, SIOCGIFADDR, name)[20:24])
+                netmask = socket.inet_ntoa(_ioctl(sock, SIOCGIFNETMASK, name)[20:24])
+            except OSError:
+                continue  # no IPv4 address
+            found.append(_network(name, address, netmask))
+    finally:
+        sock.close()
+    return found
+
+
+def parse_ifconfig_output(data):
+    """
+    Parse BSD/macOS `ifconfig` output.
+    Returns a list of network dicts for interfaces with an IPv4 broadcast address.
+    """
+    found = []
+    interface = None
+    for line in data.splitlines():
+        header = re.match(r"^(\S+?):? flags=", line)
+        if header:
+            interface = header.group(1)
+            continue
+        match = re.search(r"inet (\d+\.\d+\.\d+\.\d+) netmask (0x[0-9a-fA-F]+|\d+\.\d+\.\d+\.\d+) broadcast", line)
+        if interface and match:
+            address, netmask = match.groups()
+            if netmask.startswith("0x"):
+                netmask = socket.inet_ntoa(struct.pack("!I", int(netmask, 16)))
+            found.append(_network(interface, address, netmask))
+    return found
+
+
+def list_interfaces():
+    """
+    Return a network dict ({"interface", "address", "network", "broadcast"})
+    for every up, broadcast-capable, non-loopback IPv4 interface.
+    """
+    if fcntl is not None and hasattr(socket, "if_nameindex"):
+        try:
+            return _read_ioctl()
+        except OSError:
+            pass
+    try:
+        result = subprocess.run(["ifconfig"], capture_output=True, text=True)
+    except OSError:
+        return []
+    return parse_ifconfig_output(result.stdout)
+
+
+def resolve(specs=()):
+    """
+    Turn the config's network specs into network dicts.
+    A spec is an interface name or a subnet; a subnet with no local interface
+    (a routed VLAN) is reached by its directed broadcast and has interface None.
+    No specs means every local interface.
+    """
+    key = tuple(specs)
+    if key in _cache:
+        return _cache[key]
+    interfaces = list_interfaces()
+    if not specs:
+        networks = interfaces
+    else:
+        networks = []
+        for spec in specs:
+            if "/" not in spec:
+                networks.extend(net for net in interfaces if net["interface"] == spec)
+                continue
+            subnet = ipaddress.IPv4Network(spec, strict=False)
+            local = [net for net in interfaces if ipaddress.IPv4Address(net["address"]) in subnet]
+            if local:
+                networks.append({**local[0], "network": subnet, "broadcast": str(subnet.broadcast_address)})
+            else:
+                networks.append({
+                    "interface": None,
+                    "address": None,
+                    "network": subnet,
+                    "broadcast": str(subnet.broadcast_address),
+                })
+    _cache[key] = networks
+    return networks
+
+
+def network_for(ip, networks):
+    """
+    Return the network dict `ip` belongs to, or None.
+    """
+    address = ipaddress.IPv4Address(ip)
+    for net in networks:
+        if address in net["network"]:
+            return net
+    return None
+
+
+def label(net):
+    """
+    Name a network for the registry: its interface, or its subnet when routed.
+    """
+    return net["interface"] or str(net["network"])
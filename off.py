@@ -1,43 +1,135 @@
+import sys
 import asyncio
-from pywizlight import wizlight, discovery
+import argparse
+import statistics
 
-async def turn_off_all_wiz_bulbs():
-    print("Discovering Philips Wiz bulbs on the network...")
-    
-    bulbs = await discovery.discover_lights(broadcast_space="255.255.255.255")  # Adjust for your subnet if needed
+import config
+import fanout
+import networks
+import registry
+
+# Used only when no network is configured or detected.
+BROADCAST_SPACE = "255.255.255.255"
+# Requests in flight at once; bulbs on the same AP don't like a flood.
+CONCURRENCY = 32
+# Per-bulb deadline, retransmissions included.
+TIMEOUT = 0.5
+# Bulbs slower than this (or silent) are reported as stragglers.
+STRAGGLER_LATENCY = 0.25
+
+
+async def discover_bulbs():
+    """
+    Broadcast for bulbs with pywizlight on every configured network at once
+    and remember them, with their network, in the registry.
+    Returns {mac: ip}.
+    """
+    from pywizlight import discovery
+
+    nets = networks.resolve(config.load().networks)
+    spaces = [net["broadcast"] for net in nets] or [BROADCAST_SPACE]
+    print(f"Discovering Philips Wiz bulbs on {', '.join(spaces)}...")
+    found = await asyncio.gather(*(discovery.discover_lights(broadcast_space=space) for space in spaces))
+    reg = registry.get_registry()
+    bulbs = {}
+    for bulb in (bulb for batch in found for bulb in batch):
+        # pywizlight's wizlight objects carry the MAC as .mac, in whatever
+        # form the bulb reported it; registry keys are normalized.
+        mac = registry.normalize_mac(bulb.mac)
+        net = networks.network_for(bulb.ip, nets)
+        reg.put(mac, bulb.ip, networks.label(net) if net else None)
+        bulbs[mac] = bulb.ip
+    reg.save()
+    return bulbs
+
+
+def cached_bulbs():
+    """
+    Return {mac: ip} for the configured bulbs the registry can already address.
+    """
+    macs = config.load().devices_by_mac()
+    return registry.get_registry().resolve(macs)
+
+
+def power_command(action, brightness=None):
+    """
+    Map an action to (method, params).
+    """
+    if action == "off":
+        return "setState", {"state": False}
+    if action == "on":
+        return "setState", {"state": True}
+    if action == "brightness":
+        return "setPilot", {"dimming": brightness}
+    raise ValueError(f"unknown action: {action}")
+
+
+async def bulk_power(bulbs, action="off", brightness=None, concurrency=CONCURRENCY, timeout=TIMEOUT):
+    """
+    Send the power action to every {mac: ip} bulb concurrently, at most
+    `concurrency` in flight, each with its own `timeout`.
+    Returns {mac: (success, latency)}.
+    """
+    method, params = power_command(action, brightness)
+    results = {}
+    async with fanout.FanoutEngine(timeout=timeout) as engine:
+        targets = [(mac, ip, params) for mac, ip in bulbs.items()]
+        async for mac, reply, latency in engine.send_all(targets, method, timeout, limit=concurrency):
+            results[mac] = (fanout.is_success(reply), latency)
+    return results
+
+
+def report(bulbs, results, action):
+    names = config.load().devices_by_mac()
+    done = [mac for mac, (success, _) in results.items() if success]
+    stragglers = sorted(
+        (mac for mac, (success, latency) in results.items()
+         if not success or latency > STRAGGLER_LATENCY),
+        key=lambda mac: -results[mac][1],
+    )
+    latencies = [latency for success, latency in results.values() if success]
+    median_ms = statistics.median(latencies) * 1000 if latencies else 0
+    print(f"{action.upper()}: {len(done)}/{len(bulbs)} bulbs acknowledged, median {median_ms:.0f}ms")
+    for mac in stragglers:
+        success, latency = results[mac]
+        name = names.get(mac, {}).get("name", "UNKNOWN")
+        status = f"{latency * 1000:.0f}ms" if success else "NO REPLY"
+        print(f"  STRAGGLER {name:<10} {mac}  {bulbs[mac]:<15}  {status}")
+
+
+async def turn_off_all_wiz_bulbs(use_cache=False, action="off", brightness=None,
+                                 concurrency=CONCURRENCY, timeout=TIMEOUT):
+    bulbs = cached_bulbs() if use_cache else {}
+    if not bulbs:
+        bulbs = await discover_bulbs()
 
     if not bulbs:
         print("No Wiz bulbs found on the network.")
-        return
+        return {}
+
+    results = await bulk_power(bulbs, action, brightness, concurrency, timeout)
+    report(bulbs, results, action)
+    return results
 
-    print(f"Found {len(bulbs)} bulbs:")
-    bulb_objects = [wizlight(bulb.ip) for bulb in bulbs]
 
-    # Turn off all detected bulbs
-    for bulb in bulb_objects:
-        print(f"Turning off bulb at IP: {bulb.ip}")
-        await bulb.turn_off()
+def run(argv=None):
+    parser = argparse.ArgumentParser(description="Turn every WiZ bulb off, on, or to a brightness.")
+    parser.add_argument("action", nargs="?", default="off", choices=["off", "on", "brightness"])
+    parser.add_argument("brightness", nargs="?", type=int, help="dimming 10-100 for 'brightness'")
+    parser.add_argument("--cached", action="store_true",
+                        help="use the cached MAC to IP registry instead of a fresh discovery")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    parser.add_argument("--timeout", type=float, default=TIMEOUT, help="per-bulb deadline in seconds")
+    args = parser.parse_args(argv)
+    if args.action == "brightness" and args.brightness is None:
+        parser.error("brightness needs a value")
 
-    print("All Wiz bulbs have been turned off.")
+    results = asyncio.run(turn_off_all_wiz_bulbs(
+        args.cached, args.action, args.brightness, args.concurrency, args.timeout,
+    ))
+    if not results or not all(success for success, _ in results.values()):
+        sys.exit(1)
 
-    # Ensure proper cleanup
-    for bulb in bulb_objects:
-        await bulb.async_close()
 
-# Fix for event loop issue
 if __name__ == "__main__":
-    try:
-        loop = asyncio.get_running_loop()
-    except RuntimeError:  # If no event loop is running
-        loop = None
-
-    if loop and loop.is_running():
-        print("Detected running event loop. Using alternative execution method.")
-        task = loop.create_task(turn_off_all_wiz_bulbs())
-        loop.run_until_complete(task)
-    else:
-        asyncio.run(turn_off_all_wiz_bulbs())
-
-    # Explicitly close the loop (if necessary)
-    if loop:
-        loop.close()
\ No newline at end of file
+    run()
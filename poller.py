@@ -0,0 +1,242 @@
+import time
+import array
+import bisect
+import random
+import asyncio
+import argparse
+
+import config
+import fanout
+import registry
+import state
+
+POLL_INTERVAL = 30.0
+# Each sweep waits interval * (1 +/- JITTER) so many pollers don't align.
+JITTER = 0.1
+CONCURRENCY = 32
+# Samples kept per bulb; memory is fixed at roughly CAPACITY * 26 bytes per bulb.
+CAPACITY = 2880
+
+# Stored as signed integers; -1 marks "not reported" (and, for state, "no reply").
+MISSING = -1
+FIELDS = (
+    ("state", "b"),
+    ("r", "h"),
+    ("g", "h"),
+    ("b", "h"),
+    ("c", "h"),
+    ("w", "h"),
+    ("dimming", "h"),
+    ("temp", "i"),
+    ("sceneId", "h"),
+    ("rssi", "h"),
+)
+
+
+class BulbHistory:
+    """
+    Fixed-size ring buffer of pilot samples for one bulb, one typed array per field.
+    """
+
+    def __init__(self, capacity=CAPACITY):
+        self.capacity = capacity
+        self.times = array.array("d", [0.0]) * capacity
+        self.columns = {name: array.array(code, [MISSING]) * capacity for name, code in FIELDS}
+        self.head = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, timestamp, pilot):
+        """
+        Record one sample; `pilot` is a getPilot result, or None for no reply.
+        """
+        index = self.head
+        self.times[index] = timestamp
+        for name, _ in FIELDS:
+            column = self.columns[name]
+            if pilot is None:
+                column[index] = MISSING
+            elif name == "state":
+                column[index] = 1 if pilot.get("state") else 0
+            else:
+                value = pilot.get(name)
+                column[index] = int(value) if isinstance(value, (int, float)) else MISSING
+        self.head = (self.head + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def _physical(self, logical):
+        # Logical index 0 is the oldest sample still held.
+        return (self.head - self.size + logical) % self.capacity
+
+    def _sample(self, logical):
+        index = self._physical(logical)
+        sample = {"time": self.times[index]}
+        for name, _ in FIELDS:
+            value = self.columns[name][index]
+            if name == "state":
+                sample["reachable"] = value != MISSING
+                sample["state"] = None if value == MISSING else bool(value)
+            else:
+                sample[name] = None if value == MISSING else value
+        return sample
+
+    def latest(self):
+        return self._sample(self.size - 1) if self.size else None
+
+    def range(self, start=None, end=None):
+        """
+        Return the samples with start <= time <= end, oldest first.
+        """
+        times = _OrderedTimes(self)
+        low = 0 if start is None else bisect.bisect_left(times, start)
+        high = self.size if end is None else bisect.bisect_right(times, end)
+        return [self._sample(logical) for logical in range(low, high)]
+
+
+class _OrderedTimes:
+    # Sequence view of a history's timestamps in logical order, for bisect.
+
+    def __init__(self, history):
+        self.history = history
+
+    def __len__(self):
+        return self.history.size
+
+    def __getitem__(self, logical):
+        return self.history.times[self.history._physical(logical)]
+
+
+class Poller:
+    """
+    Sweep getPilot across a fleet at a fixed interval and keep per-bulb history.
+
+    `bulbs` is a callable returning the current {mac: ip} to poll.
+    """
+
+    def __init__(self, bulbs, interval=POLL_INTERVAL, jitter=JITTER, concurrency=CONCURRENCY,
+                 capacity=CAPACITY, engine=None):
+        self.bulbs = bulbs
+        self.interval = interval
+        self.jitter = jitter
+        self.concurrency = concurrency
+        self.capacity = capacity
+        self.engine = engine
+        self.histories = {}
+        self.sweeps = 0
+
+    def history(self, mac):
+        history = self.histories.get(mac)
+        if history is None:
+            history = self.histories[mac] = BulbHistory(self.capacity)
+        return history
+
+    async def sweep(self):
+        """
+        Poll every bulb once, concurrently. Returns {mac: pilot or None}.
+        """
+        bulbs = self.bulbs()
+        targets = [(mac, ip, {}) for mac, ip in bulbs.items()]
+        cache = state.get_state_cache()
+        results = {}
+        async for mac, reply, _ in self.engine.send_all(targets, "getPilot", limit=self.concurrency):
+            pilot = reply.get("result") if reply else None
+            self.history(mac).append(time.time(), pilot)
+            if pilot is not None:
+                cache.seed(mac, pilot)
+            results[mac] = pilot
+        self.sweeps += 1
+        return results
+
+    async def run(self, on_sweep=None):
+        """
+        Sweep forever (until cancelled), calling `on_sweep(results)` after each.
+        """
+        owns_engine = self.engine is None
+        if owns_engine:
+            self.engine = await fanout.FanoutEngine().open()
+        try:
+            while True:
+                results = await self.sweep()
+                if on_sweep is not None:
+                    on_sweep(results)
+                delay = self.interval * (1 + random.uniform(-self.jitter, self.jitter))
+                await asyncio.sleep(delay)
+        finally:
+            if owns_engine:
+                self.engine.close()
+                self.engine = None
+
+    def latest(self):
+        """
+        Return {mac: latest sample} for every polled bulb.
+        """
+        return {mac: history.latest() for mac, history in self.histories.items()}
+
+    def range(self, mac, start=None, end=None):
+        history = self.histories.get(mac)
+        return history.range(start, end) if history else []
+
+    def unreachable(self):
+        """
+        Return the MACs whose most recent poll got no reply (e.g. power loss).
+        """
+        return [mac for mac, sample in self.latest().items() if sample and not sample["reachable"]]
+
+    def drifted(self, expected):
+        """
+        Compare the latest samples with `expected` {mac: params}.
+        Returns {mac: {param: (expected, observed)}} for reachable bulbs that differ.
+        """
+        result = {}
+        for mac, params in expected.items():
+            history = self.histories.get(mac)
+            sample = history.latest() if history else None
+            if not sample or not sample["reachable"]:
+                continue
+            diff = {}
+            for key, want in params.items():
+                key = state.PARAM_ALIASES.get(key, key)
+                if key in sample and want is not None and not state.same_value(sample[key], want):
+                    diff[key] = (want, sample[key])
+            if diff:
+                result[mac] = diff
+        return result
+
+
+def configured_bulbs():
+    """
+    Return {mac: ip} for the configured bulbs the registry can address.
+    """
+    return registry.get_registry().resolve(config.load().devices_by_mac())
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description="Poll bulb state continuously and print changes.")
+    parser.add_argument("--interval", type=float, default=POLL_INTERVAL, help="seconds between sweeps")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    args = parser.parse_args(argv)
+
+    names = config.load().devices_by_mac()
+    previous = {}
+
+    def on_sweep(results):
+        for mac, pilot in sorted(results.items(), key=lambda item: names.get(item[0], {}).get("name", "")):
+            summary = "NO REPLY" if pilot is None else " ".join(
+                f"{key}={pilot[key]}" for key in ("state", "r", "g", "b", "dimming", "sceneId", "rssi") if key in pilot
+            )
+            if previous.get(mac) != summary:
+                print(f"{time.strftime('%H:%M:%S')}  {names.get(mac, {}).get('name', mac):<10}  {summary}", flush=True)
+                previous[mac] = summary
+        state.get_state_cache().save()
+
+    poller = Poller(configured_bulbs, args.interval, concurrency=args.concurrency)
+    try:
+        asyncio.run(poller.run(on_sweep))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    run()
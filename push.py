@@ -0,0 +1,194 @@
+import time
+import json
+import socket
+import asyncio
+import argparse
+
+import config
+import fanout
+import metrics
+import poller
+import registry
+import state
+
+# Bulbs send syncPilot and firstBeat to this port on every registered address.
+LISTEN_PORT = 38900
+# Bulbs drop a registration after roughly 30s without a refresh.
+REGISTER_INTERVAL = 20.0
+CONCURRENCY = 32
+# Identifies this listener to the bulbs; any 12 hex digits will do.
+PHONE_MAC = "aaaaaaaaaaaa"
+
+
+def local_ip_for(ip):
+    """
+    Return the local address the kernel would use to reach `ip`, so each
+    bulb is told to push to an address it can actually route to.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.connect((ip, fanout.WIZ_PORT))
+        return sock.getsockname()[0]
+    finally:
+        sock.close()
+
+
+def registration_params(phone_ip, phone_mac=PHONE_MAC):
+    return {"phoneIp": phone_ip, "phoneMac": phone_mac, "register": True, "id": "1"}
+
+
+class PushProtocol(asyncio.DatagramProtocol):
+    def __init__(self, listener):
+        self.listener = listener
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            message = json.loads(data.decode())
+        except ValueError:
+            return
+        if isinstance(message, dict):
+            self.listener.handle(message, addr, self.transport)
+
+
+class PushListener:
+    """
+    Register with every bulb and track the state it pushes back.
+
+    `bulbs` is a callable returning the {mac: ip} to register with. Each
+    syncPilot updates `pilots` ({mac: {"pilot", "ip", "updated"}}), the
+    state cache and the MAC to IP registry, then calls `on_change(mac, pilot,
+    changed)` with the set of fields that differ from the previous push.
+    A firstBeat (a bulb powering up) triggers an immediate registration.
+    """
+
+    def __init__(self, bulbs, port=LISTEN_PORT, interval=REGISTER_INTERVAL,
+                 concurrency=CONCURRENCY, on_change=None, engine=None):
+        self.bulbs = bulbs
+        self.port = port
+        self.interval = interval
+        self.concurrency = concurrency
+        self.on_change = on_change
+        self.engine = engine
+        self.transport = None
+        self.pilots = {}
+        self.registered = {}
+        self._owns_engine = engine is None
+        self._tasks = set()
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: PushProtocol(self), local_addr=("0.0.0.0", self.port),
+        )
+        if self.engine is None:
+            self.engine = await fanout.FanoutEngine().open()
+        return self
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+        if self._owns_engine and self.engine is not None:
+            self.engine.close()
+            self.engine = None
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def handle(self, message, addr, transport):
+        method = message.get("method")
+        params = message.get("params") or {}
+        mac = registry.normalize_mac(str(params.get("mac", "")))
+        if not mac:
+            return
+        ip = addr[0]
+        registry.get_registry().put(mac, ip)
+        if method == "firstBeat":
+            task = asyncio.ensure_future(self.register({mac: ip}))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            return
+        if method != "syncPilot":
+            return
+        # The bulb retransmits until the push is acknowledged.
+        transport.sendto(json.dumps({
+            "method": "syncPilot", "env": message.get("env", "pro"), "result": {"mac": mac},
+        }).encode(), addr)
+        pilot = {key: value for key, value in params.items() if key not in ("mac", "src")}
+        previous = self.pilots.get(mac, {}).get("pilot", {})
+        changed = {key for key in set(pilot) | set(previous)
+                   if pilot.get(key) != previous.get(key) and key != "rssi"}
+        self.pilots[mac] = {"pilot": pilot, "ip": ip, "updated": time.time()}
+        state.get_state_cache().seed(mac, pilot)
+        metrics.record_push(mac)
+        if changed and self.on_change is not None:
+            self.on_change(mac, pilot, changed)
+
+    async def register(self, bulbs=None):
+        """
+        Send a registration to every {mac: ip} bulb (default: all of them).
+        Returns the MACs that acknowledged.
+        """
+        bulbs = self.bulbs() if bulbs is None else bulbs
+        targets = [(mac, ip, registration_params(local_ip_for(ip))) for mac, ip in bulbs.items()]
+        acked = []
+        async for mac, reply, _ in self.engine.send_all(targets, "registration", limit=self.concurrency):
+            if fanout.is_success(reply):
+                self.registered[mac] = time.time()
+                acked.append(mac)
+        return acked
+
+    async def run(self):
+        """
+        Listen and refresh registrations every `interval` seconds until cancelled.
+        """
+        if self.transport is None:
+            await self.open()
+        try:
+            while True:
+                await self.register()
+                await asyncio.sleep(self.interval)
+        finally:
+            self.close()
+
+    def latest(self):
+        """
+        Return {mac: last pushed pilot}.
+        """
+        return {mac: entry["pilot"] for mac, entry in self.pilots.items()}
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description="Listen for state pushed by WiZ bulbs and print changes.")
+    parser.add_argument("--port", type=int, default=LISTEN_PORT)
+    parser.add_argument("--interval", type=float, default=REGISTER_INTERVAL,
+                        help="seconds between registration refreshes")
+    args = parser.parse_args(argv)
+
+    names = config.load().devices_by_mac()
+
+    def on_change(mac, pilot, changed):
+        summary = " ".join(f"{key}={pilot[key]}" for key in sorted(changed) if key in pilot)
+        print(f"{time.strftime('%H:%M:%S')}  {names.get(mac, {}).get('name', mac):<10}  {summary}", flush=True)
+
+    listener = PushListener(poller.configured_bulbs, args.port, args.interval, on_change=on_change)
+    try:
+        asyncio.run(listener.run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        state.get_state_cache().save()
+        registry.get_registry().save()
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,240 @@
+import os
+import re
+import json
+import time
+from collections import OrderedDict
+
+import tracing
+
+PROC_ARP = "/proc/net/arp"
+CACHE_PATH = os.environ.get(
+    "WIZ_REGISTRY_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "wizchatgpt", "registry.json"),
+)
+
+# Seconds an entry stays valid before it must be confirmed again.
+DEFAULT_TTL = 600
+# Don't rescan the neighbor table more often than this when MACs are missing.
+MIN_RESCAN_INTERVAL = 30
+MAX_ENTRIES = 4096
+
+# ARP flag for a complete (resolved) neighbor entry.
+ATF_COM = 0x2
+
+
+def normalize_mac(mac):
+    """
+    Normalize a MAC such as "CC:40:85:5A:79:6E" (or BSD-style with dropped
+    leading zeros) into the bare lowercase form used here ("cc40855a796e").
+    """
+    return ''.join(segment.zfill(2) for segment in mac.split(":")).lower()
+
+
+def read_proc_arp(path=PROC_ARP):
+    """
+    Read the kernel neighbor table directly.
+    Returns a list of tuples: (IP, MAC, interface).
+    """
+    devices = []
+    with open(path) as f:
+        next(f, None)  # header
+        for line in f:
+            fields = line.split()
+            if len(fields) < 6:
+                continue
+            ip, _, flags, mac, _, interface = fields[:6]
+            if not int(flags, 16) & ATF_COM or mac == "00:00:00:00:00:00":
+                continue
+            devices.append((ip, normalize_mac(mac), interface))
+    return devices
+
+
+def parse_arp_output(data):
+    """
+    Parse `arp -a` output and extract IP and MAC addresses.
+    Returns a list of tuples: (IP, MAC, interface or None).
+    """
+    pattern = r"\S+\s+\((\d+\.\d+\.\d+\.\d+)\)\s+at\s+([0-9A-Fa-f:]+)(?:.*?\son\s+(\S+))?"
+    return [(ip, normalize_mac(mac), interface or None) for ip, mac, interface in re.findall(pattern, data)]
+
+
+def read_arp_table():
+    """
+    Return the neighbor table as (IP, MAC, interface) tuples, preferring
+    /proc/net/arp and falling back to `arp -a` where it doesn't exist (macOS).
+    """
+    if os.path.exists(PROC_ARP):
+        with tracing.span("parse_arp", source=PROC_ARP):
+            return read_proc_arp()
+    import subprocess
+
+    with tracing.span("arp_command"):
+        result = subprocess.run(["arp", "-a"], capture_output=True, text=True)
+    with tracing.span("parse_arp", source="arp -a"):
+        return parse_arp_output(result.stdout)
+
+
+class Registry:
+    """
+    MAC -> IP table with per-entry TTL, LRU eviction and an on-disk warm cache.
+
+    Entries are stored as mac -> {"ip", "expires", "interface"} with wall-clock
+    expiry times so the cache stays meaningful across runs.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, path=CACHE_PATH, max_entries=MAX_ENTRIES):
+        self.ttl = ttl
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.last_scan = 0.0
+        self.dirty = False
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, mac):
+        return self.get(mac) is not None
+
+    def get(self, mac, now=None):
+        """
+        Return the cached IP for `mac`, or None if unknown or expired.
+        """
+        entry = self.entries.get(mac)
+        if entry is None:
+            return None
+        if entry["expires"] <= (now or time.time()):
+            del self.entries[mac]
+            self.dirty = True
+            return None
+        self.entries.move_to_end(mac)
+        return entry["ip"]
+
+    def interface(self, mac):
+        entry = self.entries.get(mac)
+        return entry.get("interface") if entry else None
+
+    def put(self, mac, ip, interface=None, ttl=None, now=None):
+        """
+        Insert or refresh one entry, evicting the least recently used if full.
+        """
+        entry = {"ip": ip, "expires": (now or time.time()) + (ttl or self.ttl)}
+        if interface:
+            entry["interface"] = interface
+        elif mac in self.entries and "interface" in self.entries[mac]:
+            entry["interface"] = self.entries[mac]["interface"]
+        self.entries[mac] = entry
+        self.entries.move_to_end(mac)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        self.dirty = True
+
+    def invalidate(self, mac):
+        if self.entries.pop(mac, None) is not None:
+            self.dirty = True
+
+    def evict_expired(self, now=None):
+        now = now or time.time()
+        for mac in [mac for mac, entry in self.entries.items() if entry["expires"] <= now]:
+            del self.entries[mac]
+            self.dirty = True
+
+    def items(self):
+        """
+        Return the live (mac, ip) pairs.
+        """
+        self.evict_expired()
+        return [(mac, entry["ip"]) for mac, entry in self.entries.items()]
+
+    def scan(self):
+        """
+        Refresh every entry from the neighbor table.
+        """
+        now = time.time()
+        with tracing.span("arp_scan"):
+            table = read_arp_table()
+        for ip, mac, interface in table:
+            self.put(mac, ip, interface, now=now)
+        self.last_scan = now
+        return self
+
+    def refresh_entry(self, mac):
+        """
+        Re-resolve a single MAC, e.g. after a send to its cached IP timed out.
+        Returns the new IP, or None if the neighbor table no longer has it.
+        """
+        self.invalidate(mac)
+        with tracing.span("arp_refresh", mac=mac):
+            table = read_arp_table()
+        for ip, table_mac, interface in table:
+            if table_mac == mac:
+                self.put(mac, ip, interface)
+                return ip
+        return None
+
+    def resolve(self, macs):
+        """
+        Return {mac: ip} for every MAC in `macs` that can be resolved.
+        The neighbor table is only scanned if some MAC is missing from the cache.
+        """
+        now = time.time()
+        resolved = {}
+        missing = []
+        for mac in macs:
+            ip = self.get(mac, now)
+            if ip:
+                resolved[mac] = ip
+            else:
+                missing.append(mac)
+        if missing and now - self.last_scan >= MIN_RESCAN_INTERVAL:
+            self.scan()
+            for mac in missing:
+                ip = self.get(mac)
+                if ip:
+                    resolved[mac] = ip
+        return resolved
+
+    def load(self):
+        """
+        Warm the table from disk; a missing or unreadable cache is ignored.
+        """
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return self
+        now = time.time()
+        for mac, entry in data.get("entries", {}).items():
+            if entry.get("expires", 0) > now:
+                self.entries[mac] = entry
+        self.last_scan = data.get("last_scan", 0.0)
+        self.dirty = False
+        return self
+
+    def save(self):
+        """
+        Persist the table atomically so a cold start can address bulbs without a scan.
+        """
+        if not self.dirty:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"last_scan": self.last_scan, "entries": self.entries}, f)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+
+_registry = None
+
+
+def get_registry():
+    """
+    Return the process-wide registry, loading the disk cache on first use.
+    """
+    global _registry
+    if _registry is None:
+        _registry = Registry().load()
+    return _registry
@@ -0,0 +1,197 @@
+import time
+import asyncio
+import collections
+
+import metrics
+
+# Sustained commands per second one bulb accepts without dropping any, and
+# how many may go back to back after it has been idle.
+BULB_RATE = 20.0
+BULB_BURST = 2
+# Ceiling for the whole fleet, so a big fan-out doesn't swamp the access point.
+GLOBAL_RATE = 500.0
+GLOBAL_BURST = 50
+
+
+class TokenBucket:
+    """
+    Token bucket that hands out reservations: `reserve()` always takes a token
+    and returns how long the caller must wait before using it.
+    A rate of None (or 0) never throttles.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def reserve(self, now=None):
+        if not self.rate:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def ready(self, now=None):
+        """
+        True if a token is available right now, without taking it.
+        """
+        if not self.rate:
+            return True
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens >= 1
+
+    def try_take(self, now=None):
+        """
+        Take a token if one is available right now. Returns True if taken.
+        """
+        if not self.ready(now):
+            return False
+        if self.rate:
+            self.tokens -= 1
+        return True
+
+
+class _BulbQueue:
+    def __init__(self, ip, rate, burst):
+        self.ip = ip
+        self.bucket = TokenBucket(rate, burst)
+        # Each item is [method, params, futures waiting on it].
+        self.items = collections.deque()
+        self.worker = None
+
+
+class SendScheduler:
+    """
+    Queue commands per bulb and send them no faster than each bulb's and the
+    fleet's token buckets allow.
+
+    A setPilot submitted while the bulb's last queued command is also a
+    setPilot replaces it (latest wins), so a bulb that can't keep up skips
+    stale frames instead of falling behind. Other methods are never merged.
+
+    With `acked` the engine waits for each reply (retransmitting as usual)
+    before the bulb's next command; otherwise commands are fire-and-forget.
+    """
+
+    def __init__(self, engine, rate=BULB_RATE, burst=BULB_BURST, global_rate=GLOBAL_RATE,
+                 global_burst=GLOBAL_BURST, acked=True, timeout=None):
+        self.engine = engine
+        self.rate = rate
+        self.burst = burst
+        self.bucket = TokenBucket(global_rate, global_burst)
+        self.acked = acked
+        self.timeout = timeout
+        self.queues = {}
+        self.coalesced = 0
+
+    def submit(self, key, ip, method, params):
+        """
+        Queue one command for bulb `key` at `ip`.
+        Returns a future resolving to (reply or None, latency, params sent); a
+        command that was coalesced away resolves with the result of the one
+        that replaced it. If sending raises, the future carries the exception.
+        """
+        future = asyncio.get_running_loop().create_future()
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = self.queues[key] = _BulbQueue(ip, self.rate, self.burst)
+        queue.ip = ip
+        if method == "setPilot" and queue.items and queue.items[-1][0] == "setPilot":
+            queue.items[-1][1] = params
+            queue.items[-1][2].append(future)
+            self.coalesced += 1
+            metrics.record_coalesced(key)
+        else:
+            queue.items.append([method, params, [future]])
+        metrics.record_queue_depth(key, len(queue.items))
+        if queue.worker is None:
+            queue.worker = asyncio.ensure_future(self._drain(key, queue))
+        return future
+
+    async def _drain(self, key, queue):
+        try:
+            while queue.items:
+                delay = queue.bucket.reserve()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                delay = self.bucket.reserve()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if not queue.items:
+                    break  # discarded while throttled
+                # Popped only now, so anything submitted while throttled still coalesces.
+                method, params, futures = queue.items.popleft()
+                metrics.record_queue_depth(key, len(queue.items))
+                try:
+                    result = await self._send(key, queue.ip, method, params)
+                except asyncio.CancelledError:
+                    for future in futures:
+                        future.cancel()
+                    raise
+                except Exception as e:
+                    # Only this command failed; the rest of the queue still goes out.
+                    for future in futures:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for future in futures:
+                    if not future.done():
+                        future.set_result(result)
+        finally:
+            queue.worker = None
+
+    async def _send(self, key, ip, method, params):
+        if self.acked:
+            reply, latency = await self.engine.request(ip, method, params, self.timeout, key)
+            return reply, latency, params
+        engine = self.engine
+        engine.transport.sendto(engine.build(method, params, engine.next_id()), (ip, engine.port))
+        metrics.record_send(key, method)
+        return None, 0.0, params
+
+    def depths(self):
+        """
+        Return {key: queued commands} for every bulb with a non-empty queue.
+        """
+        return {key: len(queue.items) for key, queue in self.queues.items() if queue.items}
+
+    def discard(self, key=None):
+        """
+        Drop queued (not yet sent) commands for `key`, or for every bulb.
+        Their futures resolve to (None, 0.0, None). Returns how many were dropped.
+        """
+        dropped = 0
+        keys = list(self.queues) if key is None else [key]
+        for key in keys:
+            queue = self.queues.get(key)
+            if queue is None:
+                continue
+            while queue.items:
+                dropped += 1
+                for future in queue.items.popleft()[2]:
+                    if not future.done():
+                        future.set_result((None, 0.0, None))
+            metrics.record_queue_depth(key, 0)
+        return dropped
+
+    async def drain(self):
+        """
+        Wait until every queued command has been sent.
+        """
+        while True:
+            workers = [queue.worker for queue in self.queues.values() if queue.worker is not None]
+            if not workers:
+                return
+            await asyncio.gather(*workers)
+
+    def close(self):
+        self.discard()
+        for queue in self.queues.values():
+            if queue.worker is not None:
+                queue.worker.cancel()
@@ -1,26 +1,15 @@
-import re
-import time
-import socket
-import json
-import subprocess
+import sys
+import asyncio
+import argparse
 
-DEVICES = {
-    "d8a01165a452": {"name": "DRESSER", "group": "accent"},
-    "cc40853d9142": {"name": "FACES", "group": "accent"},
-    "cc4085840e8a": {"name": "HORSE", "group": "accent"},
-    "cc40853e5276": {"name": "PIG", "group": "accent"},
-    "444f8e1f2fc8": {"name": "SKULLS", "group": "accent"},
+import state
+import config
+import registry
+import experimental
 
-    "cc40855a796e": {"name": "ALIEN", "group": "overhead"},
-    "cc4085558f40": {"name": "BATHROOM", "group": "overhead"},
-    "d8a011671f1a": {"name": "ENTRANCE", "group": "overhead"},
-    "cc4085558842": {"name": "K_0", "group": "overhead"},
-    "cc40855a7c1e": {"name": "K_1", "group": "overhead"},
-    "cc4085558c88": {"name": "S_0", "group": "overhead"},
-    "d8a01161d568": {"name": "S_1", "group": "overhead"},
-    "cc40855a7e7c": {"name": "TV_0", "group": "overhead"},
-    "d8a01162e8da": {"name": "TV_1", "group": "overhead"},
-}
+# Devices and groups come from the shared config file (devices.json).
+CONFIG = config.load()
+DEVICES = CONFIG.devices_by_mac()
 
 DEFAULT_PARAMS = {
     "r": 255,
@@ -33,7 +22,8 @@ DEFAULT_PARAMS = {
 
 SET = {
     "method": "setPilot",
-}.update(DEFAULT_PARAMS)
+    **DEFAULT_PARAMS,
+}
 
 ON = {
     "method": "setState",
@@ -65,45 +55,59 @@ COMMANDS = {
     "K_1":      None,
     "S_0":      None,
     "S_1":      None,
-    "TV_0":     SET.update(DEFAULT_PARAMS),
+    "TV_0":     SET,
     "TV_1":     None,
 }
 
-def send_command(ip, command):
-    terminal_command = ["echo", "{}".format(command)]  # Replace with the actual command split into a list
-    socat = ["socat", "-", "UDP-DATAGRAM:255.255.255.255:38899,broadcast"]
-    process1 = subprocess.Popen(terminal_command, stdout=subprocess.PIPE, text=True)
-    process2 = subprocess.run(socat, stdin=process1.stdout, capture_output=True, text=True, check=True)
-    results = process2.stdout
-    return results
-
-def build_command(method, params={}):
-    command = json.dumps({
-        "method": method,
-        "params": {k: v for k, v in params.items() if v is not None},
-    })
-    return command
-
 def arp():
-    pattern = re.compile(r"\((\d+\.\d+\.\d+\.\d+)\)\s+at\s+([0-9A-Fa-f]{2}(?::[0-9A-Fa-f]{2}){5})")
-    cmd = 'arp -a'
-    output = subprocess.check_output(cmd,shell=True,stderr=subprocess.STDOUT, text=True)
-    matches = pattern.findall(output)
-    macs_to_ips = {re.sub(r":", "", mac): ip for ip, mac in matches}
-    names_to_ips = {DEVICES[mac]: ip for mac, ip in macs_to_ips.items() if mac in DEVICES}
+    macs_to_ips = registry.get_registry().resolve(DEVICES)
+    names_to_ips = {DEVICES[mac]["name"]: ip for mac, ip in macs_to_ips.items()}
     return names_to_ips
 
-def run_commands():
-    names_to_ips = arp()
-    for name, command in COMMANDS:
-        if not command:
-            break
+def command_targets(names_to_ips):
+    """
+    Expand COMMANDS into (name, mac, ip, method, params) targets. A group's
+    command goes to each member without a command of its own; devices with
+    no command or no known IP are left out.
+    """
+    commands = {}
+    for name, command in COMMANDS.items():
+        group = name.lower()
+        if command and group in CONFIG.groups:
+            for member in CONFIG.groups[group]["members"]:
+                commands.setdefault(member, command)
+    for name, command in COMMANDS.items():
+        if command and name in CONFIG.devices:
+            commands[name] = command
+
+    targets = []
+    for name, command in commands.items():
         if name not in names_to_ips:
-            break
-        ip = names_to_ips[name]
-        send_command(ip, command)
-
-
+            continue
+        params = {key: value for key, value in command.items() if key != "method"}
+        targets.append((name, CONFIG.devices[name]["mac"], names_to_ips[name], command["method"], params))
+    return targets
+
+def run_commands(deadline=experimental.VERIFY_DEADLINE):
+    """
+    Send every command at once, reading each bulb back and resending until
+    it shows its command or `deadline` passes.
+    Returns {name: (verified, latency, attempts)}.
+    """
+    return asyncio.run(experimental.send_verified(command_targets(arp()), deadline))
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description="Send COMMANDS and verify each bulb shows its command.")
+    parser.add_argument("--deadline", type=float, default=experimental.VERIFY_DEADLINE,
+                        help="seconds to keep retrying bulbs whose read-back doesn't match")
+    args = parser.parse_args(argv)
+    results = run_commands(args.deadline)
+    for name, (verified, latency, attempts) in sorted(results.items()):
+        print(f"{name:<10} VERIFIED={str(verified).upper():<5}  ATTEMPTS={attempts}  LATENCY={latency * 1000:.0f}ms")
+    registry.get_registry().save()
+    state.get_state_cache().save()
+    if not all(verified for verified, _, _ in results.values()):
+        sys.exit(1)
 
 if __name__ == "__main__":
     run()
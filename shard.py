@@ -0,0 +1,257 @@
+import os
+import sys
+import zlib
+import asyncio
+import argparse
+import multiprocessing
+from multiprocessing.connection import wait
+
+import fanout
+import metrics
+
+# Requests in flight per worker.
+WORKER_CONCURRENCY = 256
+
+
+def shard_index(key, shards):
+    """
+    Stable shard for `key`, so a bulb always lands on the same worker and
+    keeps its RTT history there.
+    """
+    return zlib.crc32(str(key).encode()) % shards
+
+
+class _Worker:
+    # Runs in the child: one event loop and one UDP socket, kept for the pool's life.
+
+    def __init__(self, timeout, limit):
+        self.loop = asyncio.new_event_loop()
+        self.engine = fanout.FanoutEngine(timeout=timeout)
+        self.loop.run_until_complete(self.engine.open())
+        self.limit = limit
+        self.loaded = []
+
+    def load(self, entries, labels):
+        # Encode the slice once; every later apply only stamps fresh ids on.
+        metrics.DEVICE_LABELS.update(labels)
+        self.loaded = [
+            (key, ip, method, fanout.encode_body(method, params)) for key, ip, method, params in entries
+        ]
+        return {}
+
+    async def _collect(self, replies):
+        results = {}
+        async for key, reply, latency in replies:
+            results[key] = (reply, latency, self.engine.stats.get(key, {}).get("attempts", 1))
+        return results
+
+    def apply(self):
+        by_method = {}
+        for key, ip, method, body in self.loaded:
+            by_method.setdefault(method, []).append((key, ip, *self.engine.stamp(body)))
+
+        async def run():
+            results = {}
+            for method, targets in by_method.items():
+                results.update(await self._collect(
+                    self.engine.send_all_bytes(targets, method=method, limit=self.limit)
+                ))
+            return results
+
+        return self.loop.run_until_complete(run())
+
+    def send(self, targets, method, labels):
+        metrics.DEVICE_LABELS.update(labels)
+        return self.loop.run_until_complete(self._collect(
+            self.engine.send_all(targets, method, limit=self.limit)
+        ))
+
+    def close(self):
+        self.engine.close()
+        self.loop.close()
+
+
+def _worker_main(conn, timeout, limit):
+    worker = _Worker(timeout, limit)
+    try:
+        while True:
+            try:
+                op, args = conn.recv()
+            except EOFError:
+                return
+            if op == "close":
+                return
+            try:
+                results = getattr(worker, op)(*args)
+            except Exception as e:
+                conn.send(("error", f"{type(e).__name__}: {e}", None))
+                continue
+            # Ship this job's metrics to the coordinator and start fresh.
+            snapshot = metrics.METRICS.snapshot()
+            metrics.METRICS.reset()
+            conn.send(("ok", results, snapshot))
+    finally:
+        worker.close()
+
+
+def _labels(shard):
+    # Workers label their metrics the same way the coordinator would.
+    return {key: metrics.DEVICE_LABELS[key] for key, *_ in shard if key in metrics.DEVICE_LABELS}
+
+
+class ShardPool:
+    """
+    Split the fleet across worker processes, each with its own UDP socket,
+    event loop and slice of the MAC table.
+
+    Usage:
+        with ShardPool(workers=4) as pool:
+            pool.load(entries)          # [(key, ip, method, params)], encoded once
+            results = pool.apply()      # {key: (reply, latency, attempts)}
+            results = pool.send_all(targets, "setState")
+
+    The coordinator scatters a job to every worker at once and gathers the
+    per-bulb results as each finishes; the workers' metrics are merged into
+    this process's METRICS. A worker that dies doesn't fail the job: its
+    bulbs come back unanswered.
+    """
+
+    def __init__(self, workers=None, timeout=fanout.DEFAULT_TIMEOUT, limit=WORKER_CONCURRENCY):
+        self.workers = workers or os.cpu_count() or 1
+        self.timeout = timeout
+        self.limit = limit
+        self.processes = []
+        self.conns = []
+        # The keys each worker was given by load(), in worker order.
+        self.loaded = [[] for _ in range(self.workers)]
+
+    def start(self):
+        # spawn, not fork: the caller may already be running threads (e.g. the emulator).
+        context = multiprocessing.get_context("spawn")
+        for _ in range(self.workers):
+            parent, child = context.Pipe()
+            process = context.Process(target=_worker_main, args=(child, self.timeout, self.limit), daemon=True)
+            process.start()
+            child.close()
+            self.processes.append(process)
+            self.conns.append(parent)
+        return self
+
+    def close(self):
+        for conn in self.conns:
+            try:
+                conn.send(("close", ()))
+            except OSError:
+                pass
+            conn.close()
+        for process in self.processes:
+            process.join(timeout=2)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+        self.conns = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def partition(self, items, key=lambda item: item[0]):
+        shards = [[] for _ in range(self.workers)]
+        for item in items:
+            shards[shard_index(key(item), self.workers)].append(item)
+        return shards
+
+    def _scatter(self, jobs, keys):
+        # jobs[i] is (op, args) for worker i, or None to leave it idle; keys[i]
+        # are the bulbs it covers, reported as unanswered if the worker has died.
+        pending = {}
+        dead = []
+        for index, (conn, job) in enumerate(zip(self.conns, jobs)):
+            if job is None:
+                continue
+            try:
+                conn.send(job)
+            except OSError:
+                dead.append(index)
+                continue
+            pending[conn] = index
+        results = {}
+        errors = []
+        while pending:
+            for conn in wait(list(pending)):
+                index = pending.pop(conn)
+                try:
+                    status, payload, snapshot = conn.recv()
+                except (EOFError, OSError):
+                    dead.append(index)
+                    continue
+                if status != "ok":
+                    errors.append(payload)
+                    continue
+                results.update(payload)
+                metrics.METRICS.merge(snapshot)
+        if errors:
+            raise RuntimeError("; ".join(errors))
+        for index in dead:
+            print(f"Shard {index} died; its {len(keys[index])} bulbs got no reply.", file=sys.stderr)
+            results.update((key, (None, 0.0, 0)) for key in keys[index])
+        return results
+
+    def load(self, entries):
+        """
+        Give each worker its slice of (key, ip, method, params) entries to
+        encode and keep for apply().
+        """
+        shards = self.partition(entries)
+        self.loaded = [[key for key, *_ in shard] for shard in shards]
+        self._scatter([("load", (shard, _labels(shard))) for shard in shards], self.loaded)
+
+    def apply(self):
+        """
+        Send every loaded entry. Returns {key: (reply, latency, attempts)};
+        a worker that has died answers None for each of its bulbs.
+        """
+        return self._scatter([("apply", ()) for _ in self.conns], self.loaded)
+
+    def send_all(self, targets, method="setPilot"):
+        """
+        Send `method` to (key, ip, params) targets across the workers.
+        Returns {key: (reply, latency, attempts)}.
+        """
+        shards = self.partition(targets)
+        return self._scatter(
+            [("send", (shard, method, _labels(shard))) if shard else None for shard in shards],
+            [[key for key, *_ in shard] for shard in shards],
+        )
+
+
+def run(argv=None):
+    # Imported here so the spawned workers, which import this module, don't load the config.
+    import state
+    import config
+    import registry
+    import experimental
+
+    parser = argparse.ArgumentParser(description="Apply the configured scene with one worker process per core.")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    args = parser.parse_args(argv)
+
+    devices = config.load().devices_by_mac()
+    ips = registry.get_registry().resolve(devices)
+    data_list = [(experimental.get_alias(mac), mac, ip) for mac, ip in ips.items()]
+    with ShardPool(args.workers) as pool:
+        results = experimental.apply_sharded(data_list, pool)
+    # The workers only send; the parent records the outcome, so it keeps the caches.
+    registry.get_registry().save()
+    state.get_state_cache().save()
+    failed = sorted(alias for alias, (_, success, _, _) in results.items() if not success)
+    print(f"{len(results) - len(failed)}/{len(results)} acknowledged across {pool.workers} workers")
+    if failed:
+        print("NO REPLY: " + ", ".join(failed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,172 @@
+import os
+import json
+import time
+
+STATE_PATH = os.environ.get(
+    "WIZ_STATE_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "wizchatgpt", "state.json"),
+)
+
+# Seconds a remembered pilot state is trusted. Wall switches and the phone app
+# change bulbs behind our back, so stale entries are re-sent rather than skipped.
+DEFAULT_TTL = 300
+
+# getPilot fields that describe what the bulb is showing.
+PILOT_KEYS = ("state", "r", "g", "b", "c", "w", "dimming", "temp", "sceneId", "speed")
+
+# setPilot params whose spelling differs from the getPilot field.
+PARAM_ALIASES = {"sceneID": "sceneId"}
+
+# Channels of an RGB color, always sent together; a bulb shows either these
+# or a white "temp", never both.
+COLOR_KEYS = ("r", "g", "b", "c", "w")
+
+
+def is_success(reply):
+    """
+    Return True if a WiZ reply reports success.
+    """
+    if not reply:
+        return False
+    return reply.get("success") is True or reply.get("result", {}).get("success") is True
+
+
+def same_value(current, target):
+    """
+    True if a reported value shows `target`. Bulbs keep integers and may
+    truncate fractional channel values (31.875 -> 31).
+    """
+    if isinstance(current, (int, float)) and isinstance(target, (int, float)):
+        return abs(current - target) < 1
+    return current == target
+
+
+def pilot_diff(pilot, params, method="setPilot"):
+    """
+    Return the params of a `method` command that `pilot` (a getPilot result,
+    or None if unknown) does not show. Every param is returned when the state
+    is unknown or, for setPilot, the bulb is off or running a scene; a color
+    that differs in any channel is returned whole.
+    """
+    if method == "setState":
+        wanted = {"state": params.get("state")}
+        if pilot is None or bool(pilot.get("state")) != bool(wanted["state"]):
+            return wanted
+        return {}
+    wanted = {param: value for param, value in params.items() if value is not None}
+    if pilot is None or not pilot.get("state"):
+        return wanted
+    # Colors only hold while no scene is running.
+    if "sceneID" not in wanted and pilot.get("sceneId") not in (None, 0):
+        return wanted
+    diff = {
+        param: value for param, value in wanted.items()
+        if not same_value(pilot.get(PARAM_ALIASES.get(param, param)), value)
+    }
+    if any(key in diff for key in COLOR_KEYS):
+        diff.update({key: wanted[key] for key in COLOR_KEYS if key in wanted})
+    return diff
+
+
+class StateCache:
+    """
+    Last-known pilot state per MAC, seeded from getPilot replies and updated
+    from successful sends, used to skip bulbs that already show a target.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, path=STATE_PATH):
+        self.ttl = ttl
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+
+    def get(self, mac, now=None):
+        """
+        Return the remembered pilot dict for `mac`, or None if unknown or stale.
+        """
+        entry = self.entries.get(mac)
+        if entry is None or entry["updated"] + self.ttl <= (now or time.time()):
+            return None
+        return entry["pilot"]
+
+    def seed(self, mac, pilot):
+        """
+        Replace the state for `mac` with a getPilot result.
+        """
+        self.entries[mac] = {
+            "pilot": {key: pilot[key] for key in PILOT_KEYS if key in pilot and pilot[key] != ""},
+            "updated": time.time(),
+        }
+        self.dirty = True
+
+    def record_sent(self, mac, params, method="setPilot"):
+        """
+        Fold an acknowledged command into the state for `mac`.
+        """
+        pilot = dict(self.get(mac) or {})
+        if method == "setState":
+            pilot["state"] = params.get("state", pilot.get("state"))
+        else:
+            # setPilot turns the bulb on; a color or temperature replaces the scene.
+            pilot["state"] = True
+            if "sceneID" not in params or params["sceneID"] is None:
+                pilot["sceneId"] = 0
+            # A color replaces a white temperature and vice versa.
+            if any(params.get(key) is not None for key in COLOR_KEYS):
+                pilot.pop("temp", None)
+            elif params.get("temp") is not None:
+                for key in COLOR_KEYS:
+                    pilot.pop(key, None)
+            for param, value in params.items():
+                if value is not None:
+                    pilot[PARAM_ALIASES.get(param, param)] = value
+        self.entries[mac] = {"pilot": pilot, "updated": time.time()}
+        self.dirty = True
+
+    def forget(self, mac):
+        if self.entries.pop(mac, None) is not None:
+            self.dirty = True
+
+    def diff(self, mac, params):
+        """
+        Return the setPilot params that differ from what `mac` is showing.
+        Every param is returned when the state is unknown or the bulb is off.
+        """
+        return pilot_diff(self.get(mac), params)
+
+    def matches(self, mac, params):
+        return not self.diff(mac, params)
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+        self.dirty = False
+        return self
+
+    def save(self):
+        if not self.dirty:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+
+_state_cache = None
+
+
+def get_state_cache():
+    """
+    Return the process-wide state cache, loading it from disk on first use.
+    """
+    global _state_cache
+    if _state_cache is None:
+        _state_cache = StateCache().load()
+    return _state_cache
@@ -0,0 +1,102 @@
+import json
+
+# Characters reserved for each numeric field. Numbers are right-aligned and
+# space-padded ("r":  5), which is still valid JSON, so the packet never
+# changes length and a value can be overwritten in place.
+FIELD_WIDTHS = {
+    "r": 3,
+    "g": 3,
+    "b": 3,
+    "c": 3,
+    "w": 3,
+    "dimming": 3,
+    "temp": 4,
+    "sceneId": 3,
+    "speed": 3,
+}
+ID_WIDTH = 10
+
+_digits = {}
+_templates = {}
+
+
+def digits(width):
+    """
+    Return the table of pre-encoded, space-padded numbers 0 .. 10**width - 1.
+    """
+    table = _digits.get(width)
+    if table is None:
+        table = _digits[width] = [b"%*d" % (width, value) for value in range(10 ** width)]
+    return table
+
+
+class PacketTemplate:
+    """
+    A command serialized once with fixed-width slots for its numeric fields.
+
+    patch() overwrites the slots in the shared buffer through a memoryview;
+    no JSON is built and no packet bytes are allocated. The buffer is only
+    valid until the next patch, which is fine for sendto: the kernel (or the
+    transport, when it has to queue) copies the datagram before returning.
+    """
+
+    def __init__(self, fields, method="setPilot", request_id=0):
+        self.fields = tuple(fields)
+        marker = "#"
+        skeleton = json.dumps({
+            "id": marker * ID_WIDTH,
+            "method": method,
+            "params": {field: marker * FIELD_WIDTHS[field] for field in self.fields},
+        }, separators=(",", ":"))
+        # Strip the quotes around each placeholder so the slots hold bare numbers.
+        skeleton = skeleton.replace(f'"{marker}', marker).replace(f'{marker}"', marker)
+        self.buffer = bytearray(skeleton.encode())
+        self.view = memoryview(self.buffer)
+
+        self.slots = []
+        start = 0
+        for width in [ID_WIDTH] + [FIELD_WIDTHS[field] for field in self.fields]:
+            offset = self.buffer.index(b"#" * width, start)
+            self.slots.append((offset, offset + width, digits(width) if width != ID_WIDTH else None))
+            start = offset + width
+        self.set_id(request_id)
+        self.patch([0] * len(self.fields))
+
+    def set_id(self, request_id):
+        start, end, _ = self.slots[0]
+        self.view[start:end] = b"%*d" % (ID_WIDTH, request_id)
+
+    def patch(self, values):
+        """
+        Write integer `values` (in `fields` order) into their slots.
+        Values must already be quantized to the field's range.
+        """
+        view = self.view
+        for (start, end, table), value in zip(self.slots[1:], values):
+            view[start:end] = table[value]
+        return view
+
+    def send_batch(self, transport, rows, addrs):
+        """
+        Patch and send one datagram per (values, addr) pair from the same buffer.
+        `transport` is anything with sendto (a socket or asyncio transport).
+        Returns the number of datagrams sent.
+        """
+        sent = 0
+        view = self.view
+        for values, addr in zip(rows, addrs):
+            self.patch(values)
+            transport.sendto(view, addr)
+            sent += 1
+        return sent
+
+
+def template_for(fields, method="setPilot"):
+    """
+    Return the shared template for a parameter shape, building it on first use.
+    """
+    key = (tuple(fields), method)
+    template = _templates.get(key)
+    if template is None:
+        template = _templates[key] = PacketTemplate(fields, method)
+    return template
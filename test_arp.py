@@ -1,12 +1,89 @@
-import subprocess
-import re
-
-def arp():
-    pattern = re.compile(r"\((\d+\.\d+\.\d+\.\d+)\)\s+at\s+([0-9A-Fa-f]{2}(?::[0-9A-Fa-f]{2}){5})")
-    cmd = 'arp -a'
-    output = subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT, text=True)
-    matches = pattern.findall(output)
-    mac_ip_dict = {re.sub(r":", "", mac): ip for ip, mac in matches}
-    return mac_ip_dict
-
-arp()
\ No newline at end of file
+import pytest
+
+import registry
+
+PROC_ARP = """\
+IP address       HW type     Flags       HW address            Mask     Device
+192.168.1.20     0x1         0x2         cc:40:85:5a:79:6e     *        wlan0
+192.168.1.21     0x1         0x0         00:00:00:00:00:00     *        wlan0
+192.168.1.22     0x1         0x2         00:00:00:00:00:00     *        wlan0
+192.168.1.23     0x1         0x6         44:4F:8E:0A:1B:2C     *        eth0
+192.168.1.24     0x1
+"""
+
+ARP_A_LINUX = """\
+? (192.168.1.20) at cc:40:85:5a:79:6e [ether] on wlan0
+? (192.168.1.23) at 44:4f:8e:0a:1b:2c [ether] on eth0
+? (192.168.1.25) at <incomplete> on wlan0
+"""
+
+ARP_A_MACOS = """\
+? (192.168.1.20) at cc:40:85:5a:79:6e on en0 ifscope [ethernet]
+router.lan (192.168.1.1) at 0:11:22:3:44:5 on en0 ifscope [ethernet]
+"""
+
+
+@pytest.fixture
+def proc_arp(tmp_path):
+    path = tmp_path / "arp"
+    path.write_text(PROC_ARP)
+    return str(path)
+
+
+@pytest.fixture
+def arp_table(monkeypatch, proc_arp):
+    # Registry lookups read the fixture instead of the host's neighbor table.
+    monkeypatch.setattr(registry, "read_arp_table", lambda: registry.read_proc_arp(proc_arp))
+
+
+@pytest.fixture
+def reg(tmp_path):
+    return registry.Registry(path=str(tmp_path / "registry.json"))
+
+
+def test_read_proc_arp_skips_incomplete_entries(proc_arp):
+    assert registry.read_proc_arp(proc_arp) == [
+        ("192.168.1.20", "cc40855a796e", "wlan0"),
+        ("192.168.1.23", "444f8e0a1b2c", "eth0"),
+    ]
+
+
+def test_parse_arp_output_linux():
+    assert registry.parse_arp_output(ARP_A_LINUX) == [
+        ("192.168.1.20", "cc40855a796e", "wlan0"),
+        ("192.168.1.23", "444f8e0a1b2c", "eth0"),
+    ]
+
+
+def test_parse_arp_output_pads_bsd_macs():
+    assert registry.parse_arp_output(ARP_A_MACOS) == [
+        ("192.168.1.20", "cc40855a796e", "en0"),
+        ("192.168.1.1", "001122034405", "en0"),
+    ]
+
+
+def test_parse_arp_output_without_interface():
+    assert registry.parse_arp_output("? (10.0.0.7) at aa:bb:cc:dd:ee:ff\n") == [
+        ("10.0.0.7", "aabbccddeeff", None),
+    ]
+
+
+def test_scan_reads_the_neighbor_table(arp_table, reg):
+    reg.scan()
+    assert dict(reg.items()) == {"cc40855a796e": "192.168.1.20", "444f8e0a1b2c": "192.168.1.23"}
+    assert reg.interface("444f8e0a1b2c") == "eth0"
+
+
+def test_refresh_entry_forgets_macs_that_left(arp_table, reg):
+    reg.put("cc40855a796e", "192.168.1.99")
+    reg.put("aabbccddeeff", "192.168.1.98")
+    assert reg.refresh_entry("cc40855a796e") == "192.168.1.20"
+    assert reg.refresh_entry("aabbccddeeff") is None
+    assert "aabbccddeeff" not in reg
+
+
+def test_save_and_load_round_trip(arp_table, reg, tmp_path):
+    reg.scan().save()
+    loaded = registry.Registry(path=str(tmp_path / "registry.json"))
+    loaded.load()
+    assert dict(loaded.items()) == dict(reg.items())
@@ -0,0 +1,39 @@
+import asyncio
+
+import numpy as np
+
+import effects
+import scheduler
+
+
+class Recorder:
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, addr):
+        self.sent.append((bytes(data), addr))
+
+
+class Engine:
+    port = 38899
+
+    def __init__(self):
+        self.transport = Recorder()
+
+
+def test_fleet_refusal_keeps_the_bulb_token(monkeypatch):
+    # Each bulb gets one token for the whole run; the fleet two per frame.
+    monkeypatch.setattr(scheduler, "BULB_RATE", 0.001)
+    monkeypatch.setattr(scheduler, "BULB_BURST", 1)
+    monkeypatch.setattr(scheduler, "GLOBAL_RATE", 20)
+    monkeypatch.setattr(scheduler, "GLOBAL_BURST", 2)
+    targets = {f"bulb{n}": f"10.0.0.{n}" for n in range(4)}
+
+    def render(t):
+        return np.tile([255.0, 0.0, 0.0, 10.0 + 100 * t], (len(targets), 1))
+
+    engine = Engine()
+    stats = asyncio.run(effects.run_effect(targets, render, duration=0.25, fps=10, engine=engine))
+    # Bulbs the fleet turned away on the first frame still send on the next.
+    assert stats["packets"] == 4
+    assert sorted(addr[0] for _, addr in engine.transport.sent) == sorted(targets.values())
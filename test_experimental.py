@@ -0,0 +1,55 @@
+import pytest
+
+import experimental
+
+
+@pytest.fixture
+def tables():
+    # Tests edit the module tables in place; put the config's back afterwards.
+    yield experimental
+    experimental.load_tables(experimental.CONFIG)
+
+
+@pytest.fixture
+def mac(tables):
+    return experimental.ALL_MACS["FACES"]
+
+
+def test_compiled_table_is_cached(tables):
+    assert experimental.compile_params() is experimental.compile_params()
+
+
+def test_nested_override_edit_invalidates(tables, mac):
+    experimental.OVERRIDES["FACES"]["enabled"] = True
+    experimental.OVERRIDES["FACES"]["params"]["dimming"] = 55
+    entry = experimental.compile_params()[mac]
+    assert entry["device_override"] == "FACES"
+    assert entry["params"]["dimming"] == 55
+
+
+def test_default_edit_invalidates(tables, mac):
+    before = experimental.compile_params()
+    experimental.DEFAULT_PARAMS["dimming"] = 77
+    after = experimental.compile_params()
+    assert after is not before
+    assert after[experimental.ALL_MACS["DRESSER"]]["params"]["dimming"] == 77
+
+
+@pytest.mark.parametrize("edit", [
+    lambda params: params.update({"dimming": 12}),
+    lambda params: params.setdefault("speed", 100),
+    lambda params: params.pop("sceneID"),
+    lambda params: params.__delitem__("b"),
+    lambda params: params.clear(),
+])
+def test_every_mutator_invalidates(tables, edit):
+    experimental.compile_params()
+    edit(experimental.OVERRIDES["FACES"]["params"])
+    assert experimental._compiled_params is None
+
+
+def test_replaced_nested_dict_is_watched(tables, mac):
+    experimental.OVERRIDES["FACES"] = {"enabled": True, "params": {"r": 1, "g": 2, "b": 3}}
+    assert experimental.compile_params()[mac]["params"]["r"] == 1
+    experimental.OVERRIDES["FACES"]["params"]["r"] = 9
+    assert experimental.compile_params()[mac]["params"]["r"] == 9
@@ -0,0 +1,44 @@
+import asyncio
+
+import pytest
+
+import fanout
+import emulator
+
+# Not the real WiZ port, so the tests never collide with a running emulator.
+PORT = 48899
+
+
+@pytest.fixture(scope="module")
+def fleet():
+    # In its own process, as in bench.py, so replies really race the sends.
+    with emulator.EmulatorProcess(count=5000, latency=0.01, jitter=0.005, port=PORT, seed=1) as emu:
+        yield emu
+
+
+def send(fleet, limit):
+    targets = [(mac, ip, {"dimming": 50}) for mac, ip in fleet.macs_to_ips().items()]
+
+    async def run():
+        async with fanout.FanoutEngine(port=PORT, rtt=fanout.RttEstimator()) as engine:
+            return [result async for result in engine.send_all(targets, limit=limit)]
+
+    fleet.reset_counters()
+    return asyncio.run(run()), fleet.packets_received
+
+
+@pytest.mark.parametrize("limit", [fanout.CONCURRENCY, None])
+def test_large_fleet_is_not_retransmitted(fleet, limit):
+    # A bulb queued behind thousands of sends must not time out and be sent
+    # again while its first reply is still waiting to be read.
+    results, packets = send(fleet, limit)
+    assert sum(fanout.is_success(reply) for _, reply, _ in results) == fleet.count
+    assert packets / fleet.count <= 1.1
+
+
+def test_rtt_estimator_backoff_and_sample():
+    rtt = fanout.RttEstimator(initial_rto=0.25, min_rto=0.03, max_rto=1.0)
+    rtt.backoff("bulb")
+    assert rtt.rto("bulb") == 0.5
+    rtt.sample("bulb", 0.02)
+    assert rtt.rto("bulb") == pytest.approx(0.06)
@@ -0,0 +1,109 @@
+import json
+import socket
+
+import pytest
+
+import journal
+
+MACS = ["cc40855a796e", "444f8e0a1b2c"]
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "show.wizj")
+
+
+@pytest.fixture
+def receiver():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.settimeout(1.0)
+    yield sock
+    sock.close()
+
+
+def records(path):
+    with journal.JournalReader(path) as reader:
+        return [journal.RECORD.unpack_from(reader.map, offset)
+                for _, offsets in reader.frames() for offset in offsets]
+
+
+@pytest.mark.parametrize("params, expected", [
+    ({"r": 255, "g": 70, "b": 10, "dimming": 60}, (1, 255, 70, 10, 60, 0)),
+    ({"temp": 2700, "dimming": 40}, (1, 0, 0, 0, 40, 2700)),
+    ({"r": 300.4, "g": -5, "b": 31.875, "dimming": 5}, (1, 255, 0, 32, 10, 0)),
+    ({"state": False}, (0, 0, 0, 0, 100, 0)),
+    ({"sceneId": 4, "dimming": 50}, None),
+])
+def test_encode_state(params, expected):
+    assert journal.encode_state(params) == expected
+
+
+def test_round_trip(path):
+    with journal.JournalWriter(path, MACS) as writer:
+        writer.record(0.0, MACS[0], {"r": 255, "g": 0, "b": 0, "dimming": 80})
+        writer.record(0.0, MACS[1], {"temp": 4000, "dimming": 50})
+        writer.record(0.25, MACS[0], {"dimming": 30})
+        writer.record(0.5, MACS[1], {"state": False})
+    with journal.JournalReader(path) as reader:
+        assert reader.macs == MACS
+        assert len(reader) == 4
+        assert reader.duration() == 0.5
+        assert [(milliseconds, len(offsets)) for milliseconds, offsets in reader.frames()] == [
+            (0, 2), (250, 1), (500, 1),
+        ]
+    assert records(path) == [
+        (0, 0, 1, 255, 0, 0, 80, 0),
+        (0, 1, 1, 0, 0, 0, 50, 4000),
+        (250, 0, 1, 255, 0, 0, 30, 0),
+        (500, 1, 0, 0, 0, 0, 50, 4000),
+    ]
+
+
+def test_unrepresentable_records_are_skipped(path):
+    with journal.JournalWriter(path, MACS) as writer:
+        assert writer.record(0.0, MACS[0], {"dimming": 30}) is False
+        assert writer.record(0.1, MACS[0], {"sceneId": 4}) is False
+        assert writer.record(0.2, MACS[0], {"r": 1, "g": 2, "b": 3}) is True
+        assert (writer.count, writer.skipped) == (1, 2)
+
+
+def test_time_must_not_go_backwards(path):
+    with journal.JournalWriter(path, MACS) as writer:
+        writer.record(1.0, MACS[0], {"r": 1})
+        with pytest.raises(ValueError):
+            writer.record(0.5, MACS[0], {"r": 2})
+
+
+def test_bad_magic(tmp_path):
+    path = tmp_path / "bogus"
+    path.write_bytes(b"NOPE" + bytes(16))
+    with pytest.raises(ValueError):
+        journal.JournalReader(str(path)).open()
+
+
+def test_play_sends_every_state(path, receiver):
+    with journal.JournalWriter(path, MACS) as writer:
+        writer.record(0.0, MACS[0], {"r": 255, "g": 0, "b": 0, "dimming": 80})
+        writer.record(0.01, MACS[0], {"temp": 3000, "dimming": 20})
+        writer.record(0.02, MACS[0], {"state": False})
+    port = receiver.getsockname()[1]
+    stats = journal.play(path, {MACS[0]: "127.0.0.1"}, max_late=10.0, port=port)
+    assert stats["frames"] == 3 and stats["dropped"] == 0 and stats["packets"] == 3
+    assert stats["missing"] == [MACS[1]]
+    packets = [json.loads(receiver.recv(4096)) for _ in range(3)]
+    assert packets[0]["params"] == {"r": 255, "g": 0, "b": 0, "dimming": 80}
+    assert packets[1]["params"] == {"temp": 3000, "dimming": 20}
+    assert packets[2] == {"id": 0, "method": "setState", "params": {"state": False}}
+
+
+def test_play_folds_late_frames_into_the_end_state(path, receiver):
+    with journal.JournalWriter(path, MACS) as writer:
+        writer.record(0.0, MACS[0], {"r": 255, "g": 0, "b": 0, "dimming": 80})
+        writer.record(0.01, MACS[0], {"temp": 3000, "dimming": 20})
+        writer.record(0.02, MACS[0], {"state": False})
+    port = receiver.getsockname()[1]
+    # Every frame counts as late: all but the last are skipped.
+    stats = journal.play(path, {MACS[0]: "127.0.0.1"}, max_late=-1.0, port=port)
+    assert stats["frames"] == 3 and stats["dropped"] == 2 and stats["packets"] == 1
+    assert json.loads(receiver.recv(4096))["params"] == {"state": False}
@@ -0,0 +1,63 @@
+import json
+
+import pytest
+
+import metrics
+
+LABELS = {"method": "setPilot", "alias": "FACES", "group": "accent"}
+
+
+@pytest.fixture
+def worker():
+    worker = metrics.Metrics()
+    worker.inc("wiz_packets_sent_total", LABELS, 3)
+    worker.set("wiz_queue_depth", {"alias": "FACES", "group": "accent"}, 2)
+    for latency in (0.003, 0.02, 0.3, 5.0):
+        worker.observe("wiz_request_latency_seconds", LABELS, latency)
+    return worker
+
+
+def histogram(snapshot):
+    (entry,) = snapshot["histograms"]
+    return entry
+
+
+def test_merge_into_empty_matches_the_source(worker):
+    merged = metrics.Metrics()
+    merged.merge(worker.snapshot())
+    assert merged.snapshot() == worker.snapshot()
+
+
+def test_merge_adds_counters_and_histograms(worker):
+    merged = metrics.Metrics()
+    merged.merge(worker.snapshot())
+    merged.merge(worker.snapshot())
+    snapshot = merged.snapshot()
+    assert snapshot["counters"] == [{"name": "wiz_packets_sent_total", "labels": LABELS, "value": 6}]
+    latency = histogram(snapshot)
+    assert latency["count"] == 8
+    assert latency["sum"] == pytest.approx(2 * 5.323)
+    assert latency["buckets"]["0.005"] == 2
+    assert latency["buckets"]["0.025"] == 4
+    assert latency["buckets"]["2.5"] == 6
+    assert latency["buckets"]["+Inf"] == 8
+
+
+def test_merge_overwrites_gauges(worker):
+    merged = metrics.Metrics()
+    merged.set("wiz_queue_depth", {"alias": "FACES", "group": "accent"}, 9)
+    merged.merge(worker.snapshot())
+    assert merged.snapshot()["gauges"][0]["value"] == 2
+
+
+def test_merge_survives_json(worker):
+    # Worker snapshots cross a pipe; they must merge the same after a JSON trip.
+    merged = metrics.Metrics()
+    merged.merge(json.loads(worker.to_json()))
+    assert merged.snapshot() == worker.snapshot()
+
+
+def test_prometheus_text(worker):
+    text = worker.prometheus()
+    assert "# TYPE wiz_request_latency_seconds histogram" in text
+    assert 'wiz_packets_sent_total{alias="FACES",group="accent",method="setPilot"} 3' in text
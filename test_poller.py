@@ -0,0 +1,45 @@
+import pytest
+
+import poller
+
+
+@pytest.fixture
+def history():
+    history = poller.BulbHistory(capacity=4)
+    for second in range(6):
+        history.append(float(second), {"state": True, "r": second, "dimming": 50})
+    return history
+
+
+def test_ring_keeps_the_newest_samples(history):
+    assert len(history) == 4
+    assert [sample["time"] for sample in history.range()] == [2.0, 3.0, 4.0, 5.0]
+    assert [sample["r"] for sample in history.range()] == [2, 3, 4, 5]
+
+
+def test_latest_after_wraparound(history):
+    latest = history.latest()
+    assert latest["time"] == 5.0
+    assert latest["r"] == 5
+    assert latest["state"] is True and latest["reachable"] is True
+
+
+def test_range_bisects_across_the_wrap(history):
+    assert [sample["time"] for sample in history.range(3.0, 4.5)] == [3.0, 4.0]
+    assert [sample["time"] for sample in history.range(start=4.0)] == [4.0, 5.0]
+    assert [sample["time"] for sample in history.range(end=1.0)] == []
+
+
+def test_missing_reply_and_fields(history):
+    history.append(6.0, None)
+    history.append(7.0, {"state": False, "temp": 2700.0})
+    missed, off = history.range(6.0)
+    assert missed["reachable"] is False and missed["state"] is None and missed["r"] is None
+    assert off["state"] is False and off["temp"] == 2700 and off["r"] is None
+
+
+def test_empty_history():
+    history = poller.BulbHistory(capacity=3)
+    assert len(history) == 0
+    assert history.latest() is None
+    assert history.range() == []
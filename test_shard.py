@@ -0,0 +1,13 @@
+import shard
+
+
+def test_dead_worker_reports_its_bulbs_unanswered():
+    entries = [(f"bulb{n}", "127.0.0.1", "setPilot", {"dimming": 10}) for n in range(8)]
+    with shard.ShardPool(workers=2, timeout=0.05) as pool:
+        pool.load(entries)
+        dead = max(range(2), key=lambda index: len(pool.loaded[index]))
+        pool.processes[dead].kill()
+        pool.processes[dead].join()
+        results = pool.apply()
+    assert set(results) == {key for key, *_ in entries}
+    assert all(results[key] == (None, 0.0, 0) for key in pool.loaded[dead])
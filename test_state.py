@@ -0,0 +1,77 @@
+import pytest
+
+import state
+
+
+@pytest.fixture
+def pilot():
+    return {"state": True, "sceneId": 0, "r": 255, "g": 70, "b": 10, "dimming": 60, "temp": 2700}
+
+
+def test_unknown_state_sends_everything():
+    assert state.pilot_diff(None, {"r": 1, "g": 2, "b": 3}) == {"r": 1, "g": 2, "b": 3}
+
+
+def test_matching_pilot_sends_nothing(pilot):
+    assert state.pilot_diff(pilot, {"r": 255, "g": 70, "b": 10, "dimming": 60}) == {}
+
+
+def test_only_changed_params_are_sent(pilot):
+    assert state.pilot_diff(pilot, {"r": 255, "g": 70, "b": 10, "dimming": 80}) == {"dimming": 80}
+
+
+def test_fractional_channels_match_truncated_values(pilot):
+    assert state.pilot_diff(pilot, {"r": 255.4, "g": 70.9, "b": 10}) == {}
+
+
+def test_none_params_are_ignored(pilot):
+    assert state.pilot_diff(pilot, {"r": 255, "temp": None}) == {}
+
+
+def test_bulb_that_is_off_gets_everything(pilot):
+    pilot["state"] = False
+    assert state.pilot_diff(pilot, {"r": 255, "dimming": 60}) == {"r": 255, "dimming": 60}
+
+
+def test_running_scene_resends_colors(pilot):
+    pilot["sceneId"] = 4
+    assert state.pilot_diff(pilot, {"r": 255, "dimming": 60}) == {"r": 255, "dimming": 60}
+
+
+def test_scene_param_uses_getpilot_spelling(pilot):
+    pilot["sceneId"] = 4
+    assert state.pilot_diff(pilot, {"sceneID": 4, "dimming": 60}) == {}
+    assert state.pilot_diff(pilot, {"sceneID": 5, "dimming": 60}) == {"sceneID": 5}
+
+
+@pytest.mark.parametrize("current, wanted, expected", [
+    (True, True, {}),
+    (False, True, {"state": True}),
+    (True, False, {"state": False}),
+    (None, False, {"state": False}),
+])
+def test_set_state(pilot, current, wanted, expected):
+    pilot = None if current is None else dict(pilot, state=current)
+    assert state.pilot_diff(pilot, {"state": wanted}, "setState") == expected
+
+
+def test_state_cache_diff_uses_remembered_pilot(tmp_path, pilot):
+    cache = state.StateCache(path=str(tmp_path / "state.json"))
+    cache.seed("cc40855a796e", pilot)
+    assert cache.diff("cc40855a796e", {"r": 255, "dimming": 80}) == {"dimming": 80}
+    assert cache.diff("aabbccddeeff", {"r": 255}) == {"r": 255}
+
+
+def test_changed_color_is_sent_whole(pilot):
+    assert state.pilot_diff(pilot, {"r": 200, "g": 70, "b": 10, "dimming": 60}) == {"r": 200, "g": 70, "b": 10}
+
+
+def test_record_sent_switches_between_color_and_white(tmp_path, pilot):
+    cache = state.StateCache(path=str(tmp_path / "state.json"))
+    cache.seed("cc40855a796e", pilot)
+    cache.record_sent("cc40855a796e", {"temp": 4000})
+    assert "r" not in cache.get("cc40855a796e")
+    # The stale color must not make a return to it look half-done.
+    assert cache.diff("cc40855a796e", {"r": 255, "g": 70, "b": 10, "dimming": 60}) == {"r": 255, "g": 70, "b": 10}
+    cache.record_sent("cc40855a796e", {"r": 1, "g": 2, "b": 3})
+    assert "temp" not in cache.get("cc40855a796e")
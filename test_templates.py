@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+import templates
+
+
+@pytest.fixture
+def template():
+    return templates.PacketTemplate(("r", "g", "b", "dimming"), request_id=7)
+
+
+def test_patch_writes_values_in_place(template):
+    packet = bytes(template.patch((255, 0, 31, 100)))
+    assert json.loads(packet) == {
+        "id": 7, "method": "setPilot", "params": {"r": 255, "g": 0, "b": 31, "dimming": 100},
+    }
+
+
+def test_patch_never_changes_the_length(template):
+    lengths = {len(bytes(template.patch(values))) for values in [(0, 0, 0, 10), (5, 50, 255, 100)]}
+    assert len(lengths) == 1
+
+
+def test_patch_overwrites_the_previous_values(template):
+    template.patch((255, 255, 255, 100))
+    assert json.loads(bytes(template.patch((1, 2, 3, 10))))["params"] == {"r": 1, "g": 2, "b": 3, "dimming": 10}
+
+
+def test_set_id(template):
+    template.set_id(123456)
+    assert json.loads(bytes(template.patch((0, 0, 0, 10))))["id"] == 123456
+
+
+def test_temp_slot_is_wide_enough():
+    template = templates.PacketTemplate(("temp", "dimming"))
+    assert json.loads(bytes(template.patch((6500, 75))))["params"] == {"temp": 6500, "dimming": 75}
+
+
+def test_send_batch_patches_each_datagram(template):
+    class Recorder:
+        def __init__(self):
+            self.sent = []
+
+        def sendto(self, data, addr):
+            self.sent.append((bytes(data), addr))
+
+    transport = Recorder()
+    rows = [(1, 2, 3, 10), (4, 5, 6, 20)]
+    addrs = [("10.0.0.1", 38899), ("10.0.0.2", 38899)]
+    assert template.send_batch(transport, rows, addrs) == 2
+    assert [(json.loads(data)["params"]["r"], addr) for data, addr in transport.sent] == [
+        (1, addrs[0]), (4, addrs[1]),
+    ]
+
+
+def test_template_for_is_shared():
+    assert templates.template_for(("r", "g")) is templates.template_for(["r", "g"])
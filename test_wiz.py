@@ -0,0 +1,30 @@
+import pytest
+
+import wiz
+
+TABLE = {
+    "devices": {
+        "FACES": {"mac": "cc40853d9142", "group": "accent", "params": {}, "skip": False},
+        "ALIEN": {"mac": "cc40855a796e", "group": "accent", "params": {}, "skip": True},
+        "K_0": {"mac": "444f8e0a1b2c", "group": "overhead", "params": {}, "skip": True},
+    },
+    "groups": {"accent": ["FACES", "ALIEN"], "overhead": ["K_0"]},
+}
+
+
+def test_all_includes_skipped_devices():
+    # `wiz.py off all` must turn off the whole house, skip list included.
+    assert sorted(wiz.select_devices(TABLE, "all")) == ["ALIEN", "FACES", "K_0"]
+
+
+def test_group_in_config_order():
+    assert list(wiz.select_devices(TABLE, "accent")) == ["FACES", "ALIEN"]
+
+
+def test_single_device():
+    assert list(wiz.select_devices(TABLE, "K_0")) == ["K_0"]
+
+
+def test_unknown_target():
+    with pytest.raises(ValueError):
+        wiz.select_devices(TABLE, "GARAGE")
@@ -0,0 +1,148 @@
+import os
+import sys
+import json
+import time
+import atexit
+
+# Set WIZ_TRACE=/path/to/trace.json (or pass --trace) to record a run; open it in
+# chrome://tracing or ui.perfetto.dev. A summary table goes to stderr at exit.
+TRACE_PATH = os.environ.get("WIZ_TRACE")
+
+ENABLED = False
+_path = None
+_origin = time.perf_counter()
+_events = []
+# lane name -> Chrome trace thread id
+_lanes = {}
+
+
+def _lane(name):
+    tid = _lanes.get(name)
+    if tid is None:
+        tid = _lanes[name] = len(_lanes) + 1
+    return tid
+
+
+def _us(timestamp):
+    return (timestamp - _origin) * 1e6
+
+
+class _Span:
+    __slots__ = ("name", "cat", "lane", "args", "start")
+
+    def __init__(self, name, cat, lane, args):
+        self.name = name
+        self.cat = cat
+        self.lane = lane
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        complete(self.name, self.start, time.perf_counter(), self.cat, self.lane, **self.args)
+        return False
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(name, cat="phase", lane="main", **args):
+    """
+    Context manager timing one phase. A shared no-op when tracing is off.
+    """
+    if not ENABLED:
+        return _NO_SPAN
+    return _Span(name, cat, lane, args)
+
+
+def now():
+    """
+    Timestamp for complete(); perf_counter, the clock spans use.
+    """
+    return time.perf_counter()
+
+
+def complete(name, start, end, cat="phase", lane="main", **args):
+    """
+    Record an event that ran from `start` to `end` (perf_counter times),
+    e.g. one bulb's request, measured by the caller.
+    """
+    if not ENABLED:
+        return
+    _events.append({
+        "name": name, "cat": cat, "ph": "X", "pid": 1, "tid": _lane(lane),
+        "ts": _us(start), "dur": (end - start) * 1e6, "args": args,
+    })
+
+
+def enable(path=None):
+    """
+    Start recording; the trace is written to `path` (if any) at exit.
+    """
+    global ENABLED, _path
+    if not ENABLED:
+        atexit.register(finish)
+    ENABLED = True
+    _path = path or _path
+
+
+def summary():
+    """
+    Aggregate recorded events by (category, name).
+    Returns rows of (cat, name, count, total_ms, mean_ms, max_ms), largest total first.
+    """
+    totals = {}
+    for event in _events:
+        key = (event["cat"], event["name"])
+        count, total, longest = totals.get(key, (0, 0.0, 0.0))
+        duration = event["dur"] / 1000
+        totals[key] = (count + 1, total + duration, max(longest, duration))
+    rows = [
+        (cat, name, count, total, total / count, longest)
+        for (cat, name), (count, total, longest) in totals.items()
+    ]
+    return sorted(rows, key=lambda row: -row[3])
+
+
+def format_summary():
+    lines = [f"{'CATEGORY':<8} {'PHASE':<24} {'COUNT':>6} {'TOTAL':>10} {'MEAN':>9} {'MAX':>9}"]
+    for cat, name, count, total, mean, longest in summary():
+        lines.append(f"{cat:<8} {name:<24} {count:>6} {total:>8.1f}ms {mean:>7.2f}ms {longest:>7.2f}ms")
+    return "\n".join(lines)
+
+
+def write(path):
+    metadata = [
+        {"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": lane}}
+        for lane, tid in _lanes.items()
+    ]
+    with open(path, "w") as f:
+        json.dump({"traceEvents": metadata + _events, "displayTimeUnit": "ms"}, f)
+
+
+def finish():
+    """
+    Write the trace file and print the summary table. Runs at exit when enabled.
+    """
+    if not _events:
+        return
+    if _path:
+        write(_path)
+        print(f"Trace written to {_path}", file=sys.stderr)
+    print(format_summary(), file=sys.stderr)
+
+
+if TRACE_PATH:
+    enable(TRACE_PATH)
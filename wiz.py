@@ -0,0 +1,254 @@
+import time
+
+# Taken before any other import so --timing covers them. CPU time used so
+# far approximates the interpreter's own start-up, which happens before us.
+STARTED = time.perf_counter()
+INTERPRETER_CPU = time.process_time()
+
+import os
+import sys
+import json
+import socket
+import argparse
+
+import config
+import tracing
+
+# Quick commands (on, off, status) talk to the bulbs over a plain blocking
+# socket: importing asyncio would cost more than the whole command.
+# Same port as fanout.WIZ_PORT, which isn't imported here for that reason.
+WIZ_PORT = 38899
+TIMEOUT = 1.0
+# Unanswered bulbs are sent the request again this often until TIMEOUT.
+RETRY_INTERVAL = 0.25
+
+
+def select_devices(table, target="all"):
+    """
+    Return {name: device} from a compiled table for `target`: a device name,
+    a group or "all". The skip list only keeps devices out of the scene
+    (apply); on, off and status reach every device they name.
+    """
+    devices = table["devices"]
+    if target == "all":
+        return dict(devices)
+    if target in table["groups"]:
+        return {name: devices[name] for name in table["groups"][target]}
+    if target in devices:
+        return {target: devices[target]}
+    raise ValueError(f"unknown target: {target}")
+
+
+def request_all(targets, method, params=None, timeout=TIMEOUT, retry_interval=RETRY_INTERVAL):
+    """
+    Send `method` to every (name, ip) target from one blocking socket,
+    resending to the silent ones every `retry_interval` until `timeout`.
+    Returns {name: (reply dict or None, latency, attempts)}.
+    """
+    pending = {}
+    for index, (name, ip) in enumerate(targets):
+        request_id = index + 1
+        payload = json.dumps({"id": request_id, "method": method, "params": params or {}}).encode()
+        pending[request_id] = (name, ip, payload)
+    results = {name: (None, timeout, 1) for name, _ in targets}
+    attempts = 1
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        start = time.monotonic()
+        deadline = start + timeout
+        resend = start + retry_interval
+        for _, ip, payload in pending.values():
+            sock.sendto(payload, (ip, WIZ_PORT))
+        while pending:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            if now >= resend:
+                attempts += 1
+                for name, ip, payload in pending.values():
+                    sock.sendto(payload, (ip, WIZ_PORT))
+                    results[name] = (None, timeout, attempts)
+                resend = now + retry_interval
+            sock.settimeout(min(deadline, resend) - now)
+            try:
+                data, (ip, _) = sock.recvfrom(4096)
+            except socket.timeout:
+                continue
+            try:
+                reply = json.loads(data.decode())
+            except ValueError:
+                continue
+            entry = pending.get(reply.get("id")) if isinstance(reply, dict) else None
+            if entry is None or entry[1] != ip:
+                continue
+            del pending[reply["id"]]
+            results[entry[0]] = (reply, time.monotonic() - start, attempts)
+    finally:
+        sock.close()
+    return results
+
+
+def _resolve(table, target):
+    import registry
+
+    devices = select_devices(table, target)
+    with tracing.span("resolve", devices=len(devices)):
+        ips = registry.get_registry().resolve(device["mac"] for device in devices.values())
+    missing = sorted(name for name, device in devices.items() if device["mac"] not in ips)
+    return {name: (device["mac"], ips[device["mac"]]) for name, device in devices.items()
+            if device["mac"] in ips}, missing
+
+
+def _save():
+    import state
+    import metrics
+    import registry
+
+    with tracing.span("save_caches"):
+        registry.get_registry().save()
+        state.get_state_cache().save()
+        metrics.METRICS.write_textfile()
+
+
+def power(table, target, on, timeout=TIMEOUT):
+    """
+    Turn the devices named by `target` on or off. Returns True if every one acknowledged.
+    """
+    import state
+    import metrics
+
+    devices, missing = _resolve(table, target)
+    params = {"state": on}
+    with tracing.span("send", devices=len(devices)):
+        results = request_all([(name, ip) for name, (_, ip) in devices.items()], "setState", params, timeout)
+    cache = state.get_state_cache()
+    width = max((len(name) for name in devices), default=0)
+    for name, (mac, ip) in devices.items():
+        reply, latency, attempts = results[name]
+        metrics.record_send(name, "setState", count=attempts)
+        if state.is_success(reply):
+            metrics.record_reply(name, "setState", latency)
+            cache.record_sent(mac, params, "setState")
+            print(f"{name:<{width}}  {ip:<15}  {'ON' if on else 'OFF':<3}  ATTEMPTS={attempts}  LATENCY={latency * 1000:.0f}ms")
+        else:
+            metrics.record_timeout(name, "setState")
+            cache.forget(mac)
+            print(f"{name:<{width}}  {ip:<15}  NO REPLY")
+    for name in missing:
+        print(f"{name:<{width}}  NOT FOUND")
+    _save()
+    return not missing and all(state.is_success(reply) for reply, _, _ in results.values())
+
+
+def status(table, target, timeout=TIMEOUT):
+    """
+    Read every device named by `target` with getPilot and print what it shows.
+    Returns True if every one answered.
+    """
+    import state
+
+    devices, missing = _resolve(table, target)
+    with tracing.span("send", devices=len(devices)):
+        results = request_all([(name, ip) for name, (_, ip) in devices.items()], "getPilot", None, timeout)
+    cache = state.get_state_cache()
+    width = max((len(name) for name in devices), default=0)
+    for name, (mac, ip) in devices.items():
+        reply, latency, _ = results[name]
+        pilot = reply.get("result") if reply else None
+        if not isinstance(pilot, dict):
+            print(f"{name:<{width}}  {ip:<15}  NO REPLY")
+            continue
+        cache.seed(mac, pilot)
+        if not pilot.get("state"):
+            shown = "OFF"
+        elif pilot.get("sceneId"):
+            shown = f"SCENE={pilot['sceneId']}  DIMMING={pilot.get('dimming', '')}"
+        elif "temp" in pilot:
+            shown = f"TEMP={pilot['temp']}  DIMMING={pilot.get('dimming', '')}"
+        else:
+            shown = (f"RED={pilot.get('r', ''):<3}  GREEN={pilot.get('g', ''):<3}  "
+                     f"BLUE={pilot.get('b', ''):<3}  DIMMING={pilot.get('dimming', '')}")
+        print(f"{name:<{width}}  {ip:<15}  {shown}  LATENCY={latency * 1000:.0f}ms")
+    for name in missing:
+        print(f"{name:<{width}}  NOT FOUND")
+    _save()
+    return not missing and all(isinstance((reply or {}).get("result"), dict) for reply, _, _ in results.values())
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description="Control the configured WiZ bulbs.")
+    parser.add_argument("--timing", action="store_true", default=bool(os.environ.get("WIZ_TIMING")),
+                        help="report startup and command time on stderr (or set WIZ_TIMING=1)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    # Options after "discover" are passed on to discover.py.
+    subparsers.add_parser("discover", help="find bulbs with a getPilot broadcast (takes discover.py's options)")
+    apply_parser = subparsers.add_parser("apply", help="apply the configured scene")
+    apply_parser.add_argument("--verify", action="store_true", help="read every bulb back and retry mismatches")
+    for name in ("on", "off", "status"):
+        quick_parser = subparsers.add_parser(name, help=f"{name} for a device, a group or all")
+        quick_parser.add_argument("target", nargs="?", default="all")
+        quick_parser.add_argument("--timeout", type=float, default=TIMEOUT, help="seconds to wait for replies")
+    fade_parser = subparsers.add_parser("fade", help="fade one device to new params")
+    fade_parser.add_argument("device")
+    fade_parser.add_argument("--seconds", type=float, default=None)
+    fade_parser.add_argument("--easing", default="ease_in_out")
+    for param in ("r", "g", "b", "dimming", "temp"):
+        fade_parser.add_argument(f"--{param}", type=int)
+    args, extra = parser.parse_known_args(argv)
+    if extra and args.command != "discover":
+        parser.error(f"unrecognized arguments: {' '.join(extra)}")
+
+    imported = time.perf_counter()
+    ok = True
+    if args.command in ("on", "off", "status"):
+        # The fast path: a cached, pre-resolved device table and no asyncio.
+        with tracing.span("load_devices"):
+            table, cached = config.load_compiled()
+        loaded = time.perf_counter()
+        try:
+            if args.command == "status":
+                ok = status(table, args.target, args.timeout)
+            else:
+                ok = power(table, args.target, args.command == "on", args.timeout)
+        except ValueError as e:
+            parser.error(str(e))
+        source = "cache" if cached else "config"
+    else:
+        loaded = imported
+        source = None
+        if args.command == "discover":
+            import discover
+            discover.run(extra)
+        elif args.command == "apply":
+            import experimental
+            experimental.wrap(verify=args.verify)
+        else:
+            import fade
+            import experimental
+            if args.easing not in fade.EASINGS:
+                parser.error(f"unknown easing: {args.easing}")
+            end = {param: getattr(args, param) for param in ("r", "g", "b", "dimming", "temp")
+                   if getattr(args, param) is not None}
+            if not end:
+                parser.error("fade needs at least one of --r --g --b --dimming --temp")
+            if args.device not in experimental.ALL_MACS:
+                parser.error(f"unknown device: {args.device}")
+            seconds = experimental.FADE_SECONDS if args.seconds is None else args.seconds
+            stats = experimental.fade_device(args.device, end, seconds, args.easing)
+            ok = stats is not None
+    finished = time.perf_counter()
+
+    if args.timing:
+        devices = f", devices {(loaded - imported) * 1000:.1f}ms from {source}" if source else ""
+        print(
+            f"startup {(loaded - STARTED) * 1000:.1f}ms (imports {(imported - STARTED) * 1000:.1f}ms{devices}), "
+            f"command {(finished - loaded) * 1000:.1f}ms, interpreter ~{INTERPRETER_CPU * 1000:.0f}ms cpu",
+            file=sys.stderr,
+        )
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    run()